@@ -0,0 +1,121 @@
+from aws_cdk import (
+    Aws,
+    aws_s3,
+    CfnCondition,
+    CfnParameter,
+    Fn
+)
+from constructs import Construct
+
+# prefixes Mastodon (Paperclip) uses for local uploads; federated media lives under cache/
+LOCAL_MEDIA_PREFIXES = ["media_attachments/", "accounts/"]
+# cached remote media that the weekly 'tootctl media remove --days' also clears; other cache/ prefixes
+# (avatars and headers under cache/accounts/, cache/custom_emojis/) are never re-fetched once deleted
+EXPIRING_CACHE_PREFIX = "cache/media_attachments/"
+
+class AssetsBucketLifecycle(Construct):
+    """S3 lifecycle rules for the bucket created by the common AssetsBucket construct."""
+
+    def __init__(
+            self,
+            scope: Construct,
+            id: str,
+            *,
+            bucket,
+            default_cache_expiration_days: int = 14,
+            **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        self.cache_expiration_days_param = CfnParameter(
+            self,
+            "CacheExpirationDays",
+            default=default_cache_expiration_days,
+            description="Required: Days after which S3 deletes cached remote media attachments under cache/media_attachments/. The weekly 'tootctl media remove' uses the same age to clear the database records. 0 disables expiration.",
+            min_value=0,
+            type="Number"
+        )
+        self.cache_expiration_days_param.override_logical_id(f"{id}CacheExpirationDays")
+        self.intelligent_tiering_param = CfnParameter(
+            self,
+            "IntelligentTiering",
+            allowed_values=["true", "false"],
+            default="true",
+            description="Required: Move local uploads larger than 128 KB to S3 Intelligent-Tiering."
+        )
+        self.intelligent_tiering_param.override_logical_id(f"{id}IntelligentTiering")
+
+        self.cache_expiration_condition = CfnCondition(
+            self,
+            "CacheExpirationCondition",
+            expression=Fn.condition_not(Fn.condition_equals(self.cache_expiration_days_param.value, "0"))
+        )
+        self.cache_expiration_condition.override_logical_id(f"{id}CacheExpirationCondition")
+        self.intelligent_tiering_condition = CfnCondition(
+            self,
+            "IntelligentTieringCondition",
+            expression=Fn.condition_equals(self.intelligent_tiering_param.value, "true")
+        )
+        self.intelligent_tiering_condition.override_logical_id(f"{id}IntelligentTieringCondition")
+
+        rules = [
+            Fn.condition_if(
+                self.cache_expiration_condition.logical_id,
+                {
+                    "Id": "ExpireCachedRemoteMedia",
+                    "Prefix": EXPIRING_CACHE_PREFIX,
+                    "ExpirationInDays": self.cache_expiration_days_param.value_as_number,
+                    "Status": "Enabled"
+                },
+                Aws.NO_VALUE
+            ),
+            {
+                "Id": "AbortIncompleteMultipartUploads",
+                "AbortIncompleteMultipartUpload": {"DaysAfterInitiation": 7},
+                "Status": "Enabled"
+            }
+        ]
+        for i, prefix in enumerate(LOCAL_MEDIA_PREFIXES):
+            rules.append(
+                Fn.condition_if(
+                    self.intelligent_tiering_condition.logical_id,
+                    {
+                        "Id": f"IntelligentTieringLocalMedia{i + 1}",
+                        "Prefix": prefix,
+                        "ObjectSizeGreaterThan": 131072,
+                        "Transitions": [
+                            {"StorageClass": "INTELLIGENT_TIERING", "TransitionInDays": 0}
+                        ],
+                        "Status": "Enabled"
+                    },
+                    Aws.NO_VALUE
+                )
+            )
+
+        # only the bucket the common construct creates; an existing bucket keeps its own rules
+        for cfn_bucket in bucket.node.find_all():
+            if isinstance(cfn_bucket, aws_s3.CfnBucket):
+                cfn_bucket.add_property_override("LifecycleConfiguration", {"Rules": rules})
+
+    def metadata_parameter_group(self):
+        return [
+            {
+                "Label": {
+                    "default": "Assets Bucket Lifecycle"
+                },
+                "Parameters": [
+                    self.cache_expiration_days_param.logical_id,
+                    self.intelligent_tiering_param.logical_id
+                ]
+            }
+        ]
+
+    def metadata_parameter_labels(self):
+        return {
+            self.cache_expiration_days_param.logical_id: {
+                "default": "Cached Remote Media Expiration (days)"
+            },
+            self.intelligent_tiering_param.logical_id: {
+                "default": "Intelligent-Tiering for Local Uploads"
+            }
+        }
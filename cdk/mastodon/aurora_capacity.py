@@ -0,0 +1,130 @@
+from aws_cdk import (
+    Aws,
+    aws_rds,
+    CfnCondition,
+    CfnParameter,
+    Fn
+)
+from constructs import Construct
+
+class AuroraCapacity(Construct):
+    """Capacity and storage modes layered on top of the common AuroraPostgresql construct.
+
+    The common construct only offers provisioned instance classes, so this
+    overrides the cluster and its instances to allow Aurora Serverless v2 and
+    Aurora I/O-Optimized storage.
+    """
+
+    def __init__(
+            self,
+            scope: Construct,
+            id: str,
+            *,
+            db,
+            default_capacity_mode: str = "Provisioned",
+            default_serverless_max_capacity: float = 16,
+            default_serverless_min_capacity: float = 0.5,
+            default_storage_type: str = "aurora",
+            **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        self.capacity_mode_param = CfnParameter(
+            self,
+            "CapacityMode",
+            allowed_values=["Provisioned", "ServerlessV2"],
+            default=default_capacity_mode,
+            description="Required: Provisioned uses the DB instance class parameter; ServerlessV2 scales each instance between the minimum and maximum ACUs."
+        )
+        self.capacity_mode_param.override_logical_id(f"{id}Mode")
+        self.serverless_min_capacity_param = CfnParameter(
+            self,
+            "ServerlessMinCapacity",
+            default=default_serverless_min_capacity,
+            description="Required: Minimum Aurora Capacity Units (ACUs) for each instance when using ServerlessV2. 0 enables auto-pause.",
+            max_value=256,
+            min_value=0,
+            type="Number"
+        )
+        self.serverless_min_capacity_param.override_logical_id(f"{id}ServerlessMin")
+        self.serverless_max_capacity_param = CfnParameter(
+            self,
+            "ServerlessMaxCapacity",
+            default=default_serverless_max_capacity,
+            description="Required: Maximum Aurora Capacity Units (ACUs) for each instance when using ServerlessV2.",
+            max_value=256,
+            min_value=1,
+            type="Number"
+        )
+        self.serverless_max_capacity_param.override_logical_id(f"{id}ServerlessMax")
+        self.storage_type_param = CfnParameter(
+            self,
+            "StorageType",
+            allowed_values=["aurora", "aurora-iopt1"],
+            default=default_storage_type,
+            description="Required: Aurora storage configuration. 'aurora' is Standard (pay per I/O); 'aurora-iopt1' is I/O-Optimized, which is cheaper when I/O exceeds about 25% of the database bill."
+        )
+        self.storage_type_param.override_logical_id(f"{id}StorageType")
+
+        self.serverless_condition = CfnCondition(
+            self,
+            "ServerlessCondition",
+            expression=Fn.condition_equals(self.capacity_mode_param.value, "ServerlessV2")
+        )
+        self.serverless_condition.override_logical_id(f"{id}ServerlessCondition")
+
+        db.db_cluster.add_property_override(
+            "ServerlessV2ScalingConfiguration",
+            Fn.condition_if(
+                self.serverless_condition.logical_id,
+                {
+                    "MinCapacity": self.serverless_min_capacity_param.value_as_number,
+                    "MaxCapacity": self.serverless_max_capacity_param.value_as_number
+                },
+                Aws.NO_VALUE
+            )
+        )
+        db.db_cluster.add_property_override("StorageType", self.storage_type_param.value_as_string)
+
+        # the common construct may create replicas as well as the primary, so override every instance
+        for instance in db.node.find_all():
+            if isinstance(instance, aws_rds.CfnDBInstance):
+                instance.add_property_override(
+                    "DBInstanceClass",
+                    Fn.condition_if(
+                        self.serverless_condition.logical_id,
+                        "db.serverless",
+                        instance.db_instance_class
+                    )
+                )
+
+    def metadata_parameter_group(self):
+        return [
+            {
+                "Label": {
+                    "default": "Database Capacity"
+                },
+                "Parameters": [
+                    self.capacity_mode_param.logical_id,
+                    self.serverless_min_capacity_param.logical_id,
+                    self.serverless_max_capacity_param.logical_id,
+                    self.storage_type_param.logical_id
+                ]
+            }
+        ]
+
+    def metadata_parameter_labels(self):
+        return {
+            self.capacity_mode_param.logical_id: {
+                "default": "Database Capacity Mode"
+            },
+            self.serverless_min_capacity_param.logical_id: {
+                "default": "Serverless v2 Minimum ACUs"
+            },
+            self.serverless_max_capacity_param.logical_id: {
+                "default": "Serverless v2 Maximum ACUs"
+            },
+            self.storage_type_param.logical_id: {
+                "default": "Database Storage Type"
+            }
+        }
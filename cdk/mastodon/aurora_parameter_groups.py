@@ -0,0 +1,148 @@
+from typing import Dict, Optional
+
+from aws_cdk import (
+    aws_rds,
+    CfnParameter
+)
+from constructs import Construct
+
+# applied to every instance in the cluster; memory values are kB and scale with the instance class
+# (for Serverless v2, DBInstanceClassMemory follows the maximum ACU setting)
+DEFAULT_CLUSTER_PARAMETERS = {
+    # slow query capture
+    "shared_preload_libraries": "pg_stat_statements,auto_explain",
+    "pg_stat_statements.max": "10000",
+    "track_io_timing": "1",
+    "auto_explain.log_min_duration": "2000",
+    "auto_explain.log_format": "json",
+    "auto_explain.log_nested_statements": "1",
+    "log_min_duration_statement": "1000",
+    # timelines are index scans over hot data that Aurora serves from the buffer cache or shared storage
+    "random_page_cost": "1.1",
+    "effective_io_concurrency": "200",
+    # statuses, notifications and the stats tables churn constantly; vacuum earlier and faster
+    "autovacuum_naptime": "15",
+    "autovacuum_vacuum_scale_factor": "0.05",
+    "autovacuum_analyze_scale_factor": "0.02",
+    "autovacuum_vacuum_insert_scale_factor": "0.05",
+    "autovacuum_vacuum_cost_limit": "2000",
+    "autovacuum_max_workers": "GREATEST({DBInstanceClassMemory/8589934592},3)",
+    "work_mem": "GREATEST({DBInstanceClassMemory/524288},4096)",
+    "maintenance_work_mem": "GREATEST({DBInstanceClassMemory/16384},65536)"
+}
+
+DEFAULT_INSTANCE_PARAMETERS = {
+    "log_temp_files": "10240"
+}
+
+# cluster parameters operators can tune from the template: parameter id, label and description
+TUNABLE_CLUSTER_PARAMETERS = {
+    "work_mem": (
+        "WorkMem",
+        "Database Work Memory",
+        "Required: Memory in kB for each sort or hash in a query, or a formula over DBInstanceClassMemory (bytes). The default scales with the instance class."
+    ),
+    "random_page_cost": (
+        "RandomPageCost",
+        "Database Random Page Cost",
+        "Required: Planner cost of a random page read relative to a sequential one (1.0 = equal). Aurora serves timeline index scans from memory or shared storage, so the default is low."
+    ),
+    "autovacuum_vacuum_scale_factor": (
+        "AutovacuumVacuumScaleFactor",
+        "Autovacuum Vacuum Scale Factor",
+        "Required: Fraction of a table's rows that must be updated or deleted before autovacuum vacuums it."
+    ),
+    "autovacuum_analyze_scale_factor": (
+        "AutovacuumAnalyzeScaleFactor",
+        "Autovacuum Analyze Scale Factor",
+        "Required: Fraction of a table's rows that must change before autovacuum analyzes it."
+    )
+}
+
+class AuroraParameterGroups(Construct):
+    """Mastodon-tuned cluster and instance parameter groups for the common AuroraPostgresql construct.
+
+    The values operators are most likely to tune are template parameters,
+    defaulting to the tuned values. Any other parameter can be overridden
+    with custom_cluster_parameters and custom_instance_parameters, which are
+    merged over the defaults.
+    """
+
+    def __init__(
+            self,
+            scope: Construct,
+            id: str,
+            *,
+            db,
+            custom_cluster_parameters: Optional[Dict[str, str]] = None,
+            custom_instance_parameters: Optional[Dict[str, str]] = None,
+            family: str = "aurora-postgresql15",
+            **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        self.tunable_params = {}
+        for name, (param_id, _, description) in TUNABLE_CLUSTER_PARAMETERS.items():
+            param = CfnParameter(
+                self,
+                param_id,
+                default=DEFAULT_CLUSTER_PARAMETERS[name],
+                description=description
+            )
+            param.override_logical_id(f"{id}{param_id}")
+            self.tunable_params[name] = param
+        cluster_parameters = {
+            **DEFAULT_CLUSTER_PARAMETERS,
+            **{name: param.value_as_string for name, param in self.tunable_params.items()},
+            **(custom_cluster_parameters or {})
+        }
+        instance_parameters = {**DEFAULT_INSTANCE_PARAMETERS, **(custom_instance_parameters or {})}
+
+        self.cluster_parameter_group = aws_rds.CfnDBClusterParameterGroup(
+            self,
+            "Cluster",
+            description="Mastodon tuned Aurora PostgreSQL cluster parameters",
+            family=family,
+            parameters=cluster_parameters
+        )
+        self.cluster_parameter_group.override_logical_id(f"{id}Cluster")
+
+        self.instance_parameter_group = aws_rds.CfnDBParameterGroup(
+            self,
+            "Instance",
+            description="Mastodon tuned Aurora PostgreSQL instance parameters",
+            family=family,
+            parameters=instance_parameters
+        )
+        self.instance_parameter_group.override_logical_id(f"{id}Instance")
+
+        db.db_cluster.add_property_override(
+            "DBClusterParameterGroupName",
+            self.cluster_parameter_group.ref
+        )
+        # ship auto_explain and slow query output to CloudWatch Logs
+        db.db_cluster.add_property_override("EnableCloudwatchLogsExports", ["postgresql"])
+        for instance in db.node.find_all():
+            if isinstance(instance, aws_rds.CfnDBInstance):
+                instance.add_property_override(
+                    "DBParameterGroupName",
+                    self.instance_parameter_group.ref
+                )
+
+    def metadata_parameter_group(self):
+        return [
+            {
+                "Label": {
+                    "default": "Database Tuning"
+                },
+                "Parameters": [param.logical_id for param in self.tunable_params.values()]
+            }
+        ]
+
+    def metadata_parameter_labels(self):
+        return {
+            self.tunable_params[name].logical_id: {
+                "default": label
+            }
+            for name, (_, label, _) in TUNABLE_CLUSTER_PARAMETERS.items()
+        }
@@ -0,0 +1,226 @@
+from pathlib import Path
+
+from aws_cdk import (
+    Aws,
+    aws_cloudwatch,
+    aws_ec2,
+    aws_events,
+    aws_iam,
+    aws_lambda,
+    aws_logs,
+    CfnCondition,
+    CfnParameter,
+    Fn
+)
+from constructs import Construct
+
+# the checks run by the integration tests, inlined as the function code
+CANARY_CHECKS_FILE = Path(__file__).resolve().parents[2] / "test" / "integration" / "canary_checks.py"
+LOCATIONS = {"Vpc": "vpc", "Internet": "internet"}
+
+class Canary(Construct):
+    """Optional scheduled canary running the integration health checks every minute.
+
+    One Lambda function runs in the app subnets, so it reaches the site the
+    way the instances do, and one runs outside the VPC, as a visitor would.
+    Both run test/integration/canary_checks.py, inlined at synth time so the
+    template stays self-contained, and publish Mastodon/CanarySuccess and
+    Mastodon/CanaryLatency per check and location.
+    """
+
+    def __init__(
+            self,
+            scope: Construct,
+            id: str,
+            *,
+            alarm_topic_arn: str,
+            asg,
+            base_url: str,
+            **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        self.enabled_param = CfnParameter(
+            self,
+            "Enabled",
+            allowed_values=["true", "false"],
+            default="false",
+            description="Required: Check the health endpoint, instance API and home page response time every minute from inside the VPC and from the internet."
+        )
+        self.enabled_param.override_logical_id(f"{id}Enabled")
+        self.max_response_time_param = CfnParameter(
+            self,
+            "MaxResponseTime",
+            default=5,
+            description="Required: Seconds the home page may take to respond before the canary response time check fails.",
+            min_value=1,
+            type="Number"
+        )
+        self.max_response_time_param.override_logical_id(f"{id}MaxResponseTime")
+
+        self.enabled_condition = CfnCondition(
+            self,
+            "EnabledCondition",
+            expression=Fn.condition_equals(self.enabled_param.value, "true")
+        )
+        self.enabled_condition.override_logical_id(f"{id}EnabledCondition")
+
+        self.role = aws_iam.CfnRole(
+            self,
+            "Role",
+            assume_role_policy_document=aws_iam.PolicyDocument(
+                statements=[
+                    aws_iam.PolicyStatement(
+                        effect=aws_iam.Effect.ALLOW,
+                        actions=["sts:AssumeRole"],
+                        principals=[aws_iam.ServicePrincipal("lambda.amazonaws.com")]
+                    )
+                ]
+            ),
+            managed_policy_arns=[
+                f"arn:{Aws.PARTITION}:iam::aws:policy/service-role/AWSLambdaVPCAccessExecutionRole"
+            ],
+            policies=[
+                aws_iam.CfnRole.PolicyProperty(
+                    policy_document=aws_iam.PolicyDocument(
+                        statements=[
+                            aws_iam.PolicyStatement(
+                                effect=aws_iam.Effect.ALLOW,
+                                actions=["cloudwatch:PutMetricData"],
+                                resources=["*"],
+                                conditions={"StringEquals": {"cloudwatch:namespace": "Mastodon"}}
+                            )
+                        ]
+                    ),
+                    policy_name="AllowPutCanaryMetrics"
+                )
+            ]
+        )
+        self.role.cfn_options.condition = self.enabled_condition
+        self.role.override_logical_id(f"{id}Role")
+
+        self.sg = aws_ec2.CfnSecurityGroup(
+            self,
+            "Sg",
+            group_description="Canary function in the VPC, outbound only",
+            vpc_id=asg.sg.attr_vpc_id
+        )
+        self.sg.cfn_options.condition = self.enabled_condition
+        self.sg.override_logical_id(f"{id}Sg")
+
+        source = CANARY_CHECKS_FILE.read_text()
+        self.functions = {}
+        log_groups = []
+        for name, location in LOCATIONS.items():
+            function = aws_lambda.CfnFunction(
+                self,
+                f"{name}Function",
+                code=aws_lambda.CfnFunction.CodeProperty(zip_file=source),
+                description=f"Mastodon synthetic checks from {'inside the VPC' if name == 'Vpc' else 'the internet'}",
+                environment=aws_lambda.CfnFunction.EnvironmentProperty(
+                    variables={
+                        "BASE_URL": base_url,
+                        "LOCATION": location,
+                        "MAX_RESPONSE_TIME": self.max_response_time_param.value_as_string,
+                        "STACK_NAME": Aws.STACK_NAME
+                    }
+                ),
+                handler="index.handler",
+                memory_size=128,
+                role=self.role.attr_arn,
+                runtime="python3.12",
+                timeout=50,
+                vpc_config=aws_lambda.CfnFunction.VpcConfigProperty(
+                    security_group_ids=[self.sg.attr_group_id],
+                    subnet_ids=asg.asg.vpc_zone_identifier
+                ) if name == "Vpc" else None
+            )
+            function.cfn_options.condition = self.enabled_condition
+            function.override_logical_id(f"{id}{name}Function")
+            self.functions[name] = function
+
+            log_group = aws_logs.CfnLogGroup(
+                self,
+                f"{name}LogGroup",
+                log_group_name=f"/aws/lambda/{function.ref}",
+                retention_in_days=14
+            )
+            log_group.cfn_options.condition = self.enabled_condition
+            log_group.override_logical_id(f"{id}{name}LogGroup")
+            log_groups.append(log_group)
+
+        self.schedule = aws_events.CfnRule(
+            self,
+            "Schedule",
+            description="Run the Mastodon canary checks",
+            schedule_expression="rate(1 minute)",
+            targets=[
+                aws_events.CfnRule.TargetProperty(arn=function.attr_arn, id=name)
+                for name, function in self.functions.items()
+            ]
+        )
+        self.schedule.cfn_options.condition = self.enabled_condition
+        self.schedule.override_logical_id(f"{id}Schedule")
+        # otherwise the first invocation can create the log groups without retention
+        for log_group in log_groups:
+            self.schedule.add_dependency(log_group)
+
+        for name, function in self.functions.items():
+            permission = aws_lambda.CfnPermission(
+                self,
+                f"{name}Permission",
+                action="lambda:InvokeFunction",
+                function_name=function.attr_arn,
+                principal="events.amazonaws.com",
+                source_arn=self.schedule.attr_arn
+            )
+            permission.cfn_options.condition = self.enabled_condition
+            permission.override_logical_id(f"{id}{name}Permission")
+
+        # the site is down for visitors: the internet health check failed 3 minutes running
+        self.alarm = aws_cloudwatch.CfnAlarm(
+            self,
+            "HealthAlarm",
+            alarm_actions=[alarm_topic_arn],
+            alarm_description=f"{Aws.STACK_NAME}: Canary health check from the internet is failing",
+            comparison_operator="LessThanThreshold",
+            datapoints_to_alarm=3,
+            dimensions=[
+                aws_cloudwatch.CfnAlarm.DimensionProperty(name="Check", value="health"),
+                aws_cloudwatch.CfnAlarm.DimensionProperty(name="Location", value="internet"),
+                aws_cloudwatch.CfnAlarm.DimensionProperty(name="StackName", value=Aws.STACK_NAME)
+            ],
+            evaluation_periods=3,
+            metric_name="CanarySuccess",
+            namespace="Mastodon",
+            ok_actions=[alarm_topic_arn],
+            period=60,
+            statistic="Average",
+            threshold=1,
+            treat_missing_data="breaching"
+        )
+        self.alarm.cfn_options.condition = self.enabled_condition
+        self.alarm.override_logical_id(f"{id}HealthAlarm")
+
+    def metadata_parameter_group(self):
+        return [
+            {
+                "Label": {
+                    "default": "Canary"
+                },
+                "Parameters": [
+                    self.enabled_param.logical_id,
+                    self.max_response_time_param.logical_id
+                ]
+            }
+        ]
+
+    def metadata_parameter_labels(self):
+        return {
+            self.enabled_param.logical_id: {
+                "default": "Enable Canary"
+            },
+            self.max_response_time_param.logical_id: {
+                "default": "Canary Maximum Response Time (seconds)"
+            }
+        }
@@ -0,0 +1,424 @@
+from aws_cdk import (
+    Aws,
+    aws_cloudwatch,
+    aws_sns,
+    CfnCondition,
+    CfnOutput,
+    CfnParameter,
+    Fn,
+    Stack
+)
+from constructs import Construct
+
+# namespace used by /usr/local/bin/mastodon-sidekiq-metrics on the instances
+MASTODON_METRICS_NAMESPACE = "Mastodon"
+
+class Dashboard(Construct):
+
+    def __init__(
+            self,
+            scope: Construct,
+            id: str,
+            *,
+            alb_full_name: str,
+            asg_name: str,
+            db_cluster_identifier: str,
+            open_search_domain_name: str,
+            redis_cluster_id: str,
+            alb_5xx_threshold: int = 25,
+            alb_p99_latency_threshold: float = 2.0,
+            db_commit_latency_threshold: float = 50.0,
+            db_connections_threshold: int = 500,
+            db_cpu_threshold: int = 80,
+            open_search_latency_threshold: float = 1000.0,
+            redis_memory_threshold: int = 80,
+            sidekiq_alarm_queues: tuple = ("default", "ingress", "push"),
+            sidekiq_latency_threshold: int = 300,
+            **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        self.id = id
+        self.alb_full_name = alb_full_name
+        self.asg_name = asg_name
+        self.db_cluster_identifier = db_cluster_identifier
+        self.open_search_domain_name = open_search_domain_name
+        self.redis_cluster_id = redis_cluster_id
+
+        self.alarm_email_param = CfnParameter(
+            self,
+            "AlarmEmail",
+            default="",
+            description="Optional: Email address to notify when an operational alarm changes state. Leave blank to only create the SNS topic."
+        )
+        self.alarm_email_param.override_logical_id(f"{id}AlarmEmail")
+        self.alarm_email_exists_condition = CfnCondition(
+            self,
+            "AlarmEmailExists",
+            expression=Fn.condition_not(Fn.condition_equals(self.alarm_email_param.value, ""))
+        )
+        self.alarm_email_exists_condition.override_logical_id(f"{id}AlarmEmailExists")
+
+        self.alarm_topic = aws_sns.CfnTopic(
+            self,
+            "AlarmTopic"
+        )
+        self.alarm_topic.override_logical_id(f"{id}AlarmTopic")
+        alarm_subscription = aws_sns.CfnSubscription(
+            self,
+            "AlarmSubscription",
+            endpoint=self.alarm_email_param.value_as_string,
+            protocol="email",
+            topic_arn=self.alarm_topic.ref
+        )
+        alarm_subscription.cfn_options.condition = self.alarm_email_exists_condition
+        alarm_subscription.override_logical_id(f"{id}AlarmSubscription")
+
+        self.alarms = []
+
+        # alb
+        self._alarm(
+            "Alb5xxAlarm",
+            description=f"ALB targets returned more than {alb_5xx_threshold} 5xx responses per minute",
+            namespace="AWS/ApplicationELB",
+            metric_name="HTTPCode_Target_5XX_Count",
+            dimensions={"LoadBalancer": alb_full_name},
+            statistic="Sum",
+            threshold=alb_5xx_threshold
+        )
+        self._alarm(
+            "AlbLatencyAlarm",
+            description=f"ALB p99 target response time above {alb_p99_latency_threshold}s",
+            namespace="AWS/ApplicationELB",
+            metric_name="TargetResponseTime",
+            dimensions={"LoadBalancer": alb_full_name},
+            extended_statistic="p99",
+            threshold=alb_p99_latency_threshold
+        )
+
+        # aurora
+        self._alarm(
+            "DbCpuAlarm",
+            description=f"Aurora CPU above {db_cpu_threshold}%",
+            namespace="AWS/RDS",
+            metric_name="CPUUtilization",
+            dimensions={"DBClusterIdentifier": db_cluster_identifier},
+            threshold=db_cpu_threshold
+        )
+        self._alarm(
+            "DbConnectionsAlarm",
+            description=f"Aurora connections above {db_connections_threshold}",
+            namespace="AWS/RDS",
+            metric_name="DatabaseConnections",
+            dimensions={"DBClusterIdentifier": db_cluster_identifier},
+            statistic="Maximum",
+            threshold=db_connections_threshold
+        )
+        self._alarm(
+            "DbCommitLatencyAlarm",
+            description=f"Aurora commit latency above {db_commit_latency_threshold}ms",
+            namespace="AWS/RDS",
+            metric_name="CommitLatency",
+            dimensions={"DBClusterIdentifier": db_cluster_identifier},
+            threshold=db_commit_latency_threshold
+        )
+
+        # redis runs with maxmemory-policy noeviction, so running out of memory means write errors
+        self._alarm(
+            "RedisMemoryAlarm",
+            description=f"Redis memory usage above {redis_memory_threshold}% of maxmemory",
+            namespace="AWS/ElastiCache",
+            metric_name="DatabaseMemoryUsagePercentage",
+            dimensions={"CacheClusterId": redis_cluster_id},
+            statistic="Maximum",
+            threshold=redis_memory_threshold
+        )
+
+        # open search
+        self._alarm(
+            "OpenSearchLatencyAlarm",
+            description=f"OpenSearch search latency above {open_search_latency_threshold}ms",
+            namespace="AWS/ES",
+            metric_name="SearchLatency",
+            dimensions={"ClientId": Aws.ACCOUNT_ID, "DomainName": open_search_domain_name},
+            threshold=open_search_latency_threshold
+        )
+
+        # asg
+        self._alarm(
+            "AsgInServiceAlarm",
+            description="No instances in service in the Auto Scaling Group",
+            namespace="AWS/AutoScaling",
+            metric_name="GroupInServiceInstances",
+            dimensions={"AutoScalingGroupName": asg_name},
+            statistic="Minimum",
+            comparison_operator="LessThanThreshold",
+            threshold=1,
+            treat_missing_data="breaching"
+        )
+
+        # sidekiq - published by the instances, so missing data is not an incident by itself
+        for queue in sidekiq_alarm_queues:
+            self._alarm(
+                f"Sidekiq{queue.capitalize()}LatencyAlarm",
+                description=f"Sidekiq {queue} queue latency above {sidekiq_latency_threshold}s",
+                namespace=MASTODON_METRICS_NAMESPACE,
+                metric_name="SidekiqQueueLatency",
+                dimensions={"Queue": queue, "StackName": Aws.STACK_NAME},
+                statistic="Maximum",
+                threshold=sidekiq_latency_threshold
+            )
+
+        self.dashboard = aws_cloudwatch.CfnDashboard(
+            self,
+            "Dashboard",
+            dashboard_body=Stack.of(self).to_json_string(self._dashboard_body())
+        )
+        self.dashboard.override_logical_id(f"{id}")
+
+        self.dashboard_url_output = CfnOutput(
+            self,
+            "UrlOutput",
+            description="CloudWatch dashboard for Mastodon operations",
+            value=f"https://{Aws.REGION}.console.aws.amazon.com/cloudwatch/home?region={Aws.REGION}#dashboards:name={self.dashboard.ref}"
+        )
+        self.dashboard_url_output.override_logical_id(f"{id}UrlOutput")
+
+        self.alarm_topic_output = CfnOutput(
+            self,
+            "AlarmTopicArnOutput",
+            description="SNS topic notified by the Mastodon operational alarms",
+            value=self.alarm_topic.ref
+        )
+        self.alarm_topic_output.override_logical_id(f"{id}AlarmTopicArnOutput")
+
+    def metadata_parameter_group(self):
+        return [
+            {
+                "Label": {
+                    "default": "Monitoring"
+                },
+                "Parameters": [
+                    self.alarm_email_param.logical_id
+                ]
+            }
+        ]
+
+    def metadata_parameter_labels(self):
+        return {
+            self.alarm_email_param.logical_id: {
+                "default": "Alarm Notification Email"
+            }
+        }
+
+    def _alarm(
+            self,
+            name: str,
+            *,
+            description: str,
+            namespace: str,
+            metric_name: str,
+            dimensions: dict,
+            threshold: float,
+            comparison_operator: str = "GreaterThanThreshold",
+            datapoints_to_alarm: int = 3,
+            evaluation_periods: int = 5,
+            extended_statistic: str = None,
+            statistic: str = None,
+            treat_missing_data: str = "notBreaching"
+    ) -> aws_cloudwatch.CfnAlarm:
+        if not extended_statistic and not statistic:
+            statistic = "Average"
+        alarm = aws_cloudwatch.CfnAlarm(
+            self,
+            name,
+            alarm_actions=[self.alarm_topic.ref],
+            alarm_description=f"{Aws.STACK_NAME}: {description}",
+            comparison_operator=comparison_operator,
+            datapoints_to_alarm=datapoints_to_alarm,
+            dimensions=[
+                aws_cloudwatch.CfnAlarm.DimensionProperty(name=k, value=v)
+                for k, v in dimensions.items()
+            ],
+            evaluation_periods=evaluation_periods,
+            extended_statistic=extended_statistic,
+            metric_name=metric_name,
+            namespace=namespace,
+            ok_actions=[self.alarm_topic.ref],
+            period=60,
+            statistic=statistic,
+            threshold=threshold,
+            treat_missing_data=treat_missing_data
+        )
+        alarm.override_logical_id(f"{self.id}{name}")
+        self.alarms.append(alarm)
+        return alarm
+
+    def _widget(self, title: str, metrics: list, x: int, y: int, width: int = 8, height: int = 6, **properties) -> dict:
+        return {
+            "type": "metric",
+            "x": x,
+            "y": y,
+            "width": width,
+            "height": height,
+            "properties": {
+                "title": title,
+                "region": Aws.REGION,
+                "view": "timeSeries",
+                "stacked": False,
+                "period": 60,
+                "metrics": metrics,
+                **properties
+            }
+        }
+
+    def _dashboard_body(self) -> dict:
+        alb = ["AWS/ApplicationELB"]
+        rds = ["AWS/RDS"]
+        redis = ["AWS/ElastiCache"]
+        lb = ["LoadBalancer", self.alb_full_name]
+        cluster = ["DBClusterIdentifier", self.db_cluster_identifier]
+        cache = ["CacheClusterId", self.redis_cluster_id]
+        proxy = [MASTODON_METRICS_NAMESPACE]
+        stack = ["StackName", Aws.STACK_NAME]
+        sidekiq_search = (
+            f"SEARCH('{{{MASTODON_METRICS_NAMESPACE},Queue,StackName}} "
+            f"StackName=\"{Aws.STACK_NAME}\" MetricName=\"SidekiqQueueLatency\"', 'Maximum', 60)"
+        )
+        recycle_search = (
+            f"SEARCH('{{{MASTODON_METRICS_NAMESPACE},Service,StackName}} "
+            f"StackName=\"{Aws.STACK_NAME}\" MetricName=\"WorkerRecycled\"', 'Sum', 300)"
+        )
+        redis_guard_search = (
+            f"SEARCH('{{{MASTODON_METRICS_NAMESPACE},Action,StackName}} "
+            f"StackName=\"{Aws.STACK_NAME}\" MetricName=\"RedisGuardAction\"', 'Sum', 300)"
+        )
+        # published by the CloudWatch agent on the app instances, configured in the AMI (/etc/mastodon/amazon-cloudwatch-agent.json)
+        dns_hit_search = (
+            f"SEARCH('Namespace=\"CWAgent\" MetricName=\"DnsCacheHitPercent\" "
+            f"AutoScalingGroupName=\"{self.asg_name}\"', 'Average', 60)"
+        )
+        dns_drop_search = (
+            f"SEARCH('Namespace=\"CWAgent\" MetricName=\"ethtool_linklocal_allowance_exceeded\" "
+            f"AutoScalingGroupName=\"{self.asg_name}\"', 'Maximum', 60)"
+        )
+        canary_search = (
+            f"SEARCH('{{{MASTODON_METRICS_NAMESPACE},Check,Location,StackName}} "
+            f"StackName=\"{Aws.STACK_NAME}\" MetricName=\"CanaryLatency\"', 'Average', 60)"
+        )
+        return {
+            "widgets": [
+                self._widget(
+                    "ALB target response time (s)",
+                    [
+                        alb + ["TargetResponseTime"] + lb + [{"stat": "p50", "label": "p50"}],
+                        alb + ["TargetResponseTime"] + lb + [{"stat": "p99", "label": "p99"}]
+                    ],
+                    x=0, y=0
+                ),
+                self._widget(
+                    "ALB 5xx and requests",
+                    [
+                        alb + ["HTTPCode_Target_5XX_Count"] + lb + [{"stat": "Sum"}],
+                        alb + ["HTTPCode_ELB_5XX_Count"] + lb + [{"stat": "Sum"}],
+                        alb + ["RequestCount"] + lb + [{"stat": "Sum", "yAxis": "right"}]
+                    ],
+                    x=8, y=0
+                ),
+                self._widget(
+                    "ASG instances",
+                    [
+                        ["AWS/AutoScaling", "GroupInServiceInstances", "AutoScalingGroupName", self.asg_name],
+                        ["AWS/AutoScaling", "GroupDesiredCapacity", "AutoScalingGroupName", self.asg_name]
+                    ],
+                    x=16, y=0
+                ),
+                self._widget(
+                    "Aurora CPU and ACU utilization (%) and connections",
+                    [
+                        rds + ["CPUUtilization"] + cluster,
+                        rds + ["ACUUtilization"] + cluster,
+                        rds + ["DatabaseConnections"] + cluster + [{"stat": "Maximum", "yAxis": "right"}]
+                    ],
+                    x=0, y=6
+                ),
+                self._widget(
+                    "Aurora commit latency (ms)",
+                    [
+                        rds + ["CommitLatency"] + cluster,
+                        rds + ["CommitThroughput"] + cluster + [{"yAxis": "right"}]
+                    ],
+                    x=8, y=6
+                ),
+                self._widget(
+                    "OpenSearch search latency (ms)",
+                    [
+                        ["AWS/ES", "SearchLatency", "ClientId", Aws.ACCOUNT_ID, "DomainName", self.open_search_domain_name]
+                    ],
+                    x=16, y=6
+                ),
+                self._widget(
+                    "Redis memory (% of maxmemory), evictions and guard actions",
+                    [
+                        redis + ["DatabaseMemoryUsagePercentage"] + cache + [{"stat": "Maximum"}],
+                        redis + ["Evictions"] + cache + [{"stat": "Sum", "yAxis": "right"}],
+                        [{"expression": redis_guard_search, "id": "e4", "yAxis": "right"}]
+                    ],
+                    x=0, y=12
+                ),
+                self._widget(
+                    "Sidekiq queue latency (s)",
+                    [
+                        [{"expression": sidekiq_search, "id": "e1"}]
+                    ],
+                    x=8, y=12
+                ),
+                self._widget(
+                    "Worker recycles (memory)",
+                    [
+                        [{"expression": recycle_search, "id": "e2"}]
+                    ],
+                    x=16, y=12
+                ),
+                self._widget(
+                    "Canary check latency (ms), when the canary is enabled",
+                    [
+                        [{"expression": canary_search, "id": "e3"}]
+                    ],
+                    x=0, y=18, width=12
+                ),
+                self._widget(
+                    "Egress proxy hit rate (%), when the proxy is enabled",
+                    [
+                        proxy + ["EgressProxyHits"] + stack + [{"stat": "Sum", "id": "p1", "visible": False}],
+                        proxy + ["EgressProxyMisses"] + stack + [{"stat": "Sum", "id": "p2", "visible": False}],
+                        proxy + ["EgressProxyHitBytes"] + stack + [{"stat": "Sum", "id": "p3", "visible": False}],
+                        proxy + ["EgressProxyBytes"] + stack + [{"stat": "Sum", "id": "p4", "visible": False}],
+                        [{"expression": "100 * p1 / (p1 + p2)", "id": "e5", "label": "Requests"}],
+                        [{"expression": "100 * p3 / p4", "id": "e6", "label": "Bytes"}]
+                    ],
+                    x=12, y=18, width=12, period=300
+                ),
+                self._widget(
+                    "DNS cache hit rate (%) and packets dropped by the VPC resolver limit",
+                    [
+                        [{"expression": dns_hit_search, "id": "e7"}],
+                        [{"expression": dns_drop_search, "id": "e8", "visible": False}],
+                        # the ethtool counter is cumulative per instance
+                        [{"expression": "DIFF(e8)", "id": "e9", "label": "Dropped packets", "yAxis": "right"}]
+                    ],
+                    x=0, y=24, width=24
+                ),
+                {
+                    "type": "alarm",
+                    "x": 0,
+                    "y": 30,
+                    "width": 24,
+                    "height": 4,
+                    "properties": {
+                        "title": "Alarms",
+                        "alarms": [alarm.attr_arn for alarm in self.alarms]
+                    }
+                }
+            ]
+        }
@@ -0,0 +1,470 @@
+import json
+
+from aws_cdk import (
+    Aws,
+    aws_ec2,
+    aws_ecs,
+    aws_elasticloadbalancingv2,
+    aws_iam,
+    aws_logs,
+    aws_ssm,
+    CfnCondition,
+    CfnParameter,
+    Fn,
+    Stack
+)
+from constructs import Construct
+
+from mastodon.dashboard import MASTODON_METRICS_NAMESPACE
+
+PROXY_PORT = 3128
+# read by mastodon-egress-proxy-setup at boot: the proxy URL, or "disabled"
+URL_PARAMETER_NAME = "egress-proxy/url"
+# remote hosts Mastodon reaches without the proxy: instance metadata, AWS services and VPC hosts such as OpenSearch;
+# also set on the instances by mastodon-egress-proxy-setup in the AMI
+NO_PROXY = "localhost,127.0.0.1,169.254.169.254,169.254.170.2,.amazonaws.com,.internal"
+# fields of each access log line, from the logformat in packer/egress-proxy-entrypoint.sh
+ACCESS_LOG_FIELDS = "stack, time, result, status, bytes, method, domain"
+# metric name: (result pattern, metric value)
+ACCESS_LOG_METRICS = {
+    "EgressProxyHits": ("*HIT*", "1"),
+    "EgressProxyMisses": ("*MISS*", "1"),
+    "EgressProxyHitBytes": ("*HIT*", "$bytes"),
+    "EgressProxyBytes": ("TCP_*", "$bytes")
+}
+
+class EgressProxy(Construct):
+    """Optional shared caching proxy for Mastodon's outbound HTTP.
+
+    Squid runs as an ECS Fargate service behind an internal Network Load
+    Balancer, reachable only from the app security group. Remote actors, key
+    documents, link previews and media fetched by any instance or Sidekiq task
+    are cached once for the fleet, following the origin's caching headers,
+    with a cap on object size and on how long media without explicit
+    freshness is kept. HTTPS is decrypted with a CA the operator provides in
+    Secrets Manager, which the instances trust. Private, link-local and
+    loopback destinations are refused by the proxy, since Mastodon skips its
+    own check for them when it connects through a proxy, and only clients in
+    the VPC's CIDR are served.
+
+    Cache hits, misses and bytes are counted from the access log by metric
+    filters into the Mastodon namespace.
+    """
+
+    def __init__(
+            self,
+            scope: Construct,
+            id: str,
+            *,
+            asg,
+            vpc,
+            **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        self.enabled_param = CfnParameter(
+            self,
+            "Enabled",
+            allowed_values=["true", "false"],
+            default="false",
+            description="Required: Send Mastodon's outbound HTTP, such as federation fetches, link previews and remote media, through a shared caching proxy on ECS Fargate."
+        )
+        self.enabled_param.override_logical_id(f"{id}Enabled")
+        self.image_param = CfnParameter(
+            self,
+            "Image",
+            default="",
+            description="Optional: URI of the proxy container image built with 'make egress-proxy-image'. Required when the proxy is enabled."
+        )
+        self.image_param.override_logical_id(f"{id}Image")
+        self.ca_secret_arn_param = CfnParameter(
+            self,
+            "CaSecretArn",
+            default="",
+            description="Optional: ARN of a Secrets Manager secret with 'certificate' and 'private_key' keys holding the PEM CA the proxy signs HTTPS certificates with. Required when the proxy is enabled."
+        )
+        self.ca_secret_arn_param.override_logical_id(f"{id}CaSecretArn")
+        self.tasks_param = CfnParameter(
+            self,
+            "Tasks",
+            default=1,
+            description="Required: Number of proxy tasks. Each task has its own cache.",
+            min_value=1,
+            max_value=4,
+            type="Number"
+        )
+        self.tasks_param.override_logical_id(f"{id}Tasks")
+        self.max_object_size_param = CfnParameter(
+            self,
+            "MaxObjectSize",
+            default=64,
+            description="Required: Largest response, in MB, the proxy caches.",
+            min_value=1,
+            max_value=1024,
+            type="Number"
+        )
+        self.max_object_size_param.override_logical_id(f"{id}MaxObjectSize")
+        self.media_ttl_param = CfnParameter(
+            self,
+            "MediaTtl",
+            default=1440,
+            description="Required: Longest time, in minutes, the proxy keeps media that has no explicit freshness from the origin.",
+            min_value=1,
+            type="Number"
+        )
+        self.media_ttl_param.override_logical_id(f"{id}MediaTtl")
+        self.vpc_cidr_param = CfnParameter(
+            self,
+            "VpcCidr",
+            default="",
+            description="Optional: CIDR block of the existing VPC the stack is deployed into, whose hosts may use the proxy. Required when the proxy is enabled with an existing VPC; when this stack creates the VPC its CIDR is used."
+        )
+        self.vpc_cidr_param.override_logical_id(f"{id}VpcCidr")
+
+        self.enabled_condition = CfnCondition(
+            self,
+            "EnabledCondition",
+            expression=Fn.condition_equals(self.enabled_param.value, "true")
+        )
+        self.enabled_condition.override_logical_id(f"{id}EnabledCondition")
+
+        vpc_id = asg.sg.attr_vpc_id
+        subnets = asg.asg.vpc_zone_identifier
+        # the CIDR is only known when the common Vpc construct creates the VPC
+        cfn_vpc = next(c for c in vpc.node.find_all() if isinstance(c, aws_ec2.CfnVPC))
+        vpc_cidr = Fn.condition_if(
+            cfn_vpc.cfn_options.condition.logical_id,
+            cfn_vpc.attr_cidr_block,
+            self.vpc_cidr_param.value_as_string
+        ).to_string()
+
+        self.nlb_sg = aws_ec2.CfnSecurityGroup(
+            self,
+            "NlbSg",
+            group_description="Egress proxy load balancer, from the app instances and tasks",
+            security_group_ingress=[
+                aws_ec2.CfnSecurityGroup.IngressProperty(
+                    from_port=PROXY_PORT,
+                    ip_protocol="tcp",
+                    source_security_group_id=asg.sg.attr_group_id,
+                    to_port=PROXY_PORT
+                )
+            ],
+            vpc_id=vpc_id
+        )
+        self.nlb_sg.cfn_options.condition = self.enabled_condition
+        self.nlb_sg.override_logical_id(f"{id}NlbSg")
+        self.task_sg = aws_ec2.CfnSecurityGroup(
+            self,
+            "TaskSg",
+            group_description="Egress proxy tasks, from the load balancer",
+            security_group_ingress=[
+                aws_ec2.CfnSecurityGroup.IngressProperty(
+                    from_port=PROXY_PORT,
+                    ip_protocol="tcp",
+                    source_security_group_id=self.nlb_sg.attr_group_id,
+                    to_port=PROXY_PORT
+                )
+            ],
+            vpc_id=vpc_id
+        )
+        self.task_sg.cfn_options.condition = self.enabled_condition
+        self.task_sg.override_logical_id(f"{id}TaskSg")
+
+        self.nlb = aws_elasticloadbalancingv2.CfnLoadBalancer(
+            self,
+            "Nlb",
+            scheme="internal",
+            security_groups=[self.nlb_sg.attr_group_id],
+            subnets=subnets,
+            type="network"
+        )
+        self.nlb.cfn_options.condition = self.enabled_condition
+        self.nlb.override_logical_id(f"{id}Nlb")
+        self.target_group = aws_elasticloadbalancingv2.CfnTargetGroup(
+            self,
+            "TargetGroup",
+            health_check_protocol="TCP",
+            port=PROXY_PORT,
+            protocol="TCP",
+            target_group_attributes=[
+                aws_elasticloadbalancingv2.CfnTargetGroup.TargetGroupAttributeProperty(
+                    key="deregistration_delay.timeout_seconds",
+                    value="30"
+                )
+            ],
+            target_type="ip",
+            vpc_id=vpc_id
+        )
+        self.target_group.cfn_options.condition = self.enabled_condition
+        self.target_group.override_logical_id(f"{id}TargetGroup")
+        self.listener = aws_elasticloadbalancingv2.CfnListener(
+            self,
+            "Listener",
+            default_actions=[
+                aws_elasticloadbalancingv2.CfnListener.ActionProperty(
+                    target_group_arn=self.target_group.ref,
+                    type="forward"
+                )
+            ],
+            load_balancer_arn=self.nlb.ref,
+            port=PROXY_PORT,
+            protocol="TCP"
+        )
+        self.listener.cfn_options.condition = self.enabled_condition
+        self.listener.override_logical_id(f"{id}Listener")
+
+        proxy_url = f"http://{self.nlb.attr_dns_name}:{PROXY_PORT}"
+        # for environments that always set http_proxy; Mastodon ignores it when blank
+        self.url = Fn.condition_if(self.enabled_condition.logical_id, proxy_url, "").to_string()
+        # always created, so the app instances can depend on it and find the proxy at boot
+        self.url_parameter = aws_ssm.CfnParameter(
+            self,
+            "UrlParameter",
+            description="Egress proxy URL read by the Mastodon instances at boot",
+            name=f"/{Aws.STACK_NAME}/{URL_PARAMETER_NAME}",
+            type="String",
+            value=Fn.condition_if(self.enabled_condition.logical_id, proxy_url, "disabled").to_string()
+        )
+        self.url_parameter.override_logical_id(f"{id}UrlParameter")
+
+        # the instances read the proxy URL and the CA certificate at boot; the policy always exists,
+        # so it can be in place before they launch, with a placeholder secret when the proxy is disabled
+        self.ca_secret_arn = Fn.condition_if(
+            self.enabled_condition.logical_id,
+            self.ca_secret_arn_param.value_as_string,
+            f"arn:{Aws.PARTITION}:secretsmanager:{Aws.REGION}:{Aws.ACCOUNT_ID}:secret:{Aws.STACK_NAME}/egress-proxy-disabled"
+        ).to_string()
+        self.instance_policy = aws_iam.CfnPolicy(
+            self,
+            "InstancePolicy",
+            policy_document=aws_iam.PolicyDocument(
+                statements=[
+                    aws_iam.PolicyStatement(
+                        effect=aws_iam.Effect.ALLOW,
+                        actions=["ssm:GetParameter"],
+                        resources=[
+                            f"arn:{Aws.PARTITION}:ssm:{Aws.REGION}:{Aws.ACCOUNT_ID}:parameter/{Aws.STACK_NAME}/{URL_PARAMETER_NAME}"
+                        ]
+                    ),
+                    aws_iam.PolicyStatement(
+                        effect=aws_iam.Effect.ALLOW,
+                        actions=["secretsmanager:GetSecretValue"],
+                        resources=[self.ca_secret_arn]
+                    )
+                ]
+            ),
+            policy_name="AllowReadEgressProxyConfig",
+            roles=[
+                role.ref for role in asg.node.find_all()
+                if isinstance(role, aws_iam.CfnRole)
+                and "ec2.amazonaws.com" in json.dumps(Stack.of(self).resolve(role.assume_role_policy_document))
+            ]
+        )
+        self.instance_policy.override_logical_id(f"{id}InstancePolicy")
+
+        self.log_group = aws_logs.CfnLogGroup(
+            self,
+            "LogGroup",
+            retention_in_days=14
+        )
+        self.log_group.cfn_options.condition = self.enabled_condition
+        self.log_group.override_logical_id(f"{id}LogGroup")
+
+        for metric_name, (result, value) in ACCESS_LOG_METRICS.items():
+            name = metric_name.removeprefix("EgressProxy")
+            metric_filter = aws_logs.CfnMetricFilter(
+                self,
+                f"{name}Filter",
+                filter_pattern=f"[{ACCESS_LOG_FIELDS.replace('result', f'result={result}')}]",
+                log_group_name=self.log_group.ref,
+                metric_transformations=[
+                    aws_logs.CfnMetricFilter.MetricTransformationProperty(
+                        dimensions=[aws_logs.CfnMetricFilter.DimensionProperty(key="StackName", value="$stack")],
+                        metric_name=metric_name,
+                        metric_namespace=MASTODON_METRICS_NAMESPACE,
+                        metric_value=value,
+                        unit="Bytes" if value == "$bytes" else "Count"
+                    )
+                ]
+            )
+            metric_filter.cfn_options.condition = self.enabled_condition
+            metric_filter.override_logical_id(f"{id}{name}Filter")
+
+        self.execution_role = aws_iam.CfnRole(
+            self,
+            "ExecutionRole",
+            assume_role_policy_document=aws_iam.PolicyDocument(
+                statements=[
+                    aws_iam.PolicyStatement(
+                        effect=aws_iam.Effect.ALLOW,
+                        actions=["sts:AssumeRole"],
+                        principals=[aws_iam.ServicePrincipal("ecs-tasks.amazonaws.com")]
+                    )
+                ]
+            ),
+            managed_policy_arns=[
+                f"arn:{Aws.PARTITION}:iam::aws:policy/service-role/AmazonECSTaskExecutionRolePolicy"
+            ],
+            policies=[
+                aws_iam.CfnRole.PolicyProperty(
+                    policy_document=aws_iam.PolicyDocument(
+                        statements=[
+                            aws_iam.PolicyStatement(
+                                effect=aws_iam.Effect.ALLOW,
+                                actions=["secretsmanager:GetSecretValue"],
+                                resources=[self.ca_secret_arn_param.value_as_string]
+                            )
+                        ]
+                    ),
+                    policy_name="AllowReadCaSecret"
+                )
+            ]
+        )
+        self.execution_role.cfn_options.condition = self.enabled_condition
+        self.execution_role.override_logical_id(f"{id}ExecutionRole")
+
+        self.cluster = aws_ecs.CfnCluster(
+            self,
+            "Cluster",
+            cluster_settings=[
+                aws_ecs.CfnCluster.ClusterSettingsProperty(name="containerInsights", value="enabled")
+            ]
+        )
+        self.cluster.cfn_options.condition = self.enabled_condition
+        self.cluster.override_logical_id(f"{id}Cluster")
+
+        self.task_definition = aws_ecs.CfnTaskDefinition(
+            self,
+            "TaskDefinition",
+            container_definitions=[
+                aws_ecs.CfnTaskDefinition.ContainerDefinitionProperty(
+                    command=["squid"],
+                    environment=[
+                        aws_ecs.CfnTaskDefinition.KeyValuePairProperty(name=name, value=value)
+                        for name, value in {
+                            "MAX_OBJECT_SIZE_MB": self.max_object_size_param.value_as_string,
+                            "MEDIA_TTL_MINUTES": self.media_ttl_param.value_as_string,
+                            "STACK_NAME": Aws.STACK_NAME,
+                            "VPC_CIDR": vpc_cidr
+                        }.items()
+                    ],
+                    essential=True,
+                    image=self.image_param.value_as_string,
+                    log_configuration=aws_ecs.CfnTaskDefinition.LogConfigurationProperty(
+                        log_driver="awslogs",
+                        options={
+                            "awslogs-group": self.log_group.ref,
+                            "awslogs-region": Aws.REGION,
+                            "awslogs-stream-prefix": "squid"
+                        }
+                    ),
+                    name="squid",
+                    port_mappings=[
+                        aws_ecs.CfnTaskDefinition.PortMappingProperty(container_port=PROXY_PORT, protocol="tcp")
+                    ],
+                    secrets=[
+                        aws_ecs.CfnTaskDefinition.SecretProperty(
+                            name="CA_CERTIFICATE",
+                            value_from=f"{self.ca_secret_arn_param.value_as_string}:certificate::"
+                        ),
+                        aws_ecs.CfnTaskDefinition.SecretProperty(
+                            name="CA_PRIVATE_KEY",
+                            value_from=f"{self.ca_secret_arn_param.value_as_string}:private_key::"
+                        )
+                    ],
+                    # squid waits up to shutdown_lifetime for open connections
+                    stop_timeout=30
+                )
+            ],
+            cpu="512",
+            execution_role_arn=self.execution_role.attr_arn,
+            family=f"{Aws.STACK_NAME}-egress-proxy",
+            memory="1024",
+            network_mode="awsvpc",
+            requires_compatibilities=["FARGATE"],
+            runtime_platform=aws_ecs.CfnTaskDefinition.RuntimePlatformProperty(
+                cpu_architecture="X86_64",
+                operating_system_family="LINUX"
+            )
+        )
+        self.task_definition.cfn_options.condition = self.enabled_condition
+        self.task_definition.override_logical_id(f"{id}TaskDefinition")
+
+        self.service = aws_ecs.CfnService(
+            self,
+            "Service",
+            capacity_provider_strategy=[
+                aws_ecs.CfnService.CapacityProviderStrategyItemProperty(capacity_provider="FARGATE", weight=1)
+            ],
+            cluster=self.cluster.ref,
+            deployment_configuration=aws_ecs.CfnService.DeploymentConfigurationProperty(
+                deployment_circuit_breaker=aws_ecs.CfnService.DeploymentCircuitBreakerProperty(enable=True, rollback=True),
+                maximum_percent=200,
+                minimum_healthy_percent=100
+            ),
+            desired_count=self.tasks_param.value_as_number,
+            health_check_grace_period_seconds=60,
+            load_balancers=[
+                aws_ecs.CfnService.LoadBalancerProperty(
+                    container_name="squid",
+                    container_port=PROXY_PORT,
+                    target_group_arn=self.target_group.ref
+                )
+            ],
+            network_configuration=aws_ecs.CfnService.NetworkConfigurationProperty(
+                awsvpc_configuration=aws_ecs.CfnService.AwsVpcConfigurationProperty(
+                    assign_public_ip="DISABLED",
+                    security_groups=[self.task_sg.attr_group_id],
+                    subnets=subnets
+                )
+            ),
+            task_definition=self.task_definition.ref
+        )
+        self.service.cfn_options.condition = self.enabled_condition
+        self.service.override_logical_id(f"{id}Service")
+        # ECS needs the target group attached to the load balancer before the service registers tasks
+        self.service.add_dependency(self.listener)
+
+    def metadata_parameter_group(self):
+        return [
+            {
+                "Label": {
+                    "default": "Egress Caching Proxy"
+                },
+                "Parameters": [
+                    self.enabled_param.logical_id,
+                    self.image_param.logical_id,
+                    self.ca_secret_arn_param.logical_id,
+                    self.tasks_param.logical_id,
+                    self.max_object_size_param.logical_id,
+                    self.media_ttl_param.logical_id,
+                    self.vpc_cidr_param.logical_id
+                ]
+            }
+        ]
+
+    def metadata_parameter_labels(self):
+        return {
+            self.enabled_param.logical_id: {
+                "default": "Enable Egress Proxy"
+            },
+            self.image_param.logical_id: {
+                "default": "Egress Proxy Image URI"
+            },
+            self.ca_secret_arn_param.logical_id: {
+                "default": "Egress Proxy CA Secret ARN"
+            },
+            self.tasks_param.logical_id: {
+                "default": "Egress Proxy Tasks"
+            },
+            self.max_object_size_param.logical_id: {
+                "default": "Egress Proxy Maximum Cached Object Size (MB)"
+            },
+            self.media_ttl_param.logical_id: {
+                "default": "Egress Proxy Media TTL (minutes)"
+            },
+            self.vpc_cidr_param.logical_id: {
+                "default": "Egress Proxy VPC CIDR"
+            }
+        }
@@ -3,10 +3,13 @@ import subprocess
 
 from aws_cdk import (
     Aws,
+    aws_autoscaling,
     aws_iam,
+    aws_rds,
     CfnMapping,
     CfnOutput,
     CfnParameter,
+    Fn,
     Stack
 )
 from constructs import Construct
@@ -23,6 +26,17 @@ from oe_patterns_cdk_common.ses import Ses
 from oe_patterns_cdk_common.util import Util
 from oe_patterns_cdk_common.vpc import Vpc
 
+from mastodon.assets_bucket_lifecycle import AssetsBucketLifecycle
+from mastodon.aurora_capacity import AuroraCapacity
+from mastodon.aurora_parameter_groups import AuroraParameterGroups
+from mastodon.canary import Canary
+from mastodon.dashboard import Dashboard
+from mastodon.egress_proxy import EgressProxy, NO_PROXY
+from mastodon.media_workers import MediaWorkers
+from mastodon.sidekiq_service import SidekiqService
+from mastodon.streaming_drain import StreamingDrain
+from mastodon.vpc_endpoints import VpcEndpoints
+
 if 'TEMPLATE_VERSION' in os.environ:
     template_version = os.environ['TEMPLATE_VERSION']
 else:
@@ -45,6 +59,11 @@ class MastodonStack(Stack):
             self,
             "Vpc"
         )
+        vpc_endpoints = VpcEndpoints(
+            self,
+            "VpcEndpoints",
+            vpc=vpc
+        )
 
         self.name_param = CfnParameter(
             self,
@@ -62,6 +81,11 @@ class MastodonStack(Stack):
             object_ownership_value = "ObjectWriter",
             remove_public_access_block = True
         )
+        bucket_lifecycle = AssetsBucketLifecycle(
+            self,
+            "AssetsBucketLifecycle",
+            bucket=bucket
+        )
 
         ses = Ses(
             self,
@@ -109,6 +133,51 @@ class MastodonStack(Stack):
             ),
             policy_name="AllowUpdateInstanceSecret"
         )
+        # lets mastodon-sidekiq-drain and mastodon-streaming-drain finish the termination lifecycle hooks;
+        # the streaming drain also watches for the instance's deregistration from the target group
+        asg_lifecycle_policy = aws_iam.CfnRole.PolicyProperty(
+            policy_document=aws_iam.PolicyDocument(
+                statements=[
+                    aws_iam.PolicyStatement(
+                        effect=aws_iam.Effect.ALLOW,
+                        actions=[
+                            "autoscaling:DescribeAutoScalingGroups",
+                            "autoscaling:DescribeAutoScalingInstances",
+                            "elasticloadbalancing:DescribeTargetHealth"
+                        ],
+                        resources=["*"]
+                    ),
+                    aws_iam.PolicyStatement(
+                        effect=aws_iam.Effect.ALLOW,
+                        actions=[
+                            "autoscaling:CompleteLifecycleAction"
+                        ],
+                        resources=[
+                            f"arn:{Aws.PARTITION}:autoscaling:{Aws.REGION}:{Aws.ACCOUNT_ID}:autoScalingGroup:*:autoScalingGroupName/{Aws.STACK_NAME}-*"
+                        ]
+                    )
+                ]
+            ),
+            policy_name="AllowCompleteLifecycleAction"
+        )
+        # read by mastodon-config-agent for live configuration changes
+        asg_config_policy = aws_iam.CfnRole.PolicyProperty(
+            policy_document=aws_iam.PolicyDocument(
+                statements=[
+                    aws_iam.PolicyStatement(
+                        effect=aws_iam.Effect.ALLOW,
+                        actions=[
+                            "ssm:GetParametersByPath"
+                        ],
+                        resources=[
+                            f"arn:{Aws.PARTITION}:ssm:{Aws.REGION}:{Aws.ACCOUNT_ID}:parameter/{Aws.STACK_NAME}/config",
+                            f"arn:{Aws.PARTITION}:ssm:{Aws.REGION}:{Aws.ACCOUNT_ID}:parameter/{Aws.STACK_NAME}/config/*"
+                        ]
+                    )
+                ]
+            ),
+            policy_name="AllowReadConfigParameters"
+        )
 
         # asg
         with open("mastodon/user_data.sh") as f:
@@ -116,7 +185,7 @@ class MastodonStack(Stack):
         asg = Asg(
             self,
             "Asg",
-            additional_iam_role_policies=[asg_update_secret_policy],
+            additional_iam_role_policies=[asg_update_secret_policy, asg_lifecycle_policy, asg_config_policy],
             ami_id=AMI_ID,
             ami_id_param_name_suffix=NEXT_RELEASE_PREFIX,
             default_instance_type="t3.small",
@@ -142,6 +211,24 @@ class MastodonStack(Stack):
         )
 
         asg.asg.target_group_arns = [ alb.target_group.ref ]
+        # close streams gradually when app instances terminate, see mastodon-streaming-drain in the AMI
+        streaming_drain = StreamingDrain(
+            self,
+            "StreamingDrain",
+            alb=alb,
+            asg=asg
+        )
+
+        # shared caching proxy for outbound fetches, see packer/egress-proxy-entrypoint.sh
+        egress_proxy = EgressProxy(
+            self,
+            "EgressProxy",
+            asg=asg,
+            vpc=vpc
+        )
+        # instances read the proxy URL and CA certificate at boot
+        asg.asg.add_dependency(egress_proxy.url_parameter)
+        asg.asg.add_dependency(egress_proxy.instance_policy)
 
         db = AuroraPostgresql(
             self,
@@ -149,15 +236,109 @@ class MastodonStack(Stack):
             db_secret=db_secret,
             vpc=vpc
         )
+        db_capacity = AuroraCapacity(
+            self,
+            "DbCapacity",
+            db=db
+        )
+        db_parameter_groups = AuroraParameterGroups(
+            self,
+            "DbParameterGroups",
+            db=db
+        )
+        # performance insights for diagnosing slow queries, see mastodon-slow-queries in the AMI
+        for db_instance in db.node.find_all():
+            if isinstance(db_instance, aws_rds.CfnDBInstance):
+                db_instance.add_property_override("EnablePerformanceInsights", True)
+                db_instance.add_property_override("PerformanceInsightsRetentionPeriod", 7)
         asg.asg.node.add_dependency(db.db_primary_instance)
         asg.asg.node.add_dependency(ses.generate_smtp_password_custom_resource)
 
         Util.add_sg_ingress(oss, asg.sg)
         Util.add_sg_ingress(redis, asg.sg)
         Util.add_sg_ingress(db, asg.sg)
+
+        # media workers share the app launch template, security group and instance role
+        media_workers = MediaWorkers(
+            self,
+            "MediaWorkers",
+            asg=asg
+        )
+        media_workers.asg.add_dependency(asg.asg)
+
+        # fargate sidekiq tasks share the app security group and secrets; environment mirrors .env.production
+        # in user_data.sh, checked by test_sidekiq_environment_matches_env_production
+        sidekiq_service = SidekiqService(
+            self,
+            "SidekiqService",
+            asg=asg,
+            db_secret_arn=db_secret.secret_arn(),
+            egress_proxy=egress_proxy,
+            environment={
+                "LOCAL_DOMAIN": dns.hostname(),
+                "SINGLE_USER_MODE": "false",
+                "DB_HOST": db.db_cluster.attr_endpoint_address,
+                "DB_PORT": db.db_cluster.attr_endpoint_port,
+                "DB_NAME": "mastodon_production",
+                "ES_ENABLED": "true",
+                "ES_HOST": Fn.get_att("OpenSearchServiceDomain", "DomainEndpoint").to_string(),
+                "ES_PORT": "80",
+                "REDIS_HOST": Fn.get_att("RedisCluster", "RedisEndpoint.Address").to_string(),
+                "REDIS_PORT": Fn.get_att("RedisCluster", "RedisEndpoint.Port").to_string(),
+                "REDIS_PASSWORD": "",
+                "S3_ENABLED": "true",
+                "S3_BUCKET": bucket.bucket_name(),
+                "S3_PROTOCOL": "https",
+                "S3_REGION": Aws.REGION,
+                "S3_HOSTNAME": f"s3.{Aws.REGION}.amazonaws.com",
+                "SMTP_SERVER": f"email-smtp.{Aws.REGION}.amazonaws.com",
+                "SMTP_PORT": "587",
+                "SMTP_AUTH_METHOD": "login",
+                "SMTP_OPENSSL_VERIFY_MODE": "none",
+                "SMTP_FROM_ADDRESS": f"{self.name_param.value_as_string} <no-reply@{dns.route_53_hosted_zone_name_param.value_as_string}>",
+                "MASTODON_USE_LIBVIPS": "true",
+                "MEDIA_WORKERS_ENABLED": media_workers.enabled_param.value_as_string,
+                "http_proxy": egress_proxy.url,
+                "no_proxy": NO_PROXY
+            },
+            instance_secret_arn=ses.secret_arn()
+        )
+        sidekiq_service.service.add_dependency(asg.asg)
         
         dns.add_alb(alb)
 
+        # dashboard and alarms
+        asg.asg.metrics_collection = [
+            aws_autoscaling.CfnAutoScalingGroup.MetricsCollectionProperty(
+                granularity="1Minute",
+                metrics=["GroupDesiredCapacity", "GroupInServiceInstances"]
+            )
+        ]
+        dashboard = Dashboard(
+            self,
+            "Dashboard",
+            alb_full_name=alb.alb.attr_load_balancer_full_name,
+            asg_name=asg.asg.ref,
+            db_cluster_identifier=db.db_cluster.ref,
+            # logical ids set by the common constructs, also referenced in user_data.sh
+            open_search_domain_name=Fn.ref("OpenSearchServiceDomain"),
+            redis_cluster_id=Fn.ref("RedisCluster")
+        )
+        canary = Canary(
+            self,
+            "Canary",
+            alarm_topic_arn=dashboard.alarm_topic.ref,
+            asg=asg,
+            base_url=f"https://{dns.hostname()}"
+        )
+
+        CfnOutput(
+            self,
+            "ConfigParameterPath",
+            description="SSM Parameter Store path for live configuration; each parameter is one .env.production variable",
+            value=f"/{Aws.STACK_NAME}/config/"
+        )
+
         CfnOutput(
             self,
             "FirstUseInstructions",
@@ -180,15 +361,25 @@ sudo su - mastodon -c 'read -p \"Enter username: \" username && read -p \"Enter
             }
         ]
         parameter_groups += alb.metadata_parameter_group()
+        parameter_groups += streaming_drain.metadata_parameter_group()
         parameter_groups += bucket.metadata_parameter_group()
+        parameter_groups += bucket_lifecycle.metadata_parameter_group()
         parameter_groups += db_secret.metadata_parameter_group()
         parameter_groups += db.metadata_parameter_group()
+        parameter_groups += db_capacity.metadata_parameter_group()
+        parameter_groups += db_parameter_groups.metadata_parameter_group()
         parameter_groups += dns.metadata_parameter_group()
         parameter_groups += redis.metadata_parameter_group()
         parameter_groups += oss.metadata_parameter_group()
         parameter_groups += asg.metadata_parameter_group()
+        parameter_groups += media_workers.metadata_parameter_group()
+        parameter_groups += sidekiq_service.metadata_parameter_group()
+        parameter_groups += egress_proxy.metadata_parameter_group()
         parameter_groups += ses.metadata_parameter_group()
+        parameter_groups += dashboard.metadata_parameter_group()
+        parameter_groups += canary.metadata_parameter_group()
         parameter_groups += vpc.metadata_parameter_group()
+        parameter_groups += vpc_endpoints.metadata_parameter_group()
 
         # AWS::CloudFormation::Interface
         self.template_options.metadata = {
@@ -200,15 +391,25 @@ sudo su - mastodon -c 'read -p \"Enter username: \" username && read -p \"Enter
                         "default": "Mastodon Site Name"
                     },
                     **alb.metadata_parameter_labels(),
+                    **streaming_drain.metadata_parameter_labels(),
                     **bucket.metadata_parameter_labels(),
+                    **bucket_lifecycle.metadata_parameter_labels(),
                     **db_secret.metadata_parameter_labels(),
                     **db.metadata_parameter_labels(),
+                    **db_capacity.metadata_parameter_labels(),
+                    **db_parameter_groups.metadata_parameter_labels(),
                     **dns.metadata_parameter_labels(),
                     **redis.metadata_parameter_labels(),
                     **oss.metadata_parameter_labels(),
                     **asg.metadata_parameter_labels(),
+                    **media_workers.metadata_parameter_labels(),
+                    **sidekiq_service.metadata_parameter_labels(),
+                    **egress_proxy.metadata_parameter_labels(),
                     **ses.metadata_parameter_labels(),
-                    **vpc.metadata_parameter_labels()
+                    **dashboard.metadata_parameter_labels(),
+                    **canary.metadata_parameter_labels(),
+                    **vpc.metadata_parameter_labels(),
+                    **vpc_endpoints.metadata_parameter_labels()
                 }
             }
         }
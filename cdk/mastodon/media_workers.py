@@ -0,0 +1,229 @@
+from aws_cdk import (
+    Aws,
+    aws_autoscaling,
+    aws_ec2,
+    CfnAutoScalingRollingUpdate,
+    CfnCondition,
+    CfnParameter,
+    CfnUpdatePolicy,
+    Fn
+)
+from constructs import Construct
+
+# instance tag read by the instances (IMDS instance metadata tags) to pick their role at boot
+ROLE_TAG_KEY = "MastodonRole"
+# termination lifecycle hook completed by mastodon-sidekiq-drain on the instance
+DRAIN_LIFECYCLE_HOOK_NAME = "sidekiq-drain"
+# the workers share the app's x86_64 launch template; Graviton families have a "g" after the generation (c7gd, m6g)
+X86_INSTANCE_TYPE_PATTERN = r"^[a-z]+[0-9]+[a-fh-z-]*\.[a-z0-9]+$"
+
+class MediaWorkers(Construct):
+    """Optional Auto Scaling group of Sidekiq workers dedicated to media processing.
+
+    Instances launch from the app's launch template with a compute-optimized
+    instance type and a MastodonRole=media tag. At boot user_data.sh sees the
+    tag and starts only Sidekiq on the media and pull queues, so ffmpeg and
+    ImageMagick work no longer competes with Puma for CPU.
+
+    Jobs are retried, so capacity above an On-Demand base can run on Spot
+    across several instance types. Capacity rebalancing and a termination
+    lifecycle hook give mastodon-sidekiq-drain time to quiet Sidekiq and
+    push unfinished jobs back to Redis before the instance goes away.
+    """
+
+    def __init__(
+            self,
+            scope: Construct,
+            id: str,
+            *,
+            asg,
+            default_instance_type: str = "c6id.large",
+            default_additional_instance_types: tuple = ("c5d.large", "m6id.large"),
+            **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        self.enabled_param = CfnParameter(
+            self,
+            "Enabled",
+            allowed_values=["true", "false"],
+            default="false",
+            description="Required: Run video transcoding and remote media downloads on a separate group of Sidekiq instances instead of the web instances."
+        )
+        self.enabled_param.override_logical_id(f"{id}Enabled")
+        self.instance_type_param = CfnParameter(
+            self,
+            "InstanceType",
+            allowed_pattern=X86_INSTANCE_TYPE_PATTERN,
+            constraint_description="must be an x86_64 instance type; Graviton (arm64) types such as c7gd cannot boot the AMI",
+            default=default_instance_type,
+            description="Required: x86_64 EC2 instance type for the media workers, which boot the app's x86_64 AMI. Types with local NVMe instance storage (e.g. c6id, m6id, c5d) use it for temporary files."
+        )
+        self.instance_type_param.override_logical_id(f"{id}InstanceType")
+        self.capacity_param = CfnParameter(
+            self,
+            "Capacity",
+            default=1,
+            description="Required: Number of media worker instances.",
+            min_value=1,
+            max_value=10,
+            type="Number"
+        )
+        self.capacity_param.override_logical_id(f"{id}Capacity")
+        self.additional_instance_type_params = []
+        for i, default in enumerate(default_additional_instance_types, 1):
+            param = CfnParameter(
+                self,
+                f"AdditionalInstanceType{i}",
+                allowed_pattern=f"^({X86_INSTANCE_TYPE_PATTERN[1:-1]})?$",
+                constraint_description="must be blank or an x86_64 instance type; Graviton (arm64) types cannot boot the AMI",
+                default=default,
+                description="Optional: Another x86_64 instance type the media workers can use, so Spot capacity can come from several pools. Leave blank to skip."
+            )
+            param.override_logical_id(f"{id}AdditionalInstanceType{i}")
+            self.additional_instance_type_params.append(param)
+        self.on_demand_base_capacity_param = CfnParameter(
+            self,
+            "OnDemandBaseCapacity",
+            default=1,
+            description="Required: Number of media workers that always run On-Demand.",
+            min_value=0,
+            type="Number"
+        )
+        self.on_demand_base_capacity_param.override_logical_id(f"{id}OnDemandBaseCapacity")
+        self.on_demand_percentage_param = CfnParameter(
+            self,
+            "OnDemandPercentageAboveBase",
+            default=100,
+            description="Required: Percentage of media workers above the On-Demand base that run On-Demand; the rest run on Spot. 0 runs all of them on Spot.",
+            min_value=0,
+            max_value=100,
+            type="Number"
+        )
+        self.on_demand_percentage_param.override_logical_id(f"{id}OnDemandPercentageAboveBase")
+
+        self.enabled_condition = CfnCondition(
+            self,
+            "EnabledCondition",
+            expression=Fn.condition_equals(self.enabled_param.value, "true")
+        )
+        self.enabled_condition.override_logical_id(f"{id}EnabledCondition")
+        overrides = [
+            aws_autoscaling.CfnAutoScalingGroup.LaunchTemplateOverridesProperty(
+                instance_type=self.instance_type_param.value_as_string
+            )
+        ]
+        for i, param in enumerate(self.additional_instance_type_params, 1):
+            condition = CfnCondition(
+                self,
+                f"AdditionalInstanceType{i}Condition",
+                expression=Fn.condition_not(Fn.condition_equals(param.value, ""))
+            )
+            condition.override_logical_id(f"{id}AdditionalInstanceType{i}Condition")
+            overrides.append(
+                Fn.condition_if(
+                    condition.logical_id,
+                    {"InstanceType": param.value_as_string},
+                    Aws.NO_VALUE
+                )
+            )
+
+        # instances need their own tags in IMDS to find out which role they run
+        for launch_template in asg.node.find_all():
+            if isinstance(launch_template, aws_ec2.CfnLaunchTemplate):
+                launch_template.add_property_override(
+                    "LaunchTemplateData.MetadataOptions.InstanceMetadataTags",
+                    "enabled"
+                )
+
+        self.asg = aws_autoscaling.CfnAutoScalingGroup(
+            self,
+            "Asg",
+            capacity_rebalance=True,
+            desired_capacity=self.capacity_param.value_as_string,
+            lifecycle_hook_specification_list=[
+                aws_autoscaling.CfnAutoScalingGroup.LifecycleHookSpecificationProperty(
+                    default_result="CONTINUE",
+                    heartbeat_timeout=180,
+                    lifecycle_hook_name=DRAIN_LIFECYCLE_HOOK_NAME,
+                    lifecycle_transition="autoscaling:EC2_INSTANCE_TERMINATING"
+                )
+            ],
+            max_size=self.capacity_param.value_as_string,
+            min_size=self.capacity_param.value_as_string,
+            mixed_instances_policy=aws_autoscaling.CfnAutoScalingGroup.MixedInstancesPolicyProperty(
+                launch_template=aws_autoscaling.CfnAutoScalingGroup.LaunchTemplateProperty(
+                    launch_template_specification=asg.asg.launch_template,
+                    overrides=overrides
+                ),
+                instances_distribution=aws_autoscaling.CfnAutoScalingGroup.InstancesDistributionProperty(
+                    on_demand_base_capacity=self.on_demand_base_capacity_param.value_as_number,
+                    on_demand_percentage_above_base_capacity=self.on_demand_percentage_param.value_as_number,
+                    spot_allocation_strategy="price-capacity-optimized"
+                )
+            ),
+            tags=[
+                aws_autoscaling.CfnAutoScalingGroup.TagPropertyProperty(
+                    key="Name",
+                    propagate_at_launch=True,
+                    value=f"{Aws.STACK_NAME}/MediaWorkers"
+                ),
+                aws_autoscaling.CfnAutoScalingGroup.TagPropertyProperty(
+                    key=ROLE_TAG_KEY,
+                    propagate_at_launch=True,
+                    value="media"
+                )
+            ],
+            vpc_zone_identifier=asg.asg.vpc_zone_identifier
+        )
+        self.asg.cfn_options.condition = self.enabled_condition
+        # replace workers one at a time when the launch template changes, e.g. a new AMI
+        self.asg.cfn_options.update_policy = CfnUpdatePolicy(
+            auto_scaling_rolling_update=CfnAutoScalingRollingUpdate(
+                max_batch_size=1,
+                min_instances_in_service=0
+            )
+        )
+        self.asg.override_logical_id(f"{id}Asg")
+
+    def metadata_parameter_group(self):
+        return [
+            {
+                "Label": {
+                    "default": "Media Workers"
+                },
+                "Parameters": [
+                    self.enabled_param.logical_id,
+                    self.instance_type_param.logical_id,
+                    self.capacity_param.logical_id,
+                    *[param.logical_id for param in self.additional_instance_type_params],
+                    self.on_demand_base_capacity_param.logical_id,
+                    self.on_demand_percentage_param.logical_id
+                ]
+            }
+        ]
+
+    def metadata_parameter_labels(self):
+        return {
+            self.enabled_param.logical_id: {
+                "default": "Enable Dedicated Media Workers"
+            },
+            self.instance_type_param.logical_id: {
+                "default": "Media Worker Instance Type"
+            },
+            self.capacity_param.logical_id: {
+                "default": "Media Worker Count"
+            },
+            **{
+                param.logical_id: {
+                    "default": f"Media Worker Additional Instance Type {i}"
+                }
+                for i, param in enumerate(self.additional_instance_type_params, 1)
+            },
+            self.on_demand_base_capacity_param.logical_id: {
+                "default": "Media Worker On-Demand Base Capacity"
+            },
+            self.on_demand_percentage_param.logical_id: {
+                "default": "Media Worker On-Demand Percentage Above Base"
+            }
+        }
@@ -0,0 +1,377 @@
+from aws_cdk import (
+    Aws,
+    aws_applicationautoscaling,
+    aws_ecs,
+    aws_iam,
+    aws_logs,
+    CfnCondition,
+    CfnParameter,
+    Fn
+)
+from constructs import Construct
+
+# queues from Mastodon's config/sidekiq.yml except scheduler, which must run in one process only
+SIDEKIQ_QUEUES = ["default,8", "push,6", "ingress,4", "mailers,2", "pull", "fasp"]
+LATENCY_QUEUES = ["default", "push", "ingress", "pull"]
+
+# keys of the DB and instance secrets, mapped to the Mastodon environment variables they feed
+DB_SECRET_KEYS = {
+    "DB_USER": "username",
+    "DB_PASS": "password"
+}
+INSTANCE_SECRET_KEYS = {
+    "ACTIVE_RECORD_ENCRYPTION_DETERMINISTIC_KEY": "active_record_encryption_deterministic_key",
+    "ACTIVE_RECORD_ENCRYPTION_KEY_DERIVATION_SALT": "active_record_encryption_key_derivation_salt",
+    "ACTIVE_RECORD_ENCRYPTION_PRIMARY_KEY": "active_record_encryption_primary_key",
+    "AWS_ACCESS_KEY_ID": "access_key_id",
+    "AWS_SECRET_ACCESS_KEY": "secret_access_key",
+    "OTP_SECRET": "otp_secret",
+    "SECRET_KEY_BASE": "secret_key_base",
+    "SMTP_LOGIN": "access_key_id",
+    "SMTP_PASSWORD": "smtp_password",
+    "VAPID_PRIVATE_KEY": "vapid_private_key",
+    "VAPID_PUBLIC_KEY": "vapid_public_key"
+}
+
+class SidekiqService(Construct):
+    """Optional ECS Fargate service running Sidekiq, scaled on Sidekiq queue latency.
+
+    Tasks start in well under a minute, against several minutes for an EC2
+    instance running user_data.sh, so the service absorbs federation bursts
+    the Asg cannot. The image is the sidekiq stage of packer/Dockerfile, built
+    by the same ubuntu_2404_appinstall.sh as the AMI. Tasks share the app
+    security group and read credentials from the same secrets as the
+    instances. When the egress proxy is enabled, tasks also trust its CA.
+    """
+
+    def __init__(
+            self,
+            scope: Construct,
+            id: str,
+            *,
+            asg,
+            db_secret_arn: str,
+            egress_proxy=None,
+            environment: dict,
+            instance_secret_arn: str,
+            **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        self.enabled_param = CfnParameter(
+            self,
+            "Enabled",
+            allowed_values=["true", "false"],
+            default="false",
+            description="Required: Run additional Sidekiq workers on ECS Fargate, scaled on queue latency."
+        )
+        self.enabled_param.override_logical_id(f"{id}Enabled")
+        self.image_param = CfnParameter(
+            self,
+            "Image",
+            default="",
+            description="Optional: URI of the Sidekiq container image built with 'make sidekiq-image'. Required when the service is enabled."
+        )
+        self.image_param.override_logical_id(f"{id}Image")
+        self.cpu_param = CfnParameter(
+            self,
+            "Cpu",
+            allowed_values=["512", "1024", "2048", "4096"],
+            default="1024",
+            description="Required: Fargate CPU units per Sidekiq task."
+        )
+        self.cpu_param.override_logical_id(f"{id}Cpu")
+        self.memory_param = CfnParameter(
+            self,
+            "Memory",
+            allowed_values=["1024", "2048", "4096", "8192"],
+            default="2048",
+            description="Required: Fargate memory (MiB) per Sidekiq task. Must be a valid combination with the CPU units."
+        )
+        self.memory_param.override_logical_id(f"{id}Memory")
+        self.concurrency_param = CfnParameter(
+            self,
+            "Concurrency",
+            default=10,
+            description="Required: Sidekiq threads per task. Each thread can hold a database connection.",
+            min_value=1,
+            max_value=50,
+            type="Number"
+        )
+        self.concurrency_param.override_logical_id(f"{id}Concurrency")
+        self.min_tasks_param = CfnParameter(
+            self,
+            "MinTasks",
+            default=0,
+            description="Required: Minimum number of Sidekiq tasks.",
+            min_value=0,
+            type="Number"
+        )
+        self.min_tasks_param.override_logical_id(f"{id}MinTasks")
+        self.max_tasks_param = CfnParameter(
+            self,
+            "MaxTasks",
+            default=10,
+            description="Required: Maximum number of Sidekiq tasks.",
+            min_value=1,
+            type="Number"
+        )
+        self.max_tasks_param.override_logical_id(f"{id}MaxTasks")
+        self.target_latency_param = CfnParameter(
+            self,
+            "TargetLatency",
+            default=10,
+            description="Required: Sidekiq queue latency in seconds, across the default, push, ingress and pull queues, that the service scales to hold.",
+            min_value=1,
+            type="Number"
+        )
+        self.target_latency_param.override_logical_id(f"{id}TargetLatency")
+
+        self.enabled_condition = CfnCondition(
+            self,
+            "EnabledCondition",
+            expression=Fn.condition_equals(self.enabled_param.value, "true")
+        )
+        self.enabled_condition.override_logical_id(f"{id}EnabledCondition")
+
+        self.log_group = aws_logs.CfnLogGroup(
+            self,
+            "LogGroup",
+            retention_in_days=30
+        )
+        self.log_group.cfn_options.condition = self.enabled_condition
+        self.log_group.override_logical_id(f"{id}LogGroup")
+
+        self.execution_role = aws_iam.CfnRole(
+            self,
+            "ExecutionRole",
+            assume_role_policy_document=aws_iam.PolicyDocument(
+                statements=[
+                    aws_iam.PolicyStatement(
+                        effect=aws_iam.Effect.ALLOW,
+                        actions=["sts:AssumeRole"],
+                        principals=[aws_iam.ServicePrincipal("ecs-tasks.amazonaws.com")]
+                    )
+                ]
+            ),
+            managed_policy_arns=[
+                f"arn:{Aws.PARTITION}:iam::aws:policy/service-role/AmazonECSTaskExecutionRolePolicy"
+            ],
+            policies=[
+                aws_iam.CfnRole.PolicyProperty(
+                    policy_document=aws_iam.PolicyDocument(
+                        statements=[
+                            aws_iam.PolicyStatement(
+                                effect=aws_iam.Effect.ALLOW,
+                                actions=["secretsmanager:GetSecretValue"],
+                                resources=[db_secret_arn, instance_secret_arn] + (
+                                    [egress_proxy.ca_secret_arn] if egress_proxy else []
+                                )
+                            )
+                        ]
+                    ),
+                    policy_name="AllowReadSecrets"
+                )
+            ]
+        )
+        self.execution_role.cfn_options.condition = self.enabled_condition
+        self.execution_role.override_logical_id(f"{id}ExecutionRole")
+
+        self.cluster = aws_ecs.CfnCluster(
+            self,
+            "Cluster",
+            cluster_settings=[
+                aws_ecs.CfnCluster.ClusterSettingsProperty(name="containerInsights", value="enabled")
+            ]
+        )
+        self.cluster.cfn_options.condition = self.enabled_condition
+        self.cluster.override_logical_id(f"{id}Cluster")
+
+        secrets = [
+            aws_ecs.CfnTaskDefinition.SecretProperty(name=name, value_from=f"{db_secret_arn}:{key}::")
+            for name, key in DB_SECRET_KEYS.items()
+        ] + [
+            aws_ecs.CfnTaskDefinition.SecretProperty(name=name, value_from=f"{instance_secret_arn}:{key}::")
+            for name, key in INSTANCE_SECRET_KEYS.items()
+        ]
+        if egress_proxy:
+            # read by sidekiq-entrypoint.sh; only referenced when the proxy is enabled
+            secrets.append(Fn.condition_if(
+                egress_proxy.enabled_condition.logical_id,
+                {
+                    "Name": "EGRESS_PROXY_CA_CERTIFICATE",
+                    "ValueFrom": f"{egress_proxy.ca_secret_arn_param.value_as_string}:certificate::"
+                },
+                Aws.NO_VALUE
+            ))
+        self.task_definition = aws_ecs.CfnTaskDefinition(
+            self,
+            "TaskDefinition",
+            container_definitions=[
+                aws_ecs.CfnTaskDefinition.ContainerDefinitionProperty(
+                    command=["sidekiq", *[arg for queue in SIDEKIQ_QUEUES for arg in ("-q", queue)]],
+                    environment=[
+                        aws_ecs.CfnTaskDefinition.KeyValuePairProperty(name=name, value=value)
+                        for name, value in {
+                            **environment,
+                            "DB_POOL": self.concurrency_param.value_as_string,
+                            "SIDEKIQ_CONCURRENCY": self.concurrency_param.value_as_string
+                        }.items()
+                    ],
+                    essential=True,
+                    image=self.image_param.value_as_string,
+                    log_configuration=aws_ecs.CfnTaskDefinition.LogConfigurationProperty(
+                        log_driver="awslogs",
+                        options={
+                            "awslogs-group": self.log_group.ref,
+                            "awslogs-region": Aws.REGION,
+                            "awslogs-stream-prefix": "sidekiq"
+                        }
+                    ),
+                    name="sidekiq",
+                    secrets=secrets,
+                    # sidekiq's default shutdown timeout is 25s; unfinished jobs are pushed back to redis
+                    stop_timeout=30
+                )
+            ],
+            cpu=self.cpu_param.value_as_string,
+            execution_role_arn=self.execution_role.attr_arn,
+            family=f"{Aws.STACK_NAME}-sidekiq",
+            memory=self.memory_param.value_as_string,
+            network_mode="awsvpc",
+            requires_compatibilities=["FARGATE"],
+            runtime_platform=aws_ecs.CfnTaskDefinition.RuntimePlatformProperty(
+                cpu_architecture="X86_64",
+                operating_system_family="LINUX"
+            )
+        )
+        self.task_definition.cfn_options.condition = self.enabled_condition
+        self.task_definition.override_logical_id(f"{id}TaskDefinition")
+
+        self.service = aws_ecs.CfnService(
+            self,
+            "Service",
+            capacity_provider_strategy=[
+                aws_ecs.CfnService.CapacityProviderStrategyItemProperty(capacity_provider="FARGATE", weight=1)
+            ],
+            cluster=self.cluster.ref,
+            deployment_configuration=aws_ecs.CfnService.DeploymentConfigurationProperty(
+                maximum_percent=200,
+                minimum_healthy_percent=100
+            ),
+            desired_count=self.min_tasks_param.value_as_number,
+            network_configuration=aws_ecs.CfnService.NetworkConfigurationProperty(
+                awsvpc_configuration=aws_ecs.CfnService.AwsVpcConfigurationProperty(
+                    assign_public_ip="DISABLED",
+                    security_groups=[asg.sg.attr_group_id],
+                    subnets=asg.asg.vpc_zone_identifier
+                )
+            ),
+            task_definition=self.task_definition.ref
+        )
+        self.service.cfn_options.condition = self.enabled_condition
+        self.service.override_logical_id(f"{id}Service")
+
+        self.scalable_target = aws_applicationautoscaling.CfnScalableTarget(
+            self,
+            "ScalableTarget",
+            max_capacity=self.max_tasks_param.value_as_number,
+            min_capacity=self.min_tasks_param.value_as_number,
+            resource_id=f"service/{self.cluster.ref}/{self.service.attr_name}",
+            scalable_dimension="ecs:service:DesiredCount",
+            service_namespace="ecs"
+        )
+        self.scalable_target.cfn_options.condition = self.enabled_condition
+        self.scalable_target.override_logical_id(f"{id}ScalableTarget")
+
+        # the latency metrics are published by mastodon-sidekiq-metrics on the instances
+        queries = [
+            aws_applicationautoscaling.CfnScalingPolicy.TargetTrackingMetricDataQueryProperty(
+                id=f"m{i}",
+                metric_stat=aws_applicationautoscaling.CfnScalingPolicy.TargetTrackingMetricStatProperty(
+                    metric=aws_applicationautoscaling.CfnScalingPolicy.TargetTrackingMetricProperty(
+                        dimensions=[
+                            aws_applicationautoscaling.CfnScalingPolicy.TargetTrackingMetricDimensionProperty(name="Queue", value=queue),
+                            aws_applicationautoscaling.CfnScalingPolicy.TargetTrackingMetricDimensionProperty(name="StackName", value=Aws.STACK_NAME)
+                        ],
+                        metric_name="SidekiqQueueLatency",
+                        namespace="Mastodon"
+                    ),
+                    stat="Maximum"
+                ),
+                return_data=False
+            )
+            for i, queue in enumerate(LATENCY_QUEUES)
+        ]
+        queries.append(
+            aws_applicationautoscaling.CfnScalingPolicy.TargetTrackingMetricDataQueryProperty(
+                expression=f"MAX([{', '.join(query.id for query in queries)}])",
+                id="latency",
+                label="Sidekiq queue latency",
+                return_data=True
+            )
+        )
+        self.scaling_policy = aws_applicationautoscaling.CfnScalingPolicy(
+            self,
+            "ScalingPolicy",
+            policy_name=f"{Aws.STACK_NAME}-sidekiq-queue-latency",
+            policy_type="TargetTrackingScaling",
+            scaling_target_id=self.scalable_target.ref,
+            target_tracking_scaling_policy_configuration=aws_applicationautoscaling.CfnScalingPolicy.TargetTrackingScalingPolicyConfigurationProperty(
+                customized_metric_specification=aws_applicationautoscaling.CfnScalingPolicy.CustomizedMetricSpecificationProperty(
+                    metrics=queries
+                ),
+                scale_in_cooldown=300,
+                scale_out_cooldown=60,
+                target_value=self.target_latency_param.value_as_number
+            )
+        )
+        self.scaling_policy.cfn_options.condition = self.enabled_condition
+        self.scaling_policy.override_logical_id(f"{id}ScalingPolicy")
+
+    def metadata_parameter_group(self):
+        return [
+            {
+                "Label": {
+                    "default": "Sidekiq Service (ECS Fargate)"
+                },
+                "Parameters": [
+                    self.enabled_param.logical_id,
+                    self.image_param.logical_id,
+                    self.cpu_param.logical_id,
+                    self.memory_param.logical_id,
+                    self.concurrency_param.logical_id,
+                    self.min_tasks_param.logical_id,
+                    self.max_tasks_param.logical_id,
+                    self.target_latency_param.logical_id
+                ]
+            }
+        ]
+
+    def metadata_parameter_labels(self):
+        return {
+            self.enabled_param.logical_id: {
+                "default": "Enable Sidekiq Service"
+            },
+            self.image_param.logical_id: {
+                "default": "Sidekiq Service Image URI"
+            },
+            self.cpu_param.logical_id: {
+                "default": "Sidekiq Task CPU Units"
+            },
+            self.memory_param.logical_id: {
+                "default": "Sidekiq Task Memory (MiB)"
+            },
+            self.concurrency_param.logical_id: {
+                "default": "Sidekiq Task Concurrency"
+            },
+            self.min_tasks_param.logical_id: {
+                "default": "Sidekiq Service Minimum Tasks"
+            },
+            self.max_tasks_param.logical_id: {
+                "default": "Sidekiq Service Maximum Tasks"
+            },
+            self.target_latency_param.logical_id: {
+                "default": "Sidekiq Service Target Queue Latency (seconds)"
+            }
+        }
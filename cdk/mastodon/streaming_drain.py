@@ -0,0 +1,113 @@
+from aws_cdk import (
+    aws_autoscaling,
+    aws_elasticloadbalancingv2,
+    CfnParameter
+)
+from constructs import Construct
+
+# termination lifecycle hook completed by mastodon-streaming-drain on the instance
+DRAIN_LIFECYCLE_HOOK_NAME = "streaming-drain"
+# longest StreamingDrainSeconds plus time to stop streaming and complete the hook, for when the
+# hook starts before the deregistration; otherwise the drain is over before the hook starts
+HEARTBEAT_TIMEOUT = 360
+
+def _with_attribute(attributes, property_class, key: str, value: str) -> list:
+    """Attributes already set by the common construct, with key set to value."""
+    kept = [
+        attribute for attribute in (attributes or [])
+        if (attribute.get("key") if isinstance(attribute, dict) else attribute.key) != key
+    ]
+    return kept + [property_class(key=key, value=value)]
+
+class StreamingDrain(Construct):
+    """Graceful draining of streaming connections when app instances terminate.
+
+    On scale-in or instance replacement the Auto Scaling group deregisters
+    the instance, and the ALB keeps its open connections for the target
+    group's deregistration delay. The termination lifecycle hook only starts
+    after that delay, so mastodon-streaming-drain starts when the target
+    turns "draining" and closes the streams at random times across the
+    delay. Clients reconnect to the other instances gradually instead of all
+    at once. The hook then holds the instance while the drain stops
+    mastodon-streaming. The ALB idle timeout is raised for long-lived
+    streams.
+    """
+
+    def __init__(
+            self,
+            scope: Construct,
+            id: str,
+            *,
+            alb,
+            asg,
+            **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        self.seconds_param = CfnParameter(
+            self,
+            "Seconds",
+            default=90,
+            description="Required: Seconds to spread closing streaming connections over when an app instance is terminated. Also the target group deregistration delay.",
+            max_value=300,
+            min_value=0,
+            type="Number"
+        )
+        self.seconds_param.override_logical_id(f"{id}Seconds")
+        self.idle_timeout_param = CfnParameter(
+            self,
+            "IdleTimeout",
+            default=120,
+            description="Required: Seconds the ALB keeps an idle connection open. Streaming connections send a heartbeat every 15 to 30 seconds.",
+            max_value=4000,
+            min_value=60,
+            type="Number"
+        )
+        self.idle_timeout_param.override_logical_id(f"{id}IdleTimeout")
+
+        alb.target_group.target_group_attributes = _with_attribute(
+            alb.target_group.target_group_attributes,
+            aws_elasticloadbalancingv2.CfnTargetGroup.TargetGroupAttributeProperty,
+            "deregistration_delay.timeout_seconds",
+            self.seconds_param.value_as_string
+        )
+        alb.alb.load_balancer_attributes = _with_attribute(
+            alb.alb.load_balancer_attributes,
+            aws_elasticloadbalancingv2.CfnLoadBalancer.LoadBalancerAttributeProperty,
+            "idle_timeout.timeout_seconds",
+            self.idle_timeout_param.value_as_string
+        )
+
+        self.lifecycle_hook = aws_autoscaling.CfnLifecycleHook(
+            self,
+            "LifecycleHook",
+            auto_scaling_group_name=asg.asg.ref,
+            default_result="CONTINUE",
+            heartbeat_timeout=HEARTBEAT_TIMEOUT,
+            lifecycle_hook_name=DRAIN_LIFECYCLE_HOOK_NAME,
+            lifecycle_transition="autoscaling:EC2_INSTANCE_TERMINATING"
+        )
+        self.lifecycle_hook.override_logical_id(f"{id}LifecycleHook")
+
+    def metadata_parameter_group(self):
+        return [
+            {
+                "Label": {
+                    "default": "Streaming Connection Draining"
+                },
+                "Parameters": [
+                    self.seconds_param.logical_id,
+                    self.idle_timeout_param.logical_id
+                ]
+            }
+        ]
+
+    def metadata_parameter_labels(self):
+        return {
+            self.seconds_param.logical_id: {
+                "default": "Streaming Drain Time (seconds)"
+            },
+            self.idle_timeout_param.logical_id: {
+                "default": "ALB Idle Timeout (seconds)"
+            }
+        }
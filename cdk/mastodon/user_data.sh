@@ -1,136 +1,9 @@
 #!/bin/bash
 
-# aws cloudwatch
-cat <<EOF > /opt/aws/amazon-cloudwatch-agent/etc/amazon-cloudwatch-agent.json
-{
-  "agent": {
-    "metrics_collection_interval": 60,
-    "run_as_user": "root",
-    "logfile": "/opt/aws/amazon-cloudwatch-agent/logs/amazon-cloudwatch-agent.log"
-  },
-  "metrics": {
-    "metrics_collected": {
-      "collectd": {
-        "metrics_aggregation_interval": 60
-      },
-      "disk": {
-        "measurement": ["used_percent"],
-        "metrics_collection_interval": 60,
-        "resources": ["*"]
-      },
-      "mem": {
-        "measurement": ["mem_used_percent"],
-        "metrics_collection_interval": 60
-      }
-    },
-    "append_dimensions": {
-      "ImageId": "\${!aws:ImageId}",
-      "InstanceId": "\${!aws:InstanceId}",
-      "InstanceType": "\${!aws:InstanceType}",
-      "AutoScalingGroupName": "\${!aws:AutoScalingGroupName}"
-    }
-  },
-  "logs": {
-    "logs_collected": {
-      "files": {
-        "collect_list": [
-          {
-            "file_path": "/opt/aws/amazon-cloudwatch-agent/logs/amazon-cloudwatch-agent.log",
-            "log_group_name": "${AsgSystemLogGroup}",
-            "log_stream_name": "{instance_id}-/opt/aws/amazon-cloudwatch-agent/logs/amazon-cloudwatch-agent.log",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/var/log/dpkg.log",
-            "log_group_name": "${AsgSystemLogGroup}",
-            "log_stream_name": "{instance_id}-/var/log/dpkg.log",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/var/log/apt/history.log",
-            "log_group_name": "${AsgSystemLogGroup}",
-            "log_stream_name": "{instance_id}-/var/log/apt/history.log",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/var/log/cloud-init.log",
-            "log_group_name": "${AsgSystemLogGroup}",
-            "log_stream_name": "{instance_id}-/var/log/cloud-init.log",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/var/log/cloud-init-output.log",
-            "log_group_name": "${AsgSystemLogGroup}",
-            "log_stream_name": "{instance_id}-/var/log/cloud-init-output.log",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/var/log/auth.log",
-            "log_group_name": "${AsgSystemLogGroup}",
-            "log_stream_name": "{instance_id}-/var/log/auth.log",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/var/log/syslog",
-            "log_group_name": "${AsgSystemLogGroup}",
-            "log_stream_name": "{instance_id}-/var/log/syslog",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/var/log/amazon/ssm/amazon-ssm-agent.log",
-            "log_group_name": "${AsgSystemLogGroup}",
-            "log_stream_name": "{instance_id}-/var/log/amazon/ssm/amazon-ssm-agent.log",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/var/log/amazon/ssm/errors.log",
-            "log_group_name": "${AsgSystemLogGroup}",
-            "log_stream_name": "{instance_id}-/var/log/amazon/ssm/errors.log",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/var/log/nginx/access.log",
-            "log_group_name": "${AsgAppLogGroup}",
-            "log_stream_name": "{instance_id}-/var/log/nginx/access.log",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/var/log/nginx/error.log",
-            "log_group_name": "${AsgAppLogGroup}",
-            "log_stream_name": "{instance_id}-/var/log/nginx/error.log",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/var/log/mastodon-web.log",
-            "log_group_name": "${AsgAppLogGroup}",
-            "log_stream_name": "{instance_id}-/var/log/mastodon-web.log",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/var/log/mastodon-sidekiq.log",
-            "log_group_name": "${AsgAppLogGroup}",
-            "log_stream_name": "{instance_id}-/var/log/mastodon-sidekiq.log",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/var/log/mastodon-streaming.log",
-            "log_group_name": "${AsgAppLogGroup}",
-            "log_stream_name": "{instance_id}-/var/log/mastodon-streaming.log",
-            "timezone": "UTC"
-          },
-          {
-            "file_path": "/home/mastodon/live/log/crons.log",
-            "log_group_name": "${AsgAppLogGroup}",
-            "log_stream_name": "{instance_id}-/home/mastodon/live/log/crons.log",
-            "timezone": "UTC"
-          }
-        ]
-      }
-    },
-    "log_stream_name": "{instance_id}"
-  }
-}
-EOF
+# aws cloudwatch: the agent config is in the AMI; the log group names can be long, so each is
+# substituted into the user data once
+sed -e "s|@SYSTEM_LOG_GROUP@|${AsgSystemLogGroup}|" -e "s|@APP_LOG_GROUP@|${AsgAppLogGroup}|" \
+  /etc/mastodon/amazon-cloudwatch-agent.json > /opt/aws/amazon-cloudwatch-agent/etc/amazon-cloudwatch-agent.json
 systemctl enable amazon-cloudwatch-agent
 systemctl start amazon-cloudwatch-agent
 
@@ -140,6 +13,13 @@ openssl req -x509 -nodes -days 3650 -newkey rsa:2048 \
   -subj '/CN=localhost'
 
 mkdir -p /opt/oe/patterns
+echo "${AWS::StackName}" > /opt/oe/patterns/stack-name.txt
+# match tootctl media remove to the S3 expiration of cached remote media (tootctl default when disabled)
+MEDIA_CACHE_DAYS=${AssetsBucketLifecycleCacheExpirationDays}
+[ "$MEDIA_CACHE_DAYS" -gt 0 ] || MEDIA_CACHE_DAYS=7
+echo $MEDIA_CACHE_DAYS > /opt/oe/patterns/media-cache-days.txt
+# target group deregistration delay, read by mastodon-streaming-drain
+echo ${StreamingDrainSeconds} > /opt/oe/patterns/streaming-drain-seconds.txt
 
 # secretsmanager
 SECRET_ARN="${DbSecretArn}"
@@ -210,18 +90,37 @@ SMTP_FROM_ADDRESS='${Name} <no-reply@${HostedZoneName}>'
 ACTIVE_RECORD_ENCRYPTION_DETERMINISTIC_KEY=$ACTIVE_RECORD_ENCRYPTION_DETERMINISTIC_KEY
 ACTIVE_RECORD_ENCRYPTION_KEY_DERIVATION_SALT=$ACTIVE_RECORD_ENCRYPTION_KEY_DERIVATION_SALT
 ACTIVE_RECORD_ENCRYPTION_PRIMARY_KEY=$ACTIVE_RECORD_ENCRYPTION_PRIMARY_KEY
+MASTODON_USE_LIBVIPS=true
+MEDIA_WORKERS_ENABLED=${MediaWorkersEnabled}
 EOF
 
+# outbound fetches through the egress caching proxy, when it is enabled
+/usr/local/bin/mastodon-egress-proxy-setup "${EgressProxyCaSecretArn}"
+
 sed -i 's|# ssl_certificate     /etc/letsencrypt/live/example.com/fullchain.pem;|ssl_certificate     /etc/ssl/certs/nginx-selfsigned.crt;|' /etc/nginx/sites-available/mastodon
 sed -i 's|# ssl_certificate_key /etc/letsencrypt/live/example.com/privkey.pem;|ssl_certificate_key /etc/ssl/private/nginx-selfsigned.key;|' /etc/nginx/sites-available/mastodon
 sed -i 's/example.com/${Hostname}/g' /etc/nginx/sites-available/mastodon
 ln -s /etc/nginx/sites-available/mastodon /etc/nginx/sites-enabled/mastodon
 service nginx restart
 
+# tunables from SSM Parameter Store, then keep watching for changes
+/usr/local/bin/mastodon-config-agent --once --no-restart || true
+systemctl enable --now mastodon-config-agent
+
+# media workers only run sidekiq; the app instances handle migrations and signal CloudFormation
+if [ "$(/usr/local/bin/mastodon-instance-role)" = "media" ]; then
+  /usr/local/bin/mastodon-media-worker-setup
+  exit 0
+fi
+
+# close streams gradually when the instance is terminated
+systemctl enable --now mastodon-streaming-drain
+
 # Database setup: create+migrate for new installs, migrate for upgrades
 # db:setup will fail if database already exists, so we run db:migrate after to handle both cases
 su - mastodon -c "cd /home/mastodon/live && RAILS_ENV=production /home/mastodon/.rbenv/shims/bundle exec rake db:setup" || true
 su - mastodon -c "cd /home/mastodon/live && RAILS_ENV=production /home/mastodon/.rbenv/shims/bundle exec rake db:migrate"
+PGPASSWORD="$DB_PASSWORD" psql -h ${DbCluster.Endpoint.Address} -p ${DbCluster.Endpoint.Port} -U "$DB_USERNAME" -d mastodon_production -f /root/db-tuning.sql || true
 
 systemctl restart mastodon-web mastodon-sidekiq mastodon-streaming
 success=$?
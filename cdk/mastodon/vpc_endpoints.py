@@ -0,0 +1,156 @@
+from aws_cdk import (
+    Aws,
+    aws_ec2,
+    CfnCondition,
+    CfnParameter,
+    Fn,
+    Stack
+)
+from constructs import Construct
+
+INTERFACE_ENDPOINT_SERVICES = {
+    "SecretsManager": "secretsmanager",
+    "Ssm": "ssm",
+    "SsmMessages": "ssmmessages",
+    "Ec2Messages": "ec2messages",
+    "Logs": "logs",
+    "Monitoring": "monitoring"
+}
+
+class VpcEndpoints(Construct):
+    """S3 gateway and AWS API interface endpoints for the VPC created by the common Vpc construct.
+
+    Keeps media I/O and boot-time AWS API calls off the NAT gateways. When the
+    operator supplies an existing VPC, endpoints are theirs to manage and none
+    are created.
+    """
+
+    def __init__(
+            self,
+            scope: Construct,
+            id: str,
+            *,
+            vpc,
+            **kwargs
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        self.s3_gateway_param = CfnParameter(
+            self,
+            "S3Gateway",
+            allowed_values=["true", "false"],
+            default="true",
+            description="Required: Create an S3 gateway endpoint on the private route tables so media uploads and downloads bypass the NAT gateways. Only applies when this stack creates the VPC."
+        )
+        self.s3_gateway_param.override_logical_id(f"{id}S3Gateway")
+        self.interface_param = CfnParameter(
+            self,
+            "Interface",
+            allowed_values=["true", "false"],
+            default="false",
+            description="Required: Create interface endpoints for Secrets Manager, SSM, CloudWatch Logs and CloudWatch Monitoring in the private subnets. Each endpoint is billed hourly per AZ. Only applies when this stack creates the VPC."
+        )
+        self.interface_param.override_logical_id(f"{id}Interface")
+
+        cfn_vpc = next(c for c in vpc.node.find_all() if isinstance(c, aws_ec2.CfnVPC))
+        vpc_created_condition = cfn_vpc.cfn_options.condition
+
+        # private route tables are the ones that route through a NAT gateway
+        stack = Stack.of(self)
+        private_route_tables = []
+        for route in vpc.node.find_all():
+            if isinstance(route, aws_ec2.CfnRoute) and route.nat_gateway_id:
+                if stack.resolve(route.route_table_id) not in [stack.resolve(rt) for rt in private_route_tables]:
+                    private_route_tables.append(route.route_table_id)
+        private_subnets = []
+        for association in vpc.node.find_all():
+            if isinstance(association, aws_ec2.CfnSubnetRouteTableAssociation):
+                if stack.resolve(association.route_table_id) in [stack.resolve(rt) for rt in private_route_tables]:
+                    private_subnets.append(association.subnet_id)
+
+        self.s3_gateway_condition = CfnCondition(
+            self,
+            "S3GatewayCondition",
+            expression=self._and_vpc_created(vpc_created_condition, self.s3_gateway_param)
+        )
+        self.s3_gateway_condition.override_logical_id(f"{id}S3GatewayCondition")
+        self.interface_condition = CfnCondition(
+            self,
+            "InterfaceCondition",
+            expression=self._and_vpc_created(vpc_created_condition, self.interface_param)
+        )
+        self.interface_condition.override_logical_id(f"{id}InterfaceCondition")
+
+        self.s3_gateway_endpoint = aws_ec2.CfnVPCEndpoint(
+            self,
+            "S3GatewayEndpoint",
+            route_table_ids=private_route_tables,
+            service_name=f"com.amazonaws.{Aws.REGION}.s3",
+            vpc_endpoint_type="Gateway",
+            vpc_id=cfn_vpc.ref
+        )
+        self.s3_gateway_endpoint.cfn_options.condition = self.s3_gateway_condition
+        self.s3_gateway_endpoint.override_logical_id(f"{id}S3GatewayEndpoint")
+
+        self.sg = aws_ec2.CfnSecurityGroup(
+            self,
+            "InterfaceSg",
+            group_description=f"{Aws.STACK_NAME} VPC interface endpoints",
+            security_group_ingress=[
+                aws_ec2.CfnSecurityGroup.IngressProperty(
+                    cidr_ip=cfn_vpc.attr_cidr_block,
+                    description="HTTPS from the VPC",
+                    from_port=443,
+                    ip_protocol="tcp",
+                    to_port=443
+                )
+            ],
+            vpc_id=cfn_vpc.ref
+        )
+        self.sg.cfn_options.condition = self.interface_condition
+        self.sg.override_logical_id(f"{id}InterfaceSg")
+
+        self.interface_endpoints = []
+        for name, service in INTERFACE_ENDPOINT_SERVICES.items():
+            endpoint = aws_ec2.CfnVPCEndpoint(
+                self,
+                f"{name}Endpoint",
+                private_dns_enabled=True,
+                security_group_ids=[self.sg.ref],
+                service_name=f"com.amazonaws.{Aws.REGION}.{service}",
+                subnet_ids=private_subnets,
+                vpc_endpoint_type="Interface",
+                vpc_id=cfn_vpc.ref
+            )
+            endpoint.cfn_options.condition = self.interface_condition
+            endpoint.override_logical_id(f"{id}{name}Endpoint")
+            self.interface_endpoints.append(endpoint)
+
+    def _and_vpc_created(self, vpc_created_condition, param):
+        enabled = Fn.condition_equals(param.value, "true")
+        if vpc_created_condition is None:
+            return enabled
+        return Fn.condition_and(vpc_created_condition, enabled)
+
+    def metadata_parameter_group(self):
+        return [
+            {
+                "Label": {
+                    "default": "VPC Endpoints"
+                },
+                "Parameters": [
+                    self.s3_gateway_param.logical_id,
+                    self.interface_param.logical_id
+                ]
+            }
+        ]
+
+    def metadata_parameter_labels(self):
+        return {
+            self.s3_gateway_param.logical_id: {
+                "default": "Create S3 Gateway Endpoint"
+            },
+            self.interface_param.logical_id: {
+                "default": "Create AWS API Interface Endpoints"
+            }
+        }
@@ -1,19 +1,317 @@
-# from aws_cdk import (
-#         core,
-#         assertions
-#     )
+"""
+Synth tests for MastodonStack.
 
-# from mastodon.mastodon_stack import MastodonStack
+The stack is synthesized once for the module. Besides checking the resources
+this repo adds, the tests keep the template and the launch template user data
+under budgets set below the CloudFormation and EC2 limits, so growth that
+would slow down or break deploys fails here first.
 
+The resource snapshot lists every logical ID and type, and is committed
+with the code; the test fails when it is missing. After an intended change,
+regenerate it with:
 
-# example tests. To run these tests, uncomment this file along with the example
-# resource in mastodon/mastodon_stack.py
-def test_sqs_queue_created():
-#     app = core.App()
-#     stack = MastodonStack(app, "mastodon")
-#     template = assertions.Template.from_stack(stack)
+    UPDATE_SNAPSHOTS=1 pytest tests/unit
+"""
 
-#     template.has_resource_properties("AWS::SQS::Queue", {
-#         "VisibilityTimeout": 300
-#     })
-  pass
+import json
+import os
+import re
+import time
+from pathlib import Path
+
+import aws_cdk as cdk
+import pytest
+from aws_cdk import assertions
+
+from mastodon.mastodon_stack import MastodonStack
+
+CDK_DIR = Path(__file__).resolve().parents[2]
+SNAPSHOT_FILE = Path(__file__).resolve().parent / "snapshots" / "mastodon_stack_resources.json"
+
+# EC2 rejects user data over 16 KB before base64 encoding
+USER_DATA_LIMIT = 16 * 1024
+USER_DATA_BUDGET = 14 * 1024
+# templates deployed from S3, as Marketplace does, are limited to 1 MB
+TEMPLATE_LIMIT = 1024 * 1024
+TEMPLATE_BUDGET = 800 * 1024
+RESOURCE_LIMIT = 500
+RESOURCE_BUDGET = 400
+PARAMETER_LIMIT = 200
+PARAMETER_BUDGET = 180
+SYNTH_BUDGET_SECONDS = 60
+# CloudFormation limit on inline (ZipFile) function code, which the canary uses
+INLINE_CODE_LIMIT = 32 * 1024
+
+# longest values a deployment can substitute for ${...} in user data
+PLACEHOLDER_LENGTHS = {
+    "AWS::AccountId": 12,
+    "AWS::Partition": 10,
+    "AWS::Region": 14,
+    "AWS::StackName": 128,
+    "AWS::URLSuffix": 13,
+    "AsgAppLogGroup": 160,
+    "AsgSystemLogGroup": 160,
+    "AssetsBucketName": 63,
+    "DbCluster.Endpoint.Address": 120,
+    "DbCluster.Endpoint.Port": 5,
+    "DbSecretArn": 220,
+    "HostedZoneName": 253,
+    "Hostname": 253,
+    "InstanceSecretName": 149,
+    "Name": 128,
+    "OpenSearchServiceDomain.DomainEndpoint": 100,
+    "RedisCluster.RedisEndpoint.Address": 120,
+    "RedisCluster.RedisEndpoint.Port": 5,
+}
+# anything else, such as a generated name or ARN including the stack name
+DEFAULT_PLACEHOLDER_LENGTH = 200
+
+
+@pytest.fixture(scope="module")
+def synth(tmp_path_factory):
+    # the stack reads mastodon/user_data.sh relative to the cdk directory
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(CDK_DIR)
+        start = time.monotonic()
+        app = cdk.App(outdir=str(tmp_path_factory.mktemp("cdk.out")))
+        stack = MastodonStack(
+            app,
+            "oe-patterns-mastodon-test",
+            env=cdk.Environment(account="992593896645", region="us-east-1"),
+            synthesizer=cdk.DefaultStackSynthesizer(generate_bootstrap_version_rule=False)
+        )
+        artifact = app.synth().get_stack_by_name(stack.stack_name)
+        seconds = time.monotonic() - start
+    template_path = Path(artifact.assembly.directory) / artifact.template_file
+    return {
+        "seconds": seconds,
+        "template": artifact.template,
+        "template_bytes": template_path.stat().st_size
+    }
+
+
+@pytest.fixture(scope="module")
+def template(synth):
+    return assertions.Template.from_json(synth["template"])
+
+
+def sub_length(value: str) -> int:
+    escaped = value.count("${!")
+    value = value.replace("${!", "")
+    placeholders = re.findall(r"\$\{([^}]+)\}", value)
+    literal = re.sub(r"\$\{[^}]+\}", "", value)
+    return len(literal) + escaped * 2 + sum(PLACEHOLDER_LENGTHS.get(name, DEFAULT_PLACEHOLDER_LENGTH) for name in placeholders)
+
+
+def rendered_length(value) -> int:
+    """Longest the value can be once CloudFormation resolves it, before base64 encoding."""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict) and len(value) == 1:
+        (function, args), = value.items()
+        if function == "Fn::Base64":
+            return rendered_length(args)
+        if function == "Fn::Sub":
+            return sub_length(args[0] if isinstance(args, list) else args)
+        if function == "Fn::Join":
+            separator, parts = args
+            return len(separator) * max(len(parts) - 1, 0) + sum(rendered_length(part) for part in parts)
+    return DEFAULT_PLACEHOLDER_LENGTH
+
+
+def find_user_data(value, path=""):
+    if isinstance(value, dict):
+        for key, child in value.items():
+            if key == "UserData":
+                yield path, child
+            else:
+                yield from find_user_data(child, f"{path}.{key}" if path else key)
+    elif isinstance(value, list):
+        for i, child in enumerate(value):
+            yield from find_user_data(child, f"{path}[{i}]")
+
+
+def test_rendered_length():
+    assert rendered_length({"Fn::Base64": "echo hi"}) == 7
+    assert rendered_length({"Fn::Sub": "${AWS::Region} ${Unknown} ${!Literal}"}) == 14 + 1 + DEFAULT_PLACEHOLDER_LENGTH + 1 + 10
+    assert rendered_length({"Fn::Sub": ["${Hostname}", {"Hostname": {"Ref": "DnsHostname"}}]}) == 253
+    assert rendered_length({"Fn::Join": ["-", ["a", {"Ref": "AWS::Region"}]]}) == 2 + DEFAULT_PLACEHOLDER_LENGTH
+
+
+def test_synth_time(synth, record_property):
+    record_property("synth_seconds", round(synth["seconds"], 2))
+    assert synth["seconds"] < SYNTH_BUDGET_SECONDS, \
+        f"MastodonStack took {synth['seconds']:.1f}s to synthesize, budget is {SYNTH_BUDGET_SECONDS}s"
+
+
+def test_template_size(synth, record_property):
+    size = synth["template_bytes"]
+    record_property("template_bytes", size)
+    assert size < TEMPLATE_BUDGET, \
+        f"template is {size} bytes, budget is {TEMPLATE_BUDGET} (CloudFormation limit {TEMPLATE_LIMIT})"
+
+
+def test_template_counts(synth):
+    resources = len(synth["template"]["Resources"])
+    parameters = len(synth["template"].get("Parameters", {}))
+    assert resources < RESOURCE_BUDGET, \
+        f"template has {resources} resources, budget is {RESOURCE_BUDGET} (CloudFormation limit {RESOURCE_LIMIT})"
+    assert parameters < PARAMETER_BUDGET, \
+        f"template has {parameters} parameters, budget is {PARAMETER_BUDGET} (CloudFormation limit {PARAMETER_LIMIT})"
+
+
+def test_user_data_size(synth, record_property):
+    user_data = dict(find_user_data(synth["template"]["Resources"]))
+    assert user_data, "no UserData found in the template"
+    for path, value in user_data.items():
+        size = rendered_length(value)
+        record_property(f"user_data_bytes {path}", size)
+        assert size < USER_DATA_BUDGET, \
+            f"{path} renders to up to {size} bytes, budget is {USER_DATA_BUDGET} (EC2 limit {USER_DATA_LIMIT})"
+
+
+def test_user_data_variables(synth):
+    # an unresolvable ${Name} in user_data.sh only fails when the stack is deployed
+    template = synth["template"]
+    known = set(template.get("Parameters", {})) | set(template["Resources"])
+    for path, value in find_user_data(template["Resources"]):
+        body = value.get("Fn::Base64", {}).get("Fn::Sub") if isinstance(value, dict) else None
+        if body is None:
+            continue
+        string, variables = body if isinstance(body, list) else (body, {})
+        for name in set(re.findall(r"\$\{([^!}][^}]*)\}", string)):
+            assert name.startswith("AWS::") or name in variables or name.split(".")[0] in known, \
+                f"{path} references unknown ${{{name}}}"
+
+
+def test_sidekiq_environment_matches_env_production(template):
+    # the Fargate tasks get by environment and secrets what user_data.sh writes to .env.production
+    user_data = (CDK_DIR / "mastodon" / "user_data.sh").read_text()
+    env_production = re.search(r"cat <<EOF > /home/mastodon/live/\.env\.production\n(.*?)\nEOF\n", user_data, re.S).group(1)
+    env_keys = set(re.findall(r"^([A-Za-z_]+)=", env_production, re.M))
+    container = next(iter(template.find_resources("AWS::ECS::TaskDefinition", {
+        "Properties": {"Family": {"Fn::Join": ["", [assertions.Match.any_value(), "-sidekiq"]]}}
+    }).values()))["Properties"]["ContainerDefinitions"][0]
+    task_keys = {pair["Name"] for pair in container["Environment"]} | \
+        {secret["Name"] for secret in container["Secrets"] if "Name" in secret}
+    # task sizing, and the proxy settings mastodon-egress-proxy-setup adds on the instances
+    task_only = {"DB_POOL", "SIDEKIQ_CONCURRENCY", "http_proxy", "no_proxy"}
+    assert task_keys - task_only == env_keys
+
+
+def test_resource_snapshot(synth):
+    resources = {logical_id: resource["Type"] for logical_id, resource in sorted(synth["template"]["Resources"].items())}
+    if os.environ.get("UPDATE_SNAPSHOTS"):
+        SNAPSHOT_FILE.parent.mkdir(exist_ok=True)
+        SNAPSHOT_FILE.write_text(json.dumps(resources, indent=2) + "\n")
+        pytest.skip(f"wrote {SNAPSHOT_FILE.name}, review and commit it")
+    assert SNAPSHOT_FILE.exists(), \
+        f"{SNAPSHOT_FILE.name} is missing; generate it with UPDATE_SNAPSHOTS=1 (make update-cdk-snapshot) and commit it"
+    expected = json.loads(SNAPSHOT_FILE.read_text())
+    added = sorted(set(resources) - set(expected))
+    removed = sorted(set(expected) - set(resources))
+    changed = sorted(k for k in set(resources) & set(expected) if resources[k] != expected[k])
+    assert not (added or removed or changed), \
+        f"resources changed, added {added}, removed {removed}, type changed {changed}; " \
+        "run with UPDATE_SNAPSHOTS=1 if intended"
+
+
+def test_dashboard_and_alarm_topic(template):
+    template.resource_count_is("AWS::CloudWatch::Dashboard", 1)
+    template.has_resource("AWS::SNS::Topic", {})
+    template.has_output("DashboardUrlOutput", {})
+
+
+def test_performance_insights(template):
+    instances = template.find_resources("AWS::RDS::DBInstance")
+    assert instances
+    for instance in instances.values():
+        assert instance["Properties"]["EnablePerformanceInsights"] is True
+
+
+def test_tunable_db_parameters(template):
+    template.has_resource_properties("AWS::RDS::DBClusterParameterGroup", {
+        "Parameters": assertions.Match.object_like({
+            "work_mem": {"Ref": "DbParameterGroupsWorkMem"},
+            "random_page_cost": {"Ref": "DbParameterGroupsRandomPageCost"},
+            "autovacuum_vacuum_scale_factor": {"Ref": "DbParameterGroupsAutovacuumVacuumScaleFactor"},
+            "autovacuum_analyze_scale_factor": {"Ref": "DbParameterGroupsAutovacuumAnalyzeScaleFactor"}
+        })
+    })
+
+
+def test_cache_expiration_spares_avatars_and_emoji(template):
+    prefixes = [
+        rule.get("Fn::If", [None, rule])[1].get("Prefix")
+        for bucket in template.find_resources("AWS::S3::Bucket").values()
+        for rule in bucket["Properties"].get("LifecycleConfiguration", {}).get("Rules", [])
+    ]
+    assert "cache/media_attachments/" in prefixes
+    assert "cache/" not in prefixes
+
+
+def test_optional_resources_are_conditional(template):
+    conditions = {
+        "CanaryVpcFunction": "CanaryEnabledCondition",
+        "CanaryInternetFunction": "CanaryEnabledCondition",
+        "CanaryHealthAlarm": "CanaryEnabledCondition",
+        "EgressProxyNlb": "EgressProxyEnabledCondition",
+        "EgressProxyService": "EgressProxyEnabledCondition",
+        "MediaWorkersAsg": "MediaWorkersEnabledCondition",
+        "SidekiqServiceService": "SidekiqServiceEnabledCondition",
+    }
+    resources = template.to_json()["Resources"]
+    for logical_id, condition in conditions.items():
+        assert resources[logical_id]["Condition"] == condition
+    for parameter in ("CanaryEnabled", "EgressProxyEnabled", "MediaWorkersEnabled", "SidekiqServiceEnabled"):
+        template.has_parameter(parameter, {"Default": "false"})
+
+
+def test_inline_function_code(template):
+    functions = template.find_resources("AWS::Lambda::Function")
+    assert {"CanaryVpcFunction", "CanaryInternetFunction"} <= set(functions)
+    assert "def handler(event, context)" in functions["CanaryVpcFunction"]["Properties"]["Code"]["ZipFile"]
+    for logical_id, function in functions.items():
+        code = function["Properties"]["Code"].get("ZipFile")
+        if code is not None:
+            assert len(code) < INLINE_CODE_LIMIT, f"{logical_id} inline code is {len(code)} characters"
+
+
+def test_streaming_drain(template):
+    template.has_resource_properties("AWS::AutoScaling::LifecycleHook", {
+        "LifecycleHookName": "streaming-drain",
+        "LifecycleTransition": "autoscaling:EC2_INSTANCE_TERMINATING"
+    })
+    template.has_resource_properties("AWS::ElasticLoadBalancingV2::TargetGroup", {
+        "TargetGroupAttributes": assertions.Match.array_with([
+            {"Key": "deregistration_delay.timeout_seconds", "Value": {"Ref": "StreamingDrainSeconds"}}
+        ])
+    })
+    template.has_resource_properties("AWS::ElasticLoadBalancingV2::LoadBalancer", {
+        "LoadBalancerAttributes": assertions.Match.array_with([
+            {"Key": "idle_timeout.timeout_seconds", "Value": {"Ref": "StreamingDrainIdleTimeout"}}
+        ])
+    })
+
+
+def test_egress_proxy(template):
+    resources = template.to_json()["Resources"]
+    # instances depend on these at boot, so they exist whether or not the proxy is enabled
+    for logical_id in ("EgressProxyUrlParameter", "EgressProxyInstancePolicy"):
+        assert "Condition" not in resources[logical_id]
+        assert logical_id in resources["Asg"]["DependsOn"]
+    filters = template.find_resources("AWS::Logs::MetricFilter")
+    names = {
+        transformation["MetricName"]
+        for metric_filter in filters.values()
+        for transformation in metric_filter["Properties"]["MetricTransformations"]
+    }
+    assert {"EgressProxyHits", "EgressProxyMisses", "EgressProxyHitBytes", "EgressProxyBytes"} <= names
+    # squid only serves clients in the VPC, whether the stack creates it or not
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "ContainerDefinitions": [assertions.Match.object_like({
+            "Environment": assertions.Match.array_with([
+                {"Name": "VPC_CIDR", "Value": {"Fn::If": [assertions.Match.any_value(), {"Fn::GetAtt": [assertions.Match.any_value(), "CidrBlock"]}, {"Ref": "EgressProxyVpcCidr"}]}}
+            ])
+        })]
+    })
@@ -0,0 +1,112 @@
+#!/bin/bash
+#
+# Entrypoint of the egress proxy container image: Squid as a caching forward
+# proxy for Mastodon's outbound HTTP. Configuration comes from the environment
+# (the ECS task definition, or docker-compose.yml locally).
+#
+#   CA_CERTIFICATE, CA_PRIVATE_KEY   PEM CA that signs the certificates presented for HTTPS
+#   MAX_OBJECT_SIZE_MB               largest response cached (default 64)
+#   MEDIA_TTL_MINUTES                longest media without explicit freshness is cached (default 1440)
+#   CACHE_SIZE_MB                    disk cache size (default 15000, within Fargate's 20 GiB)
+#   STACK_NAME                       first field of each access log line, for the metric filters
+#   VPC_CIDR                         clients allowed to use the proxy (required)
+#
+#   squid        run squid in the foreground
+#   smoke-test   start squid with a throwaway CA and check that it refuses private destinations
+#
+set -e
+
+SSL_DB=/var/lib/squid/ssl_db
+
+configure() {
+  mkdir -p /etc/squid/ssl
+  printf '%s\n%s\n' "$CA_CERTIFICATE" "$CA_PRIVATE_KEY" > /etc/squid/ssl/ca.pem
+  chmod 600 /etc/squid/ssl/ca.pem
+  chown -R proxy:proxy /etc/squid/ssl
+
+  cat <<EOF > /etc/squid/squid.conf
+http_port 3128 ssl-bump tls-cert=/etc/squid/ssl/ca.pem generate-host-certificates=on dynamic_cert_mem_cache_size=16MB
+sslcrtd_program /usr/lib/squid/security_file_certgen -s $SSL_DB -M 64MB
+tls_outgoing_options cafile=/etc/ssl/certs/ca-certificates.crt
+acl step1 at_step SslBump1
+ssl_bump peek step1
+ssl_bump bump all
+
+# Mastodon skips its private address check when it uses a proxy, so refuse them here
+acl private_dst dst 0.0.0.0/8 10.0.0.0/8 100.64.0.0/10 127.0.0.0/8 169.254.0.0/16 172.16.0.0/12 192.168.0.0/16 ::1 fc00::/7 fe80::/10
+acl clients src ${VPC_CIDR:?VPC_CIDR is required} 127.0.0.1
+acl safe_ports port 80 443
+http_access deny !safe_ports
+http_access deny CONNECT !safe_ports
+http_access deny private_dst
+http_access allow clients
+http_access deny all
+
+cache_mem 256 MB
+maximum_object_size_in_memory 1 MB
+maximum_object_size ${MAX_OBJECT_SIZE_MB:-64} MB
+cache_dir ufs /var/spool/squid ${CACHE_SIZE_MB:-15000} 16 256
+# freshness comes from Cache-Control and Expires; these only apply to responses without them
+refresh_pattern -i \.(avif|gif|heic|jpe?g|png|webp|flac|m4a|mp3|oga|ogg|opus|wav|m4v|mov|mp4|webm)(\?.*)?$ 0 20% ${MEDIA_TTL_MINUTES:-1440}
+refresh_pattern . 0 20% 60
+
+# fields match ACCESS_LOG_FIELDS in cdk/mastodon/egress_proxy.py
+logformat mastodon ${STACK_NAME:-local} %ts %Ss %>Hs %<st %rm %>rd
+access_log daemon:/var/log/squid/access.log mastodon
+cache_log /var/log/squid/cache.log
+logfile_rotate 1
+via off
+forwarded_for delete
+httpd_suppress_version_string on
+shutdown_lifetime 20 seconds
+pid_filename /run/squid.pid
+coredump_dir /var/spool/squid
+EOF
+
+  rm -rf $SSL_DB
+  /usr/lib/squid/security_file_certgen -c -s $SSL_DB -M 64MB
+  chown -R proxy:proxy $SSL_DB /var/spool/squid /var/log/squid
+  squid -k parse -f /etc/squid/squid.conf
+  squid -z -N -f /etc/squid/squid.conf
+}
+
+start() {
+  : > /var/log/squid/access.log
+  : > /var/log/squid/cache.log
+  chown proxy:proxy /var/log/squid/access.log /var/log/squid/cache.log
+  tail -qF /var/log/squid/access.log /var/log/squid/cache.log &
+  # keep the log files small; tail -F follows the rotation
+  (while sleep 3600; do squid -k rotate; done) &
+  squid -N -f /etc/squid/squid.conf &
+  SQUID=$!
+  trap 'squid -k shutdown' TERM INT
+  wait $SQUID || wait $SQUID
+}
+
+case "$1" in
+  squid)
+    configure
+    start
+    ;;
+  smoke-test)
+    openssl req -x509 -new -nodes -newkey rsa:2048 -days 1 -subj "/CN=smoke-test egress proxy CA" \
+      -keyout /tmp/ca.key -out /tmp/ca.crt 2>/dev/null
+    CA_CERTIFICATE=$(cat /tmp/ca.crt) CA_PRIVATE_KEY=$(cat /tmp/ca.key) VPC_CIDR=${VPC_CIDR:-10.0.0.0/16} configure
+    start &
+    for i in $(seq 1 30); do
+      curl -s -o /dev/null http://127.0.0.1:3128/ && break
+      sleep 1
+    done
+    for URL in http://169.254.169.254/latest/meta-data/ http://10.0.0.1/ http://127.0.0.1:8080/; do
+      STATUS=$(curl -s -o /dev/null -w '%{http_code}' -x http://127.0.0.1:3128 "$URL" || true)
+      if [ "$STATUS" != "403" ]; then
+        echo "expected the proxy to refuse $URL with 403, got $STATUS"
+        exit 1
+      fi
+    done
+    echo "squid started and refused private destinations"
+    ;;
+  *)
+    exec "$@"
+    ;;
+esac
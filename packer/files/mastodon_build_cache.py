@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Layered build cache for the Mastodon AMI build.
+
+ubuntu_2404_appinstall.sh saves the slow build steps as gzipped tarballs and
+restores them on later builds:
+
+    ruby     the compiled Ruby, keyed by Ruby version, OS release and architecture
+    gems     vendor/bundle, keyed by Gemfile.lock and the Ruby key
+    node     node_modules, keyed by yarn.lock and the Node.js major version
+    assets   precompiled assets, keyed by the Mastodon git commit and the node key
+
+BUILD_CACHE is the cache location, either s3://bucket/prefix or a local
+directory. When it is unset every restore misses and nothing is saved, so the
+build runs from scratch. S3 is accessed with the AWS CLI, using the build
+instance's credentials.
+
+Usage (exit status 1 on a miss):
+    mastodon_build_cache.py key ruby 3.4.7 noble x86_64
+    mastodon_build_cache.py key gems Gemfile.lock <ruby key>
+    mastodon_build_cache.py restore gems <key> --dir /home/mastodon/live
+    mastodon_build_cache.py save gems <key> --dir /home/mastodon/live vendor/bundle
+
+Only used while building the AMI; it is not installed into it.
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import List, Optional
+
+LAYERS = ("ruby", "gems", "node", "assets")
+
+
+def cache_key(layer: str, parts: List[str]) -> str:
+    """Hash of the parts, reading the contents of any part that is an existing file."""
+    digest = hashlib.sha256(layer.encode())
+    for part in parts:
+        path = Path(part)
+        digest.update(b"\0")
+        digest.update(path.read_bytes() if path.is_file() else part.encode())
+    return digest.hexdigest()[:24]
+
+
+def object_name(layer: str, key: str) -> str:
+    return f"{layer}-{key}.tar.gz"
+
+
+def cache_location() -> Optional[str]:
+    return os.environ.get("BUILD_CACHE") or None
+
+
+def fetch(location: str, name: str, dest: Path) -> bool:
+    if location.startswith("s3://"):
+        if not shutil.which("aws"):
+            print("aws CLI not found, skipping the S3 build cache", file=sys.stderr)
+            return False
+        url = f"{location.rstrip('/')}/{name}"
+        exists = subprocess.run(["aws", "s3", "ls", url], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if exists.returncode != 0:
+            return False
+        subprocess.run(["aws", "s3", "cp", "--only-show-errors", url, str(dest)], check=True)
+        return True
+    source = Path(location) / name
+    if not source.is_file():
+        return False
+    shutil.copyfile(source, dest)
+    return True
+
+
+def store(location: str, name: str, source: Path) -> None:
+    if location.startswith("s3://"):
+        if not shutil.which("aws"):
+            print("aws CLI not found, skipping the S3 build cache", file=sys.stderr)
+            return
+        subprocess.run(["aws", "s3", "cp", "--only-show-errors", str(source), f"{location.rstrip('/')}/{name}"], check=True)
+        return
+    directory = Path(location)
+    directory.mkdir(parents=True, exist_ok=True)
+    # copy then rename, so a concurrent or interrupted build never restores half a tarball
+    partial = directory / f".{name}.{os.getpid()}"
+    shutil.copyfile(source, partial)
+    os.replace(partial, directory / name)
+
+
+def restore(layer: str, key: str, directory: Path, location: Optional[str] = None) -> bool:
+    location = location or cache_location()
+    if not location:
+        return False
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = Path(tmp) / object_name(layer, key)
+        if not fetch(location, archive.name, archive):
+            print(f"build cache miss: {layer} {key}")
+            return False
+        directory.mkdir(parents=True, exist_ok=True)
+        subprocess.run(["tar", "-xzf", str(archive), "-C", str(directory)], check=True)
+    print(f"build cache hit: {layer} {key}")
+    return True
+
+
+def save(layer: str, key: str, directory: Path, paths: List[str], location: Optional[str] = None) -> bool:
+    location = location or cache_location()
+    if not location:
+        return False
+    existing = [path for path in paths if (directory / path).exists()]
+    if not existing:
+        print(f"nothing to save for {layer}: none of {' '.join(paths)} exist in {directory}", file=sys.stderr)
+        return False
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = Path(tmp) / object_name(layer, key)
+        subprocess.run(["tar", "-czf", str(archive), "-C", str(directory), *existing], check=True)
+        store(location, archive.name, archive)
+    print(f"build cache saved: {layer} {key}")
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Restore and save layers of the Mastodon AMI build")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    key_parser = commands.add_parser("key", help="Print the cache key for a layer")
+    key_parser.add_argument("layer", choices=LAYERS)
+    key_parser.add_argument("parts", nargs="+", help="Files whose contents, or strings, the layer depends on")
+
+    for name in ("restore", "save"):
+        command = commands.add_parser(name)
+        command.add_argument("layer", choices=LAYERS)
+        command.add_argument("key")
+        command.add_argument("--dir", type=Path, required=True, help="Directory the layer's paths are relative to")
+        if name == "save":
+            command.add_argument("paths", nargs="+")
+
+    args = parser.parse_args(argv)
+    if args.command == "key":
+        print(cache_key(args.layer, args.parts))
+        return 0
+    try:
+        if args.command == "restore":
+            return 0 if restore(args.layer, args.key, args.dir) else 1
+        save(args.layer, args.key, args.dir, args.paths)
+    except subprocess.CalledProcessError as e:
+        # a broken cache only makes the build slower: restore misses and save is skipped
+        print(f"build cache {args.command} failed for {args.layer}: {e}", file=sys.stderr)
+        return 1 if args.command == "restore" else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Live configuration agent for the Mastodon AMI.
+
+Polls the SSM Parameter Store path /<stack name>/config/ where each parameter
+is one Mastodon environment variable, e.g. /mastodon-prod/config/MAX_THREADS.
+When the set of values changes it re-renders a managed block at the end of
+.env.production plus /etc/mastodon/tunables.env (read by the systemd units)
+and restarts the services in place, without replacing the instance:
+
+  * Puma gets USR1. With preload_app that is a hot restart: the listening
+    socket is kept, so requests queue briefly instead of failing, and
+    config/puma.rb overloads .env.production so new thread counts apply.
+  * Sidekiq is quieted (TSTP) so it stops fetching jobs, given time to
+    finish running ones, then restarted.
+  * Streaming is restarted only when a STREAMING_* value changed, since it
+    drops websocket connections.
+
+Installed in the AMI as /usr/local/bin/mastodon-config-agent.
+"""
+
+import argparse
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+ENV_FILE = "/home/mastodon/live/.env.production"
+TUNABLES_FILE = "/etc/mastodon/tunables.env"
+STACK_NAME_FILE = "/opt/oe/patterns/stack-name.txt"
+
+BLOCK_BEGIN = "# BEGIN mastodon-config-agent (managed, edit in SSM Parameter Store)"
+BLOCK_END = "# END mastodon-config-agent"
+NAME_PATTERN = re.compile(r"^[A-Z][A-Z0-9_]*$")
+# double-quoted values as understood by both dotenv and systemd EnvironmentFile
+ESCAPES = {"\\": "\\\\", '"': '\\"', "\n": "\\n"}
+UNESCAPES = {"\\": "\\", '"': '"', "n": "\n"}
+
+
+def parameters_to_values(parameters: List[Dict], path: str) -> Dict[str, str]:
+    """Map SSM parameters under path to environment variables, skipping invalid names and nested paths."""
+    values = {}
+    for parameter in parameters:
+        name = parameter["Name"][len(path):]
+        if not NAME_PATTERN.match(name):
+            print(f"ignoring {parameter['Name']}: not a valid environment variable name", file=sys.stderr)
+            continue
+        values[name] = parameter["Value"]
+    return values
+
+
+def quote(value: str) -> str:
+    return '"' + "".join(ESCAPES.get(c, c) for c in value) + '"'
+
+
+def unquote(value: str) -> str:
+    return re.sub(r'\\(.)', lambda m: UNESCAPES.get(m.group(1), m.group(1)), value[1:-1])
+
+
+def render_block(values: Dict[str, str]) -> str:
+    lines = [BLOCK_BEGIN] + [f"{name}={quote(values[name])}" for name in sorted(values)] + [BLOCK_END]
+    return "\n".join(lines) + "\n"
+
+
+def split_env(text: str) -> Tuple[str, Dict[str, str]]:
+    """Return the env file without the managed block, and the values in the block."""
+    values = {}
+    if BLOCK_BEGIN not in text:
+        return text, values
+    before, rest = text.split(BLOCK_BEGIN, 1)
+    block, _, after = rest.partition(BLOCK_END)
+    for line in block.strip().splitlines():
+        name, _, value = line.partition("=")
+        values[name] = unquote(value)
+    return before + after.lstrip("\n"), values
+
+
+def render_env(text: str, values: Dict[str, str]) -> str:
+    """Replace the managed block; it goes last so its values win over the ones rendered by user_data."""
+    base, _ = split_env(text)
+    if not values:
+        return base
+    return base.rstrip("\n") + "\n" + render_block(values)
+
+
+def changed_names(old: Dict[str, str], new: Dict[str, str]) -> Set[str]:
+    return {name for name in set(old) | set(new) if old.get(name) != new.get(name)}
+
+
+def services_to_restart(old: Dict[str, str], new: Dict[str, str]) -> List[str]:
+    changed = changed_names(old, new)
+    if not changed:
+        return []
+    services = ["mastodon-web", "mastodon-sidekiq"]
+    if any(name.startswith("STREAMING_") for name in changed):
+        services.append("mastodon-streaming")
+    return services
+
+
+def write_atomic(path: str, content: str) -> None:
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    if os.path.exists(path):
+        stat = os.stat(path)
+        os.chmod(tmp, stat.st_mode & 0o777)
+        os.chown(tmp, stat.st_uid, stat.st_gid)
+    os.replace(tmp, path)
+
+
+def fetch_values(path: str, region: str = None) -> Dict[str, str]:
+    import boto3
+
+    client = boto3.client("ssm", region_name=region)
+    parameters = []
+    for page in client.get_paginator("get_parameters_by_path").paginate(Path=path, WithDecryption=True):
+        parameters += page["Parameters"]
+    return parameters_to_values(parameters, path)
+
+
+def is_active(service: str) -> bool:
+    return subprocess.run(["systemctl", "is-active", "--quiet", service]).returncode == 0
+
+
+def restart(services: List[str], quiet_seconds: int) -> None:
+    for service in services:
+        if not is_active(service):
+            continue
+        print(f"restarting {service}")
+        if service == "mastodon-web":
+            subprocess.run(["systemctl", "kill", "--kill-who=main", "--signal=USR1", service], check=True)
+        elif service == "mastodon-sidekiq":
+            subprocess.run(["systemctl", "kill", "--kill-who=main", "--signal=TSTP", service], check=True)
+            time.sleep(quiet_seconds)
+            subprocess.run(["systemctl", "restart", service], check=True)
+        else:
+            subprocess.run(["systemctl", "restart", service], check=True)
+
+
+def apply(values: Dict[str, str], env_file: str, tunables_file: str, restart_services: bool, quiet_seconds: int) -> bool:
+    text = Path(env_file).read_text()
+    _, current = split_env(text)
+    services = services_to_restart(current, values)
+    if not services:
+        return False
+    print(f"configuration changed: {', '.join(sorted(changed_names(current, values)))}")
+    write_atomic(env_file, render_env(text, values))
+    write_atomic(tunables_file, "".join(f"{name}={quote(values[name])}\n" for name in sorted(values)))
+    if restart_services:
+        restart(services, quiet_seconds)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply Mastodon configuration from SSM Parameter Store without replacing the instance")
+    parser.add_argument("--path", help="Parameter path (default: /<stack name>/config/)")
+    parser.add_argument("--region", help="AWS region (default: from the instance metadata)")
+    parser.add_argument("--env-file", default=ENV_FILE)
+    parser.add_argument("--tunables-file", default=TUNABLES_FILE)
+    parser.add_argument("--interval", type=int, default=60, help="Seconds between polls (default: 60)")
+    parser.add_argument("--jitter", type=int, default=60, help="Max random delay before restarting, so instances restart at different times (default: 60)")
+    parser.add_argument("--quiet-seconds", type=int, default=20, help="Time Sidekiq gets to finish running jobs after TSTP (default: 20)")
+    parser.add_argument("--once", action="store_true", help="Apply once and exit")
+    parser.add_argument("--no-restart", action="store_true", help="Only render the files, e.g. at boot before the services start")
+    args = parser.parse_args(argv)
+
+    path = args.path or f"/{Path(STACK_NAME_FILE).read_text().strip()}/config/"
+    if not path.endswith("/"):
+        path += "/"
+
+    while True:
+        try:
+            values = fetch_values(path, args.region)
+            _, current = split_env(Path(args.env_file).read_text())
+            if services_to_restart(current, values) and not args.once:
+                time.sleep(random.uniform(0, args.jitter))
+            apply(values, args.env_file, args.tunables_file, not args.no_restart, args.quiet_seconds)
+        except Exception as e:
+            print(f"error applying configuration from {path}: {e}", file=sys.stderr)
+            if args.once:
+                return 1
+        if args.once:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+DNS cache metrics for the Mastodon AMI.
+
+Each instance resolves through a local unbound cache in front of the VPC
+resolver, which drops packets above its per-interface rate limit. Run every
+minute from cron as root: reads and resets unbound's counters with
+unbound-control stats and sends them to the CloudWatch agent's statsd
+listener, which publishes them to the CWAgent namespace with the instance
+dimensions. Packets dropped by the VPC resolver's rate limit are collected by
+the agent itself, as ethtool_linklocal_allowance_exceeded.
+
+Installed in the AMI as /usr/local/bin/mastodon-dns-metrics.
+"""
+
+import argparse
+import socket
+import subprocess
+import sys
+from typing import Dict, List
+
+STATSD_ADDRESS = ("127.0.0.1", 8125)
+
+# unbound-control stats counter: statsd counter name
+COUNTERS = {
+    "total.num.queries": "DnsQueries",
+    "total.num.cachehits": "DnsCacheHits",
+    "total.num.cachemiss": "DnsCacheMisses",
+    "total.num.prefetch": "DnsPrefetches",
+    # answered from an expired cache entry because the VPC resolver was slow
+    "total.num.expired": "DnsExpiredAnswers",
+    # the VPC resolver didn't answer, or more queries were waiting than unbound keeps
+    "num.answer.rcode.SERVFAIL": "DnsServfailAnswers",
+    "total.requestlist.exceeded": "DnsRequestListExceeded"
+}
+
+
+def parse_stats(output: str) -> Dict[str, float]:
+    stats = {}
+    for line in output.splitlines():
+        name, _, value = line.partition("=")
+        try:
+            stats[name.strip()] = float(value)
+        except ValueError:
+            continue
+    return stats
+
+
+def statsd_lines(stats: Dict[str, float]) -> List[str]:
+    """Counters since the last reset, and the cache hit rate when there were queries."""
+    lines = [f"{metric}:{int(stats.get(name, 0))}|c" for name, metric in COUNTERS.items()]
+    queries = stats.get("total.num.queries", 0)
+    if queries:
+        lines.append(f"DnsCacheHitPercent:{100 * stats.get('total.num.cachehits', 0) / queries:.1f}|g")
+    return lines
+
+
+def read_stats() -> Dict[str, float]:
+    # statistics-cumulative is off, so this returns the counts since the previous run
+    output = subprocess.run(["unbound-control", "stats"], capture_output=True, text=True, check=True).stdout
+    return parse_stats(output)
+
+
+def send(lines: List[str], address=STATSD_ADDRESS) -> None:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.sendto("\n".join(lines).encode(), address)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send unbound cache statistics to the CloudWatch agent")
+    parser.add_argument("--print", action="store_true", help="Print the statsd lines instead of sending them")
+    args = parser.parse_args(argv)
+
+    try:
+        lines = statsd_lines(read_stats())
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"unbound statistics unavailable: {e}", file=sys.stderr)
+        return 1
+    if args.print:
+        print("\n".join(lines))
+    else:
+        send(lines)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Image processing benchmark for the Mastodon AMI.
+
+Runs the resizes Mastodon does for an uploaded image (the capped original and
+the small preview) through libvips and ImageMagick over a corpus of JPEG, PNG,
+WebP and animated GIF files, and reports throughput and peak RSS for each
+backend. Without --corpus a sample corpus is generated with ImageMagick.
+
+Installed in the AMI as /usr/local/bin/mastodon-image-benchmark.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".gif")
+
+# bounding boxes matching the pixel limits in Mastodon's MediaAttachment::IMAGE_STYLES
+STYLES = {
+    "original": (3840, 2160),
+    "small": (640, 360),
+}
+
+# name, ImageMagick generator, size; frames > 1 makes an animated GIF
+SAMPLES = [
+    ("photo", "plasma:fractal", "4032x3024", 1),
+    ("screenshot", "gradient:white-navy", "2560x1440", 1),
+    ("banner", "plasma:", "1500x500", 1),
+    ("animation", "plasma:", "480x270", 24),
+]
+
+
+def output_path(source: Path, out_dir: Path, style: str) -> Path:
+    # animated GIFs stay GIFs here; Mastodon transcodes them to MP4 with ffmpeg instead
+    suffix = ".gif" if source.suffix.lower() == ".gif" else ".webp" if source.suffix.lower() == ".webp" else ".jpg"
+    return out_dir / f"{source.stem}-{style}{suffix}"
+
+
+def vips_command(source: Path, dest: Path, width: int, height: int) -> List[str]:
+    # n=-1 loads every frame of an animation
+    load = f"{source}[n=-1]" if source.suffix.lower() == ".gif" else str(source)
+    return ["vipsthumbnail", load, "--size", f"{width}x{height}>", "-o", f"{dest}[strip]"]
+
+
+def imagemagick_command(source: Path, dest: Path, width: int, height: int) -> List[str]:
+    if source.suffix.lower() == ".gif":
+        return ["convert", str(source), "-coalesce", "-resize", f"{width}x{height}>", "-layers", "optimize", str(dest)]
+    return ["convert", str(source), "-auto-orient", "-resize", f"{width}x{height}>", "-strip", str(dest)]
+
+
+BACKENDS = {
+    "vips": vips_command,
+    "imagemagick": imagemagick_command,
+}
+
+
+def run_command(argv: List[str]) -> Dict:
+    """Run a command, returning its wall time, peak RSS in KB and exit status."""
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(argv, stdout=subprocess.DEVNULL, stderr=stderr)
+        # wait4 gives the rusage of this child alone, unlike RUSAGE_CHILDREN
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        stderr.seek(0)
+        message = stderr.read().decode(errors="replace").strip()
+    return {
+        "seconds": elapsed,
+        "max_rss_kb": rusage.ru_maxrss,
+        "returncode": os.waitstatus_to_exitcode(status),
+        "stderr": message,
+    }
+
+
+def find_corpus(directory: Path) -> List[Path]:
+    return sorted(p for p in directory.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def generate_corpus(directory: Path) -> List[Path]:
+    """Write a JPEG, PNG and WebP of each still sample plus the animated GIFs using ImageMagick."""
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, generator, size, frames in SAMPLES:
+        if frames > 1:
+            argv = ["convert", "-delay", "8", "-loop", "0"]
+            for i in range(frames):
+                argv += ["-size", size, generator, "-swirl", str(i * 15)]
+            argv.append(str(directory / f"{name}.gif"))
+            subprocess.run(argv, check=True)
+            continue
+        for extension in (".jpg", ".png", ".webp"):
+            subprocess.run(["convert", "-size", size, generator, str(directory / f"{name}{extension}")], check=True)
+    return find_corpus(directory)
+
+
+def benchmark(corpus: List[Path], backends: List[str], repeat: int, out_dir: Path) -> Dict[str, Dict]:
+    """Process every file in every style with each backend and aggregate the results per backend."""
+    results = {}
+    for backend in backends:
+        build = BACKENDS[backend]
+        summary = {"images": 0, "failures": 0, "seconds": 0.0, "max_rss_kb": 0, "by_format": {}}
+        for _ in range(repeat):
+            for source in corpus:
+                for style, (width, height) in STYLES.items():
+                    run = run_command(build(source, output_path(source, out_dir, style), width, height))
+                    if run["returncode"] != 0:
+                        summary["failures"] += 1
+                        print(f"{backend}: {source.name} ({style}) failed: {run['stderr']}", file=sys.stderr)
+                        continue
+                    add_run(summary, source.suffix.lower().lstrip("."), run)
+        results[backend] = finish(summary)
+    return results
+
+
+def add_run(summary: Dict, image_format: str, run: Dict) -> None:
+    summary["images"] += 1
+    summary["seconds"] += run["seconds"]
+    summary["max_rss_kb"] = max(summary["max_rss_kb"], run["max_rss_kb"])
+    by_format = summary["by_format"].setdefault(image_format, {"images": 0, "seconds": 0.0, "max_rss_kb": 0})
+    by_format["images"] += 1
+    by_format["seconds"] += run["seconds"]
+    by_format["max_rss_kb"] = max(by_format["max_rss_kb"], run["max_rss_kb"])
+
+
+def finish(summary: Dict) -> Dict:
+    for stats in [summary] + list(summary["by_format"].values()):
+        stats["images_per_second"] = stats["images"] / stats["seconds"] if stats["seconds"] else 0.0
+    return summary
+
+
+def format_report(results: Dict[str, Dict]) -> str:
+    lines = [f"{'backend':<12} {'format':<8} {'images':>7} {'img/s':>8} {'peak RSS MB':>12}"]
+    for backend, summary in results.items():
+        rows = [("all", summary)] + sorted(summary["by_format"].items())
+        for image_format, stats in rows:
+            lines.append(
+                f"{backend:<12} {image_format:<8} {stats['images']:>7} "
+                f"{stats['images_per_second']:>8.2f} {stats['max_rss_kb'] / 1024:>12.1f}"
+            )
+        if summary["failures"]:
+            lines.append(f"{backend:<12} {'failed':<8} {summary['failures']:>7}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare libvips and ImageMagick throughput and peak memory on Mastodon's image resizes"
+    )
+    parser.add_argument("--corpus", type=Path, help="Directory of JPEG, PNG, WebP and GIF files (default: generate samples)")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), action="append", help="Backend to run; repeat for several (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the corpus per backend (default: 3)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args(argv)
+
+    backends = args.backend or list(BACKENDS)
+    missing = [b for b in backends if not shutil.which(BACKENDS[b](Path("x.jpg"), Path("y.jpg"), 1, 1)[0])]
+    if missing:
+        print(f"Missing tools for: {', '.join(missing)}", file=sys.stderr)
+        return 1
+
+    with tempfile.TemporaryDirectory(prefix="mastodon-image-benchmark-") as work_dir:
+        corpus = find_corpus(args.corpus) if args.corpus else generate_corpus(Path(work_dir) / "corpus")
+        if not corpus:
+            print(f"No images found in {args.corpus}", file=sys.stderr)
+            return 1
+        out_dir = Path(work_dir) / "out"
+        out_dir.mkdir()
+        results = benchmark(corpus, backends, args.repeat, out_dir)
+
+    print(json.dumps(results, indent=2) if args.json else format_report(results))
+    return 1 if any(r["failures"] for r in results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
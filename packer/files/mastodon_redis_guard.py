@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Redis memory guard for the Mastodon AMI.
+
+The stack's Redis runs with maxmemory-policy noeviction, so when used_memory
+reaches maxmemory every write fails, including Sidekiq enqueues and home feed
+inserts. Run every minute from cron as root, this compares used_memory to
+maxmemory and frees memory in stages:
+
+  1. trim feeds: home feeds not read or written for REDIS_GUARD_INACTIVE_DAYS
+     are deleted. Mastodon stops delivering to the feeds of inactive users,
+     and regenerates a feed when its user comes back.
+  2. clear cache: the Rails cache namespace (cache:*) is deleted.
+
+Once usage is back below the recovery threshold after an incident, feeds are
+rebuilt with tootctl feeds build, so active users whose feeds were trimmed get
+them back. Each action is published to CloudWatch as Mastodon/RedisGuardAction
+and Mastodon/RedisGuardKeysRemoved.
+
+Thresholds are read from .env.production, so they can be changed through
+mastodon-config-agent:
+
+    REDIS_GUARD_TRIM_FEEDS_PERCENT    default 85
+    REDIS_GUARD_CLEAR_CACHE_PERCENT   default 92
+    REDIS_GUARD_RECOVER_PERCENT       default 70
+    REDIS_GUARD_INACTIVE_DAYS         default 7
+    REDIS_GUARD_BUILD_CONCURRENCY     default 5
+
+Instances coordinate through a lock key in Redis, so one instance acts at a
+time. Installed in the AMI as /usr/local/bin/mastodon-redis-guard.
+"""
+
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import uuid
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+ENV_FILE = "/home/mastodon/live/.env.production"
+STACK_NAME_FILE = "/opt/oe/patterns/stack-name.txt"
+
+DEFAULTS = {
+    "REDIS_GUARD_TRIM_FEEDS_PERCENT": 85,
+    "REDIS_GUARD_CLEAR_CACHE_PERCENT": 92,
+    "REDIS_GUARD_RECOVER_PERCENT": 70,
+    "REDIS_GUARD_INACTIVE_DAYS": 7,
+    "REDIS_GUARD_BUILD_CONCURRENCY": 5,
+}
+FEED_PATTERN = "feed:home:*"
+CACHE_PATTERN = "cache:*"
+INCIDENT_KEY = "mastodon-redis-guard:incident"
+LOCK_KEY = "mastodon-redis-guard:lock"
+# long enough to cover a scan of every feed, and a feed rebuild on a large instance
+ACTION_LOCK_SECONDS = 300
+REBUILD_LOCK_SECONDS = 3600
+BATCH = 500
+
+
+class RedisError(Exception):
+    pass
+
+
+class Redis:
+    """Just enough of a RESP client for this guard: commands and pipelines over one connection."""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+
+    @classmethod
+    def connect(cls, host: str, port: int, timeout: float = 30) -> "Redis":
+        return cls(socket.create_connection((host, port), timeout=timeout))
+
+    @staticmethod
+    def encode(args) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis closed the connection")
+        kind, rest = line[:1], line[1:-2].decode()
+        if kind == b"+":
+            return rest
+        if kind == b"-":
+            return RedisError(rest)
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            if int(rest) < 0:
+                return None
+            data = self.reader.read(int(rest) + 2)
+            return data[:-2].decode(errors="replace")
+        if kind == b"*":
+            return None if int(rest) < 0 else [self.read_reply() for _ in range(int(rest))]
+        raise RedisError(f"unexpected reply {line!r}")
+
+    def pipeline(self, commands: List[Tuple]) -> List:
+        """Replies in order; errors are returned as RedisError rather than raised."""
+        if not commands:
+            return []
+        self.sock.sendall(b"".join(self.encode(command) for command in commands))
+        return [self.read_reply() for _ in commands]
+
+    def execute(self, *args):
+        reply = self.pipeline([args])[0]
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    def scan(self, pattern: str, count: int = BATCH) -> Iterator[str]:
+        cursor = "0"
+        while True:
+            cursor, keys = self.execute("SCAN", cursor, "MATCH", pattern, "COUNT", count)
+            yield from keys
+            if cursor == "0":
+                return
+
+
+def env_values(path: str = ENV_FILE) -> Dict[str, str]:
+    values = {}
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            name, value = line.split("=", 1)
+            # mastodon-config-agent writes its values double-quoted
+            if len(value) >= 2 and value[0] == value[-1] == '"':
+                value = value[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+            values[name] = value
+    return values
+
+
+def settings(env: Dict[str, str]) -> Dict[str, int]:
+    result = {}
+    for name, default in DEFAULTS.items():
+        value = env.get(name, "")
+        if value.isdigit() and int(value) > 0:
+            result[name] = int(value)
+        else:
+            if value:
+                print(f"ignoring {name}={value}: not a positive integer, using {default}", file=sys.stderr)
+            result[name] = default
+    return result
+
+
+def memory_percent(info: str) -> Optional[float]:
+    """used_memory as a percentage of maxmemory from INFO memory, or None without a maxmemory limit."""
+    fields = dict(line.split(":", 1) for line in info.splitlines() if ":" in line)
+    maxmemory = int(fields.get("maxmemory", 0))
+    if not maxmemory:
+        return None
+    return 100.0 * int(fields["used_memory"]) / maxmemory
+
+
+def plan(percent: float, incident: bool, config: Dict[str, int]) -> List[str]:
+    """Actions for this run, in order. Stages are cumulative: above the cache threshold feeds are trimmed too."""
+    actions = []
+    if percent >= config["REDIS_GUARD_TRIM_FEEDS_PERCENT"]:
+        actions.append("trim_feeds")
+    if percent >= config["REDIS_GUARD_CLEAR_CACHE_PERCENT"]:
+        actions.append("clear_cache")
+    if not actions and incident and percent < config["REDIS_GUARD_RECOVER_PERCENT"]:
+        actions.append("rebuild_feeds")
+    return actions
+
+
+def feed_keys(redis: Redis) -> Dict[str, List[str]]:
+    """Keys under feed:home:<account id>, including the reblog tracking keys, grouped by account id."""
+    feeds = {}
+    for key in redis.scan(FEED_PATTERN):
+        account_id = key.split(":")[2]
+        if account_id.isdigit():
+            feeds.setdefault(account_id, []).append(key)
+    return feeds
+
+
+def inactive_feeds(redis: Redis, feeds: Dict[str, List[str]], idle_seconds: int) -> List[str]:
+    """Account ids whose feed hasn't been read or written for idle_seconds."""
+    account_ids = sorted(feeds)
+    inactive = []
+    for start in range(0, len(account_ids), BATCH):
+        batch = account_ids[start:start + BATCH]
+        replies = redis.pipeline([("OBJECT", "IDLETIME", f"feed:home:{account_id}") for account_id in batch])
+        inactive += [
+            account_id for account_id, idle in zip(batch, replies)
+            if isinstance(idle, int) and idle >= idle_seconds
+        ]
+    return inactive
+
+
+def unlink(redis: Redis, keys: List[str]) -> int:
+    removed = 0
+    for start in range(0, len(keys), BATCH):
+        removed += redis.execute("UNLINK", *keys[start:start + BATCH])
+    return removed
+
+
+def trim_feeds(redis: Redis, config: Dict[str, int], dry_run: bool = False) -> int:
+    feeds = feed_keys(redis)
+    inactive = inactive_feeds(redis, feeds, config["REDIS_GUARD_INACTIVE_DAYS"] * 86400)
+    keys = [key for account_id in inactive for key in feeds[account_id]]
+    print(f"{'would trim' if dry_run else 'trimming'} {len(inactive)} of {len(feeds)} home feeds ({len(keys)} keys)")
+    return len(keys) if dry_run else unlink(redis, keys)
+
+
+def clear_cache(redis: Redis, dry_run: bool = False) -> int:
+    removed = 0
+    batch = []
+    for key in redis.scan(CACHE_PATTERN):
+        batch.append(key)
+        if len(batch) >= BATCH:
+            removed += len(batch) if dry_run else unlink(redis, batch)
+            batch = []
+    removed += len(batch) if dry_run else unlink(redis, batch)
+    print(f"{'would clear' if dry_run else 'cleared'} {removed} Rails cache keys")
+    return removed
+
+
+def rebuild_feeds(concurrency: int) -> None:
+    subprocess.run(
+        ["su", "-", "mastodon", "-c",
+         "cd /home/mastodon/live && RAILS_ENV=production PATH=/home/mastodon/.rbenv/shims:$PATH "
+         f"/home/mastodon/live/bin/tootctl feeds build --concurrency {concurrency}"],
+        check=True
+    )
+
+
+def acquire(redis: Redis, token: str, seconds: int) -> bool:
+    reply = redis.pipeline([("SET", LOCK_KEY, token, "NX", "EX", seconds)])[0]
+    if isinstance(reply, RedisError):
+        # under noeviction a full Redis refuses the SET; freeing memory can't wait for the lock
+        print(f"could not take the lock, continuing: {reply}", file=sys.stderr)
+        return True
+    return reply == "OK"
+
+
+def release(redis: Redis, token: str) -> None:
+    if redis.execute("GET", LOCK_KEY) == token:
+        redis.execute("DEL", LOCK_KEY)
+
+
+def metric_data(results: Dict[str, int], stack_name: str) -> List[Dict]:
+    data = []
+    for action, removed in results.items():
+        dimensions = [
+            {"Name": "Action", "Value": action},
+            {"Name": "StackName", "Value": stack_name},
+        ]
+        data.append({"MetricName": "RedisGuardAction", "Unit": "Count", "Value": 1, "Dimensions": dimensions})
+        if action != "rebuild_feeds":
+            data.append({"MetricName": "RedisGuardKeysRemoved", "Unit": "Count", "Value": removed, "Dimensions": dimensions})
+    return data
+
+
+def publish(results: Dict[str, int]) -> None:
+    try:
+        stack_name = Path(STACK_NAME_FILE).read_text().strip()
+    except FileNotFoundError:
+        return
+    subprocess.run(
+        ["aws", "cloudwatch", "put-metric-data", "--namespace", "Mastodon",
+         "--metric-data", json.dumps(metric_data(results, stack_name))],
+        check=False
+    )
+
+
+def run(redis: Redis, config: Dict[str, int], dry_run: bool = False) -> Dict[str, int]:
+    """Check memory and act on it; returns the keys removed by each action taken."""
+    percent = memory_percent(redis.execute("INFO", "memory"))
+    if percent is None:
+        return {}
+    incident = redis.execute("EXISTS", INCIDENT_KEY) == 1
+    actions = plan(percent, incident, config)
+    if not actions:
+        return {}
+    print(f"redis memory at {percent:.1f}% of maxmemory: {', '.join(actions)}")
+    rebuild = actions == ["rebuild_feeds"]
+
+    token = uuid.uuid4().hex
+    if not dry_run and not acquire(redis, token, REBUILD_LOCK_SECONDS if rebuild else ACTION_LOCK_SECONDS):
+        print("another instance is acting, skipping")
+        return {}
+    results = {}
+    if rebuild:
+        if dry_run:
+            print(f"would rebuild feeds with concurrency {config['REDIS_GUARD_BUILD_CONCURRENCY']}")
+        else:
+            rebuild_feeds(config["REDIS_GUARD_BUILD_CONCURRENCY"])
+            redis.execute("DEL", INCIDENT_KEY)
+        results["rebuild_feeds"] = 0
+    if "trim_feeds" in actions:
+        results["trim_feeds"] = trim_feeds(redis, config, dry_run)
+    if "clear_cache" in actions:
+        results["clear_cache"] = clear_cache(redis, dry_run)
+    if dry_run:
+        return results
+    if not rebuild:
+        # after deleting, so a full Redis has room for the marker
+        reply = redis.pipeline([("SET", INCIDENT_KEY, token)])[0]
+        if isinstance(reply, RedisError):
+            print(f"could not record the incident: {reply}", file=sys.stderr)
+    release(redis, token)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Free Redis memory before noeviction rejects writes")
+    parser.add_argument("--dry-run", action="store_true", help="Print what would be removed without doing it")
+    parser.add_argument("--env-file", default=ENV_FILE)
+    args = parser.parse_args(argv)
+
+    env = env_values(args.env_file)
+    config = settings(env)
+    try:
+        redis = Redis.connect(env["REDIS_HOST"], int(env.get("REDIS_PORT", 6379)))
+        results = run(redis, config, args.dry_run)
+    except (OSError, RedisError) as e:
+        print(f"redis guard failed: {e}", file=sys.stderr)
+        return 1
+    except subprocess.CalledProcessError as e:
+        # the incident stays recorded, so the rebuild is retried once the lock expires
+        print(f"feed rebuild failed: {e}", file=sys.stderr)
+        return 1
+    if results and not args.dry_run:
+        publish(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
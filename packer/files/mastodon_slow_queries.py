@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Slow query report for the Mastodon database.
+
+Reads pg_stat_statements, ranks the top statements by total time, mean time
+and I/O, maps them to the Mastodon models they touch and prints the change
+since the previous run. Each run saves a snapshot so the next report shows
+what happened in between, e.g. during a CPU spike.
+
+Installed in the AMI as /usr/local/bin/mastodon-slow-queries.
+"""
+
+import argparse
+import json
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+ENV_FILE = "/home/mastodon/live/.env.production"
+DEFAULT_SNAPSHOT = Path.home() / ".cache" / "mastodon-slow-queries" / "snapshot.json"
+
+# tables whose model name can't be derived by singularizing and camelizing
+TABLE_MODELS = {
+    "statuses": "Status",
+    "status_stats": "StatusStat",
+    "statuses_tags": "Status/Tag (join)",
+    "media_attachments": "MediaAttachment",
+    "preview_cards_statuses": "PreviewCard/Status (join)",
+    "users": "User",
+    "oauth_access_tokens": "Doorkeeper::AccessToken",
+    "oauth_applications": "Doorkeeper::Application",
+    "accounts_tags": "Account/Tag (join)",
+    "custom_emojis": "CustomEmoji",
+    "web_push_subscriptions": "Web::PushSubscription",
+    "web_settings": "Web::Setting",
+}
+
+TABLE_PATTERN = re.compile(
+    r'\b(?:from|join|update|into|delete\s+from)\s+(?:only\s+)?(?:"?public"?\.)?"?([a-z_][a-z0-9_]*)"?',
+    re.IGNORECASE
+)
+
+# pg_stat_statements renamed columns in PostgreSQL 13 and 17
+COLUMN_ALIASES = {
+    "total_time": ["total_exec_time", "total_time"],
+    "mean_time": ["mean_exec_time", "mean_time"],
+    "read_time": ["shared_blk_read_time", "blk_read_time"],
+    "write_time": ["shared_blk_write_time", "blk_write_time"],
+}
+
+SORT_KEYS = {
+    "total": ("total_time", "Total time (ms)"),
+    "mean": ("mean_time", "Mean time (ms)"),
+    "io": ("io_blocks", "I/O (blocks read + written)"),
+}
+
+
+def load_env_file(path: str) -> Dict[str, str]:
+    """Parse a dotenv file such as .env.production into a dict."""
+    env = {}
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            env[key.strip()] = value.strip().strip("\"'")
+    return env
+
+
+def connection_kwargs(env: Dict[str, str]) -> Dict[str, str]:
+    """Build psycopg2 connection arguments from Mastodon's DB_* settings."""
+    return {
+        "host": env.get("DB_HOST", "localhost"),
+        "port": env.get("DB_PORT", "5432"),
+        "dbname": env.get("DB_NAME", "mastodon_production"),
+        "user": env.get("DB_USER", "mastodon"),
+        "password": env.get("DB_PASS", ""),
+    }
+
+
+def singularize(word: str) -> str:
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("sses", "shes", "ches", "xes", "uses")):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def model_for_table(table: str) -> str:
+    """Map a Mastodon table name to its ActiveRecord model name."""
+    if table in TABLE_MODELS:
+        return TABLE_MODELS[table]
+    parts = table.split("_")
+    parts[-1] = singularize(parts[-1])
+    return "".join(part.capitalize() for part in parts)
+
+
+def models_for_query(query: str) -> List[str]:
+    """Return the models touched by a normalized SQL statement, in order of appearance."""
+    models = []
+    for table in TABLE_PATTERN.findall(query or ""):
+        table = table.lower()
+        if table.startswith("pg_") or table in ("information_schema", "lateral", "select"):
+            continue
+        model = model_for_table(table)
+        if model not in models:
+            models.append(model)
+    return models
+
+
+def normalize_row(row: Dict) -> Dict:
+    """Reduce a pg_stat_statements row to the fields the report uses."""
+    def pick(name):
+        for column in COLUMN_ALIASES[name]:
+            if column in row and row[column] is not None:
+                return float(row[column])
+        return 0.0
+
+    io_blocks = sum(
+        int(row.get(column) or 0)
+        for column in ("shared_blks_read", "shared_blks_written", "local_blks_read", "temp_blks_read", "temp_blks_written")
+    )
+    return {
+        # a statement run both at top level and from inside a function has a row for each
+        "key": f"{row.get('userid')}:{row.get('dbid')}:{row.get('queryid')}:{row.get('toplevel')}",
+        "query": " ".join((row.get("query") or "").split()),
+        "calls": int(row.get("calls") or 0),
+        "rows": int(row.get("rows") or 0),
+        "total_time": pick("total_time"),
+        "mean_time": pick("mean_time"),
+        "io_blocks": io_blocks,
+        "io_time": pick("read_time") + pick("write_time"),
+    }
+
+
+def fetch_statements(conn) -> List[Dict]:
+    """Read pg_stat_statements for the current database."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT * FROM pg_stat_statements "
+            "WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())"
+        )
+        columns = [column[0] for column in cursor.description]
+        return [normalize_row(dict(zip(columns, values))) for values in cursor.fetchall()]
+
+
+def compute_deltas(current: List[Dict], previous: Optional[Dict]) -> List[Dict]:
+    """
+    Annotate each statement with its change since the previous snapshot.
+
+    A statement whose counters went backwards was reset (pg_stat_statements_reset
+    or eviction), so its current values are the delta.
+    """
+    previous_rows = (previous or {}).get("statements", {})
+    results = []
+    for row in current:
+        before = previous_rows.get(row["key"])
+        delta = dict(row)
+        if before and row["calls"] >= before["calls"]:
+            delta["delta_calls"] = row["calls"] - before["calls"]
+            delta["delta_total_time"] = row["total_time"] - before["total_time"]
+            delta["delta_io_blocks"] = row["io_blocks"] - before["io_blocks"]
+        else:
+            delta["delta_calls"] = row["calls"]
+            delta["delta_total_time"] = row["total_time"]
+            delta["delta_io_blocks"] = row["io_blocks"]
+        delta["delta_mean_time"] = (
+            delta["delta_total_time"] / delta["delta_calls"] if delta["delta_calls"] else 0.0
+        )
+        results.append(delta)
+    return results
+
+
+def rank(rows: List[Dict], sort: str, top: int, use_deltas: bool) -> List[Dict]:
+    field = SORT_KEYS[sort][0]
+    if use_deltas:
+        field = f"delta_{field}"
+    ranked = [row for row in rows if not use_deltas or row["delta_calls"] > 0]
+    return sorted(ranked, key=lambda row: row[field], reverse=True)[:top]
+
+
+def format_report(rows: List[Dict], sorts: List[str], top: int, previous: Optional[Dict], width: int = 100) -> str:
+    use_deltas = previous is not None
+    lines = []
+    if use_deltas:
+        elapsed = time.time() - previous.get("taken_at", time.time())
+        lines.append(f"Changes since snapshot taken {elapsed:.0f}s ago")
+    else:
+        lines.append("No previous snapshot: showing cumulative totals since stats were last reset")
+
+    for sort in sorts:
+        title = SORT_KEYS[sort][1]
+        lines.append("")
+        lines.append(f"== Top {top} by {title}{' (delta)' if use_deltas else ''} ==")
+        lines.append(f"{'#':>3} {'calls':>10} {'total ms':>12} {'mean ms':>10} {'io blks':>10}  models / query")
+        for i, row in enumerate(rank(rows, sort, top, use_deltas), 1):
+            prefix = "delta_" if use_deltas else ""
+            models = ", ".join(models_for_query(row["query"])) or "-"
+            lines.append(
+                f"{i:>3} {row[prefix + 'calls']:>10} {row[prefix + 'total_time']:>12.1f} "
+                f"{row[prefix + 'mean_time']:>10.2f} {row[prefix + 'io_blocks']:>10}  {models}"
+            )
+            lines.append(f"{'':>51}{row['query'][:width]}")
+    return "\n".join(lines)
+
+
+def load_snapshot(path: Path) -> Optional[Dict]:
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_snapshot(path: Path, rows: List[Dict]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    snapshot = {
+        "taken_at": time.time(),
+        "statements": {
+            row["key"]: {k: row[k] for k in ("calls", "total_time", "io_blocks")}
+            for row in rows
+        }
+    }
+    with open(path, "w") as f:
+        json.dump(snapshot, f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Report the most expensive Mastodon database statements from pg_stat_statements"
+    )
+    parser.add_argument("--top", type=int, default=10, help="Number of statements per ranking (default: 10)")
+    parser.add_argument(
+        "--sort",
+        choices=sorted(SORT_KEYS),
+        action="append",
+        help="Ranking to print; repeat for several (default: total, mean and io)"
+    )
+    parser.add_argument("--env-file", default=ENV_FILE, help=f"Mastodon env file with DB_* settings (default: {ENV_FILE})")
+    parser.add_argument("--dsn", help="libpq connection string; overrides --env-file")
+    parser.add_argument("--snapshot-file", type=Path, default=DEFAULT_SNAPSHOT, help="Where to keep the previous snapshot")
+    parser.add_argument("--cumulative", action="store_true", help="Ignore the previous snapshot and rank cumulative totals")
+    parser.add_argument("--no-save", action="store_true", help="Do not update the snapshot after reporting")
+    args = parser.parse_args(argv)
+
+    import psycopg2
+
+    if args.dsn:
+        conn = psycopg2.connect(args.dsn)
+    else:
+        conn = psycopg2.connect(**connection_kwargs(load_env_file(args.env_file)))
+
+    try:
+        current = fetch_statements(conn)
+    except psycopg2.Error as e:
+        print(f"Error reading pg_stat_statements: {e}".strip(), file=sys.stderr)
+        print("Is the extension created and preloaded (shared_preload_libraries)?", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+
+    previous = None if args.cumulative else load_snapshot(args.snapshot_file)
+    rows = compute_deltas(current, previous)
+    print(format_report(rows, args.sort or ["total", "mean", "io"], args.top, previous))
+
+    if not args.no_save:
+        save_snapshot(args.snapshot_file, current)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Graceful draining of streaming connections for the Mastodon AMI.
+
+Runs as the mastodon-streaming-drain service on app instances. When the
+Auto Scaling group starts terminating the instance (scale-in, or a rolling
+replacement after an AsgReprovisionString or AMI change), it deregisters the
+instance from the target group, and the ALB keeps the open streams for the
+deregistration delay. AWS documents that the termination lifecycle hook
+(Terminating:Wait) only starts after that delay, when the ALB has already
+cut every stream and all the clients have reconnected to the remaining
+instances in the same second.
+
+So the drain starts from the deregistration itself: the target's health in
+the group's target groups turns "draining". The target lifecycle state
+turning "Terminated" also starts it, in case the hook comes first. Each
+streaming connection is given a random close time spread over the
+deregistration delay, less a margin for polling, so reconnects arrive at a
+steady rate. Connections are closed by destroying the socket between nginx
+and the streaming server (ss -K), and nginx then closes the client's
+connection. Once the instance is in Terminating:Wait, anything left is
+closed by stopping mastodon-streaming, and the streaming-drain lifecycle
+hook is completed.
+
+The deregistration delay is read from /opt/oe/patterns/streaming-drain-seconds.txt,
+written by user data from the StreamingDrainSeconds stack parameter.
+
+Installed in the AMI as /usr/local/bin/mastodon-streaming-drain.
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import Callable, List, Optional, Tuple
+
+IMDS = "http://169.254.169.254/latest"
+HOOK = "streaming-drain"
+DRAIN_SECONDS_FILE = "/opt/oe/patterns/streaming-drain-seconds.txt"
+DEFAULT_DRAIN_SECONDS = 90
+# close the last streams this long before the ALB cuts whatever is left; covers the polling interval
+MARGIN_SECONDS = 15
+STREAMING_PORT = 4000
+POLL_SECONDS = 10
+# ports per ss -K call, to keep the filter expression short
+CLOSE_BATCH = 100
+
+
+def imds_token() -> str:
+    request = urllib.request.Request(
+        f"{IMDS}/api/token", method="PUT", headers={"X-aws-ec2-metadata-token-ttl-seconds": "60"}
+    )
+    with urllib.request.urlopen(request, timeout=2) as response:
+        return response.read().decode()
+
+
+def imds(path: str, token: str) -> str:
+    request = urllib.request.Request(f"{IMDS}/meta-data/{path}", headers={"X-aws-ec2-metadata-token": token})
+    try:
+        with urllib.request.urlopen(request, timeout=2) as response:
+            return response.read().decode()
+    except urllib.error.HTTPError:
+        return ""
+
+
+def drain_window(path: str = DRAIN_SECONDS_FILE) -> int:
+    """Seconds to spread the closes over: the deregistration delay less the margin."""
+    try:
+        with open(path, "r") as f:
+            seconds = int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        seconds = DEFAULT_DRAIN_SECONDS
+    return max(seconds - MARGIN_SECONDS, 0)
+
+
+def parse_peers(output: str) -> List[int]:
+    """nginx-side ports of established connections, from ss -Htn state established output."""
+    peers = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) >= 4:
+            peers.append(int(fields[3].rsplit(":", 1)[1]))
+    return sorted(set(peers))
+
+
+def connections(port: int = STREAMING_PORT) -> List[int]:
+    output = subprocess.run(
+        ["ss", "-Htn", "state", "established", f"( sport = :{port} )"],
+        capture_output=True, text=True, check=True
+    ).stdout
+    return parse_peers(output)
+
+
+def schedule(peers: List[int], window: int, rng: random.Random) -> List[Tuple[int, List[int]]]:
+    """(second, peers) pairs in time order, each peer closed at a uniformly random second of the window."""
+    seconds = {}
+    for peer in peers:
+        seconds.setdefault(rng.randint(0, window), []).append(peer)
+    return sorted(seconds.items())
+
+
+def close(peers: List[int], port: int = STREAMING_PORT) -> None:
+    for start in range(0, len(peers), CLOSE_BATCH):
+        ports = " or ".join(f"dport = :{peer}" for peer in peers[start:start + CLOSE_BATCH])
+        subprocess.run(
+            ["ss", "-K", "-tn", "state", "established", f"( sport = :{port} and ( {ports} ) )"],
+            stdout=subprocess.DEVNULL, check=False
+        )
+
+
+def drain(
+        window: int,
+        peers: List[int],
+        rng: random.Random,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+        closer: Callable[[List[int]], None] = close
+) -> int:
+    start = clock()
+    closed = 0
+    for second, batch in schedule(peers, window, rng):
+        delay = start + second - clock()
+        if delay > 0:
+            sleep(delay)
+        closer(batch)
+        closed += len(batch)
+    return closed
+
+
+def aws(region: str, *args: str) -> str:
+    return subprocess.run(
+        ["aws", *args, "--region", region, "--output", "json"], capture_output=True, text=True, check=True
+    ).stdout
+
+
+def asg_name(instance_id: str, region: str) -> str:
+    output = aws(region, "autoscaling", "describe-auto-scaling-instances", "--instance-ids", instance_id)
+    return json.loads(output)["AutoScalingInstances"][0]["AutoScalingGroupName"]
+
+
+def target_group_arns(asg: str, region: str) -> List[str]:
+    output = aws(region, "autoscaling", "describe-auto-scaling-groups", "--auto-scaling-group-names", asg)
+    return json.loads(output)["AutoScalingGroups"][0].get("TargetGroupARNs", [])
+
+
+def parse_target_state(output: str) -> Optional[str]:
+    """State of the target from elbv2 describe-target-health output, None when it is not registered."""
+    descriptions = json.loads(output).get("TargetHealthDescriptions", [])
+    return descriptions[0]["TargetHealth"]["State"] if descriptions else None
+
+
+def deregistering(instance_id: str, region: str, target_groups: List[str]) -> bool:
+    """Whether the ALB is draining this instance in any of its target groups."""
+    for arn in target_groups:
+        output = aws(region, "elbv2", "describe-target-health", "--target-group-arn", arn,
+                     "--targets", f"Id={instance_id}")
+        if parse_target_state(output) == "draining":
+            return True
+    return False
+
+
+def complete_lifecycle_action(token: str) -> None:
+    instance_id = imds("instance-id", token)
+    region = imds("placement/region", token)
+    subprocess.run(
+        ["aws", "autoscaling", "complete-lifecycle-action", "--region", region, "--lifecycle-hook-name", HOOK,
+         "--auto-scaling-group-name", asg_name(instance_id, region), "--instance-id", instance_id, "--lifecycle-action-result", "CONTINUE"],
+        check=False
+    )
+
+
+def drain_connections(window: int) -> None:
+    peers = connections()
+    print(f"draining {len(peers)} streaming connections over {window}s")
+    closed = drain(window, peers, random.Random())
+    print(f"closed {closed} streaming connections")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Close streaming connections gradually before the instance terminates")
+    parser.add_argument("--now", action="store_true", help="Drain immediately instead of waiting for termination")
+    parser.add_argument("--window", type=int, help="Seconds to spread the closes over (default: from the stack)")
+    args = parser.parse_args(argv)
+
+    window = drain_window() if args.window is None else args.window
+    drained = False
+    target_groups = None
+    # drain from the deregistration, or from Terminated if that comes first, then wait for Terminating:Wait
+    while not args.now:
+        try:
+            token = imds_token()
+            terminating = imds("autoscaling/target-lifecycle-state", token) == "Terminated"
+            if not drained and not terminating:
+                instance_id = imds("instance-id", token)
+                region = imds("placement/region", token)
+                if target_groups is None:
+                    target_groups = target_group_arns(asg_name(instance_id, region), region)
+                if deregistering(instance_id, region, target_groups):
+                    print("deregistered from the target group")
+                    drain_connections(window)
+                    drained = True
+            elif not drained:
+                print("lifecycle state Terminated before deregistration")
+                drain_connections(window)
+                drained = True
+            if terminating:
+                break
+        except (OSError, subprocess.CalledProcessError, ValueError, KeyError, IndexError) as e:
+            print(f"instance or target state unavailable: {e}", file=sys.stderr)
+        time.sleep(POLL_SECONDS)
+
+    if args.now:
+        drain_connections(window)
+    # also closes anything that connected during the drain
+    print("stopping mastodon-streaming")
+    subprocess.run(["systemctl", "stop", "mastodon-streaming"], check=False)
+    if not args.now:
+        complete_lifecycle_action(imds_token())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
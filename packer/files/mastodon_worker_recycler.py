@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Memory-aware recycling of Puma workers and Sidekiq for the Mastodon AMI.
+
+Run every minute from cron as root. Thresholds are computed from the
+instance's memory so they sit below the systemd MemoryHigh limits of each
+service: a Puma worker above its share is sent TERM (the Puma master finishes
+its requests and forks a replacement) and Sidekiq above its share is quieted
+(TSTP), given time to finish running jobs, then restarted. Puma workers are
+measured by PSS, so the copy-on-write pages they share with the master are
+split between them instead of counted in full by each. Each recycle is
+published to CloudWatch as Mastodon/WorkerRecycled.
+
+Installed in the AMI as /usr/local/bin/mastodon-worker-recycler.
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+STACK_NAME_FILE = "/opt/oe/patterns/stack-name.txt"
+
+# fractions of instance memory; keep below MemoryHigh in the systemd drop-ins
+# (45% web, 35% sidekiq, 75% sidekiq on media workers where puma doesn't run)
+WEB_SHARE = 0.40
+SIDEKIQ_SHARE = 0.30
+SIDEKIQ_ONLY_SHARE = 0.70
+# never recycle a puma worker below this PSS, however small the instance
+MIN_WORKER_KB = 300 * 1024
+# time sidekiq gets to finish running jobs after TSTP, as in mastodon-config-agent
+QUIET_SECONDS = 20
+
+
+def mem_total_kb(meminfo: str = "/proc/meminfo") -> int:
+    with open(meminfo, "r") as f:
+        for line in f:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1])
+    raise ValueError(f"MemTotal missing from {meminfo}")
+
+
+def thresholds(total_kb: int, web_workers: int, sidekiq_only: bool = False) -> Dict[str, int]:
+    """RSS limits in KB for one Puma worker and for the Sidekiq process."""
+    return {
+        "puma_worker": max(int(total_kb * WEB_SHARE / max(web_workers, 1)), MIN_WORKER_KB),
+        "sidekiq": int(total_kb * (SIDEKIQ_ONLY_SHARE if sidekiq_only else SIDEKIQ_SHARE)),
+    }
+
+
+def rss_kb(pid: int, proc: Path = Path("/proc")) -> int:
+    try:
+        with open(proc / str(pid) / "status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return 0
+
+
+def pss_kb(pid: int, proc: Path = Path("/proc")) -> int:
+    """Proportional set size, falling back to RSS where smaps_rollup is unavailable."""
+    try:
+        with open(proc / str(pid) / "smaps_rollup", "r") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1])
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        pass
+    return rss_kb(pid, proc)
+
+
+def children(pid: int, proc: Path = Path("/proc")) -> List[int]:
+    """PIDs whose parent is pid, read from /proc/<pid>/stat."""
+    result = []
+    for entry in proc.iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        # the command name is in parentheses and may contain spaces
+        fields = stat[stat.rindex(")") + 2:].split()
+        if int(fields[1]) == pid:
+            result.append(int(entry.name))
+    return sorted(result)
+
+
+def main_pid(service: str) -> Optional[int]:
+    output = subprocess.run(
+        ["systemctl", "show", "--property", "MainPID", "--value", service],
+        capture_output=True, text=True
+    ).stdout.strip()
+    return int(output) if output.isdigit() and int(output) > 0 else None
+
+
+def plan(web_workers: Dict[int, int], sidekiq_kb: Optional[int], limits: Dict[str, int]) -> List[Dict]:
+    """
+    Decide what to recycle this run, from worker PSS and Sidekiq RSS in KB.
+
+    Only the largest oversized Puma worker is recycled per run so the web tier
+    never loses more than one worker at a time.
+    """
+    actions = []
+    oversized = {pid: kb for pid, kb in web_workers.items() if kb > limits["puma_worker"]}
+    if oversized:
+        pid = max(oversized, key=oversized.get)
+        actions.append({"service": "mastodon-web", "pid": pid, "memory_kb": oversized[pid], "limit_kb": limits["puma_worker"]})
+    if sidekiq_kb is not None and sidekiq_kb > limits["sidekiq"]:
+        actions.append({"service": "mastodon-sidekiq", "memory_kb": sidekiq_kb, "limit_kb": limits["sidekiq"]})
+    return actions
+
+
+def recycle(action: Dict, quiet_seconds: int = QUIET_SECONDS) -> None:
+    if action["service"] == "mastodon-web":
+        os.kill(action["pid"], signal.SIGTERM)
+    else:
+        # stop fetching jobs and let running ones finish, so the restart interrupts as few as possible
+        subprocess.run(["systemctl", "kill", "--kill-who=main", "--signal=TSTP", action["service"]], check=True)
+        time.sleep(quiet_seconds)
+        subprocess.run(["systemctl", "restart", action["service"]], check=True)
+
+
+def metric_data(actions: List[Dict], stack_name: str) -> List[Dict]:
+    return [
+        {
+            "MetricName": "WorkerRecycled",
+            "Unit": "Count",
+            "Value": 1,
+            "Dimensions": [
+                {"Name": "Service", "Value": action["service"]},
+                {"Name": "StackName", "Value": stack_name},
+            ],
+        }
+        for action in actions
+    ]
+
+
+def publish(actions: List[Dict]) -> None:
+    try:
+        stack_name = Path(STACK_NAME_FILE).read_text().strip()
+    except FileNotFoundError:
+        return
+    subprocess.run(
+        ["aws", "cloudwatch", "put-metric-data", "--namespace", "Mastodon",
+         "--metric-data", json.dumps(metric_data(actions, stack_name))],
+        check=False
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recycle Puma workers and Sidekiq that exceed their memory share")
+    parser.add_argument("--dry-run", action="store_true", help="Print what would be recycled without doing it")
+    args = parser.parse_args(argv)
+
+    web_pid = main_pid("mastodon-web")
+    workers = {pid: pss_kb(pid) for pid in children(web_pid)} if web_pid else {}
+    sidekiq_pid = main_pid("mastodon-sidekiq")
+    limits = thresholds(mem_total_kb(), len(workers), sidekiq_only=web_pid is None)
+    actions = plan(workers, rss_kb(sidekiq_pid) if sidekiq_pid else None, limits)
+
+    for action in actions:
+        print(
+            f"{'would recycle' if args.dry_run else 'recycling'} {action['service']}"
+            f"{' worker ' + str(action['pid']) if 'pid' in action else ''}: "
+            f"{'PSS' if 'pid' in action else 'RSS'} {action['memory_kb'] // 1024} MB > {action['limit_kb'] // 1024} MB"
+        )
+        if not args.dry_run:
+            recycle(action)
+    if actions and not args.dry_run:
+        publish(actions)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
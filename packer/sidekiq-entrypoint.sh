@@ -0,0 +1,53 @@
+#!/bin/bash
+#
+# Entrypoint of the Sidekiq container image. Configuration comes from the
+# environment (the ECS task definition, or docker-compose.yml locally) rather
+# than .env.production.
+#
+#   sidekiq [args]   run sidekiq with SIDEKIQ_CONCURRENCY threads
+#   smoke-test       prepare the database, check redis is reachable and sidekiq boots
+#
+set -e
+
+cd /home/mastodon/live
+export RAILS_ENV=production
+export PATH=/home/mastodon/.rbenv/shims:$PATH
+
+# the egress proxy presents certificates signed by its own CA
+if [ -n "$EGRESS_PROXY_CA_CERTIFICATE" ]; then
+  cat /etc/ssl/certs/ca-certificates.crt > /tmp/ca-certificates.crt
+  echo "$EGRESS_PROXY_CA_CERTIFICATE" >> /tmp/ca-certificates.crt
+  export SSL_CERT_FILE=/tmp/ca-certificates.crt
+fi
+
+case "$1" in
+  sidekiq)
+    shift
+    exec bundle exec sidekiq -c "${SIDEKIQ_CONCURRENCY:-10}" "$@"
+    ;;
+  smoke-test)
+    bundle exec rails db:prepare
+    bundle exec rails runner '
+      ActiveRecord::Base.connection.execute("SELECT 1")
+      Sidekiq.redis { |redis| redis.call("PING") }
+      puts "database and redis reachable"
+    '
+    bundle exec sidekiq -c 1 -q default &
+    PID=$!
+    for i in $(seq 1 120); do
+      if [ "$(redis-cli -h "$REDIS_HOST" -p "${REDIS_PORT:-6379}" SCARD processes)" -gt 0 ]; then
+        echo "sidekiq process registered after ${i}s"
+        kill -TERM $PID
+        wait $PID
+        exit 0
+      fi
+      kill -0 $PID 2>/dev/null || { echo "sidekiq exited during startup"; exit 1; }
+      sleep 1
+    done
+    echo "sidekiq did not register within 120s"
+    exit 1
+    ;;
+  *)
+    exec "$@"
+    ;;
+esac
@@ -0,0 +1,20 @@
+"""
+Shared fixtures for tests of the tools installed into the AMI from packer/files.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "files"))
+
+
+@pytest.fixture(scope="session")
+def postgres_dsn():
+    """DSN of a local scratch Postgres database, e.g. postgresql://postgres@localhost/postgres."""
+    dsn = os.environ.get("TEST_POSTGRES_DSN")
+    if not dsn:
+        pytest.skip("TEST_POSTGRES_DSN not set")
+    return dsn
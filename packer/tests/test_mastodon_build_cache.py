@@ -0,0 +1,83 @@
+"""
+Tests for the layered AMI build cache, using a local directory as the cache.
+"""
+
+import pytest
+
+import mastodon_build_cache as mbc
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    location = tmp_path / "cache"
+    monkeypatch.setenv("BUILD_CACHE", str(location))
+    return location
+
+
+@pytest.fixture
+def live(tmp_path):
+    live = tmp_path / "live"
+    (live / "vendor" / "bundle" / "ruby").mkdir(parents=True)
+    (live / "vendor" / "bundle" / "ruby" / "gem.rb").write_text("puts 1\n")
+    (live / "Gemfile.lock").write_text("GEM\n  specs:\n    rails (8.0.0)\n")
+    return live
+
+
+class TestCacheKey:
+
+    def test_file_contents_and_strings(self, live):
+        lock = str(live / "Gemfile.lock")
+        key = mbc.cache_key("gems", [lock, "ruby-key"])
+        assert key == mbc.cache_key("gems", [lock, "ruby-key"])
+        assert key != mbc.cache_key("node", [lock, "ruby-key"])
+        assert key != mbc.cache_key("gems", [lock, "other-ruby-key"])
+
+        (live / "Gemfile.lock").write_text("GEM\n  specs:\n    rails (8.0.1)\n")
+        assert key != mbc.cache_key("gems", [lock, "ruby-key"])
+
+    def test_parts_are_separated(self):
+        assert mbc.cache_key("ruby", ["3.4", "7"]) != mbc.cache_key("ruby", ["3.", "47"])
+
+
+class TestRestoreAndSave:
+
+    def test_round_trip(self, cache, live, tmp_path):
+        assert not mbc.restore("gems", "abc", tmp_path / "new")
+        assert mbc.save("gems", "abc", live, ["vendor/bundle", "node_modules"])
+        assert (cache / "gems-abc.tar.gz").is_file()
+        assert [p.name for p in cache.iterdir()] == ["gems-abc.tar.gz"]
+
+        assert mbc.restore("gems", "abc", tmp_path / "new")
+        assert (tmp_path / "new" / "vendor" / "bundle" / "ruby" / "gem.rb").read_text() == "puts 1\n"
+        assert not mbc.restore("gems", "other", tmp_path / "other")
+
+    def test_disabled_without_build_cache(self, live, tmp_path, monkeypatch):
+        monkeypatch.delenv("BUILD_CACHE", raising=False)
+        assert not mbc.save("gems", "abc", live, ["vendor/bundle"])
+        assert not mbc.restore("gems", "abc", tmp_path / "new")
+
+    def test_nothing_to_save(self, cache, live):
+        assert not mbc.save("assets", "abc", live, ["public/packs"])
+        assert not cache.exists()
+
+    def test_s3_without_aws_cli_misses(self, live, tmp_path, monkeypatch):
+        monkeypatch.setenv("BUILD_CACHE", "s3://bucket/prefix")
+        monkeypatch.setenv("PATH", str(tmp_path / "empty"))
+        assert not mbc.restore("gems", "abc", tmp_path / "new")
+
+
+class TestMain:
+
+    def test_exit_status(self, cache, live, tmp_path, capsys):
+        key = mbc.cache_key("gems", [str(live / "Gemfile.lock")])
+        assert mbc.main(["key", "gems", str(live / "Gemfile.lock")]) == 0
+        assert capsys.readouterr().out.strip() == key
+
+        assert mbc.main(["restore", "gems", key, "--dir", str(tmp_path / "new")]) == 1
+        assert mbc.main(["save", "gems", key, "--dir", str(live), "vendor/bundle"]) == 0
+        assert mbc.main(["restore", "gems", key, "--dir", str(tmp_path / "new")]) == 0
+
+    def test_corrupt_archive_is_a_miss(self, cache, tmp_path):
+        cache.mkdir()
+        (cache / "node-abc.tar.gz").write_bytes(b"not a tarball")
+        assert mbc.main(["restore", "node", "abc", "--dir", str(tmp_path / "new")]) == 1
@@ -0,0 +1,78 @@
+"""
+Tests for mastodon-config-agent.
+"""
+
+import mastodon_config_agent as mca
+
+BASE_ENV = """LOCAL_DOMAIN=mastodon.example.com
+DB_PASS="secret"
+"""
+
+
+class TestParameters:
+
+    def test_maps_names_under_path(self):
+        parameters = [
+            {"Name": "/stack/config/MAX_THREADS", "Value": "8"},
+            {"Name": "/stack/config/AUTHORIZED_FETCH", "Value": "true"},
+            {"Name": "/stack/config/nested/THING", "Value": "x"},
+            {"Name": "/stack/config/lower_case", "Value": "x"},
+        ]
+        assert mca.parameters_to_values(parameters, "/stack/config/") == {
+            "MAX_THREADS": "8",
+            "AUTHORIZED_FETCH": "true",
+        }
+
+
+class TestRender:
+
+    def test_appends_managed_block_and_reads_it_back(self):
+        values = {"MAX_THREADS": "8", "SMTP_FROM_ADDRESS": 'Site "Name" <no-reply@example.com>'}
+        rendered = mca.render_env(BASE_ENV, values)
+
+        assert rendered.startswith(BASE_ENV)
+        assert rendered.endswith(mca.BLOCK_END + "\n")
+        assert 'MAX_THREADS="8"' in rendered
+        base, parsed = mca.split_env(rendered)
+        assert base == BASE_ENV
+        assert parsed == values
+
+    def test_replaces_existing_block(self):
+        first = mca.render_env(BASE_ENV, {"MAX_THREADS": "8", "WEB_CONCURRENCY": "2"})
+        second = mca.render_env(first, {"MAX_THREADS": "5"})
+        assert second.count(mca.BLOCK_BEGIN) == 1
+        assert mca.split_env(second)[1] == {"MAX_THREADS": "5"}
+
+    def test_removing_every_parameter_removes_the_block(self):
+        rendered = mca.render_env(BASE_ENV, {"MAX_THREADS": "8"})
+        assert mca.render_env(rendered, {}) == BASE_ENV
+
+    def test_quote_round_trip(self):
+        for value in ["plain", 'with "quotes"', "back\\slash", "two\nlines", "\\n literal"]:
+            assert mca.unquote(mca.quote(value)) == value
+
+
+class TestRestarts:
+
+    def test_no_change(self):
+        assert mca.services_to_restart({"MAX_THREADS": "8"}, {"MAX_THREADS": "8"}) == []
+
+    def test_app_change_restarts_web_and_sidekiq(self):
+        assert mca.services_to_restart({}, {"MAX_THREADS": "8"}) == ["mastodon-web", "mastodon-sidekiq"]
+        assert mca.services_to_restart({"AUTHORIZED_FETCH": "true"}, {}) == ["mastodon-web", "mastodon-sidekiq"]
+
+    def test_streaming_change_also_restarts_streaming(self):
+        assert "mastodon-streaming" in mca.services_to_restart({}, {"STREAMING_CLUSTER_NUM": "2"})
+
+
+def test_apply_writes_both_files_once(tmp_path):
+    env_file = tmp_path / ".env.production"
+    env_file.write_text(BASE_ENV)
+    tunables_file = tmp_path / "etc" / "tunables.env"
+
+    values = {"SIDEKIQ_CONCURRENCY": "15", "SIDEKIQ_QUEUE_ARGS": "-q default,8 -q ingress,6"}
+    assert mca.apply(values, str(env_file), str(tunables_file), restart_services=False, quiet_seconds=0)
+    assert mca.split_env(env_file.read_text())[1] == values
+    assert tunables_file.read_text() == 'SIDEKIQ_CONCURRENCY="15"\nSIDEKIQ_QUEUE_ARGS="-q default,8 -q ingress,6"\n'
+
+    assert not mca.apply(values, str(env_file), str(tunables_file), restart_services=False, quiet_seconds=0)
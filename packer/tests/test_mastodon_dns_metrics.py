@@ -0,0 +1,51 @@
+"""
+Tests for mastodon-dns-metrics.
+"""
+
+import socket
+
+import mastodon_dns_metrics as mdm
+
+STATS = """thread0.num.queries=700
+total.num.queries=1000
+total.num.queries_ip_ratelimited=0
+total.num.cachehits=850
+total.num.cachemiss=150
+total.num.prefetch=40
+total.num.expired=3
+total.requestlist.exceeded=0
+total.recursion.time.avg=0.012000
+num.answer.rcode.NOERROR=930
+num.answer.rcode.SERVFAIL=2
+num.answer.rcode.NXDOMAIN=68
+"""
+
+
+def test_parse_stats():
+    stats = mdm.parse_stats(STATS + "garbage line\n")
+    assert stats["total.num.queries"] == 1000
+    assert stats["total.recursion.time.avg"] == 0.012
+    assert "garbage line" not in stats
+
+
+def test_statsd_lines():
+    lines = mdm.statsd_lines(mdm.parse_stats(STATS))
+    assert "DnsQueries:1000|c" in lines
+    assert "DnsCacheHits:850|c" in lines
+    assert "DnsServfailAnswers:2|c" in lines
+    assert "DnsRequestListExceeded:0|c" in lines
+    assert lines[-1] == "DnsCacheHitPercent:85.0|g"
+    # no hit rate for an idle minute, and missing counters are zero
+    idle = mdm.statsd_lines({"total.num.queries": 0})
+    assert len(idle) == len(mdm.COUNTERS)
+    assert "DnsServfailAnswers:0|c" in idle
+
+
+def test_send():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    try:
+        mdm.send(["DnsQueries:1|c", "DnsCacheHitPercent:100.0|g"], receiver.getsockname())
+        assert receiver.recv(1024) == b"DnsQueries:1|c\nDnsCacheHitPercent:100.0|g"
+    finally:
+        receiver.close()
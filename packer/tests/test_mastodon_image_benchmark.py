@@ -0,0 +1,80 @@
+"""
+Tests for mastodon-image-benchmark.
+The end-to-end test runs only where vipsthumbnail and ImageMagick are installed.
+"""
+
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+import mastodon_image_benchmark as mib
+
+
+class TestCommands:
+
+    def test_vips_loads_every_gif_frame(self):
+        argv = mib.vips_command(Path("a.gif"), Path("out/a-small.gif"), 640, 360)
+        assert argv[:2] == ["vipsthumbnail", "a.gif[n=-1]"]
+        assert "640x360>" in argv
+
+    def test_imagemagick_coalesces_gifs_only(self):
+        assert "-coalesce" in mib.imagemagick_command(Path("a.gif"), Path("b.gif"), 640, 360)
+        assert "-coalesce" not in mib.imagemagick_command(Path("a.png"), Path("b.jpg"), 640, 360)
+
+    def test_output_path_keeps_gif_and_webp(self):
+        out = Path("out")
+        assert mib.output_path(Path("x.gif"), out, "small") == out / "x-small.gif"
+        assert mib.output_path(Path("x.webp"), out, "small") == out / "x-small.webp"
+        assert mib.output_path(Path("x.png"), out, "original") == out / "x-original.jpg"
+
+
+class TestRunCommand:
+
+    def test_reports_peak_rss_of_the_child(self):
+        run = mib.run_command([sys.executable, "-c", "x = bytearray(64 * 1024 * 1024); x[::4096] = b'1' * len(x[::4096])"])
+        assert run["returncode"] == 0
+        assert run["max_rss_kb"] > 64 * 1024
+        assert run["seconds"] > 0
+
+    def test_reports_failure(self):
+        run = mib.run_command([sys.executable, "-c", "import sys; sys.stderr.write('boom'); sys.exit(3)"])
+        assert run["returncode"] == 3
+        assert run["stderr"] == "boom"
+
+
+class TestReport:
+
+    def test_aggregates_per_backend_and_format(self):
+        summary = {"images": 0, "failures": 0, "seconds": 0.0, "max_rss_kb": 0, "by_format": {}}
+        mib.add_run(summary, "jpg", {"seconds": 0.5, "max_rss_kb": 2048})
+        mib.add_run(summary, "jpg", {"seconds": 0.5, "max_rss_kb": 4096})
+        mib.add_run(summary, "gif", {"seconds": 2.0, "max_rss_kb": 10240})
+        mib.finish(summary)
+
+        assert summary["images"] == 3
+        assert summary["images_per_second"] == pytest.approx(1.0)
+        assert summary["max_rss_kb"] == 10240
+        assert summary["by_format"]["jpg"]["images_per_second"] == pytest.approx(2.0)
+        assert summary["by_format"]["jpg"]["max_rss_kb"] == 4096
+
+        report = mib.format_report({"vips": summary})
+        assert "vips         all            3     1.00         10.0" in report
+        assert "vips         gif            1     0.50         10.0" in report
+
+
+@pytest.mark.skipif(
+    not (shutil.which("vipsthumbnail") and shutil.which("convert")),
+    reason="libvips and ImageMagick command line tools not installed"
+)
+def test_benchmark_generated_corpus(tmp_path):
+    corpus = mib.generate_corpus(tmp_path / "corpus")
+    assert {p.suffix for p in corpus} == {".jpg", ".png", ".webp", ".gif"}
+
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    results = mib.benchmark(corpus, ["vips", "imagemagick"], 1, out_dir)
+    for backend in ("vips", "imagemagick"):
+        assert results[backend]["failures"] == 0
+        assert results[backend]["images"] == len(corpus) * len(mib.STYLES)
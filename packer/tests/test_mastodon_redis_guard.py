@@ -0,0 +1,174 @@
+"""
+Tests for mastodon-redis-guard.
+"""
+
+import fnmatch
+import socket
+
+import pytest
+
+import mastodon_redis_guard as mrg
+
+DAY = 86400
+
+
+class FakeRedis:
+    """In-memory stand-in for mrg.Redis: keys map to their idle time in seconds."""
+
+    def __init__(self, keys, used_memory, maxmemory=1000, full=False):
+        self.keys = dict(keys)
+        self.values = {}
+        self.used_memory = used_memory
+        self.maxmemory = maxmemory
+        self.full = full
+        self.commands = []
+
+    def command(self, name, *args):
+        self.commands.append((name,) + args)
+        if name == "INFO":
+            return f"# Memory\r\nused_memory:{self.used_memory}\r\nmaxmemory:{self.maxmemory}\r\n"
+        if name == "OBJECT":
+            return self.keys.get(args[1])
+        if name == "UNLINK" or name == "DEL":
+            removed = [key for key in args if key in self.keys or key in self.values]
+            for key in removed:
+                self.keys.pop(key, None)
+                self.values.pop(key, None)
+            return len(removed)
+        if name == "EXISTS":
+            return int(args[0] in self.values)
+        if name == "GET":
+            return self.values.get(args[0])
+        if name == "SET":
+            if self.full:
+                return mrg.RedisError("OOM command not allowed when used memory > 'maxmemory'.")
+            if "NX" in args and args[0] in self.values:
+                return None
+            self.values[args[0]] = args[1]
+            return "OK"
+        raise AssertionError(f"unexpected command {name}")
+
+    def pipeline(self, commands):
+        return [self.command(*command) for command in commands]
+
+    def execute(self, *args):
+        reply = self.command(*args)
+        if isinstance(reply, mrg.RedisError):
+            raise reply
+        return reply
+
+    def scan(self, pattern, count=mrg.BATCH):
+        return [key for key in list(self.keys) if fnmatch.fnmatchcase(key, pattern)]
+
+
+def feeds():
+    return {
+        "feed:home:1": 30 * DAY,
+        "feed:home:1:reblogs": 30 * DAY,
+        "feed:home:1:reblogs:110": 30 * DAY,
+        "feed:home:2": 60,
+        "feed:home:2:reblogs": 60,
+        "feed:list:5": 30 * DAY,
+        "cache:views/home": 10,
+        "cache:statuses/1": 10,
+        "queue:default": 0,
+    }
+
+
+class TestClient:
+
+    def test_encode_and_replies(self):
+        ours, theirs = socket.socketpair()
+        with ours, theirs:
+            theirs.sendall(b"+OK\r\n:3\r\n$5\r\nhello\r\n$-1\r\n*2\r\n$1\r\n0\r\n*1\r\n$3\r\nkey\r\n-ERR wrong\r\n")
+            redis = mrg.Redis(ours)
+            replies = redis.pipeline([("SET", "a", 1), ("UNLINK", "a", "b", "c"), ("GET", "a"), ("GET", "b"),
+                                      ("SCAN", 0), ("BROKEN",)])
+            assert replies[:5] == ["OK", 3, "hello", None, ["0", ["key"]]]
+            assert isinstance(replies[5], mrg.RedisError)
+            assert theirs.recv(4096).startswith(b"*3\r\n$3\r\nSET\r\n$1\r\na\r\n$1\r\n1\r\n*4\r\n$6\r\nUNLINK\r\n")
+
+
+class TestConfig:
+
+    def test_env_values_and_settings(self, tmp_path, capsys):
+        env_file = tmp_path / ".env.production"
+        env_file.write_text(
+            "REDIS_HOST=redis.internal\nREDIS_PORT=6379\n"
+            "# BEGIN mastodon-config-agent (managed, edit in SSM Parameter Store)\n"
+            'REDIS_GUARD_TRIM_FEEDS_PERCENT="80"\nREDIS_GUARD_INACTIVE_DAYS="soon"\n'
+            "# END mastodon-config-agent\n"
+        )
+        env = mrg.env_values(str(env_file))
+        assert env["REDIS_HOST"] == "redis.internal"
+        config = mrg.settings(env)
+        assert config["REDIS_GUARD_TRIM_FEEDS_PERCENT"] == 80
+        assert config["REDIS_GUARD_INACTIVE_DAYS"] == 7
+        assert "REDIS_GUARD_INACTIVE_DAYS=soon" in capsys.readouterr().err
+
+    def test_memory_percent(self):
+        assert mrg.memory_percent("used_memory:850\r\nmaxmemory:1000\r\n") == 85.0
+        assert mrg.memory_percent("used_memory:850\r\nmaxmemory:0\r\n") is None
+
+
+class TestPlan:
+
+    @pytest.mark.parametrize("percent,incident,actions", [
+        (50, False, []),
+        (86, False, ["trim_feeds"]),
+        (95, True, ["trim_feeds", "clear_cache"]),
+        (80, True, []),
+        (60, True, ["rebuild_feeds"]),
+    ])
+    def test_stages(self, percent, incident, actions):
+        assert mrg.plan(percent, incident, mrg.settings({})) == actions
+
+
+class TestRun:
+
+    def test_trims_only_inactive_feeds(self):
+        redis = FakeRedis(feeds(), used_memory=870)
+        assert mrg.run(redis, mrg.settings({})) == {"trim_feeds": 3}
+        assert "feed:home:2" in redis.keys and "feed:home:1" not in redis.keys
+        # list feeds and the cache are left alone below the cache threshold
+        assert {"feed:list:5", "cache:views/home"} <= set(redis.keys)
+        assert mrg.INCIDENT_KEY in redis.values and mrg.LOCK_KEY not in redis.values
+
+    def test_clears_cache_when_full(self):
+        # a full Redis refuses the lock and the incident marker, but keys are still deleted
+        redis = FakeRedis(feeds(), used_memory=1000, full=True)
+        assert mrg.run(redis, mrg.settings({})) == {"trim_feeds": 3, "clear_cache": 2}
+        assert not any(key.startswith("cache:") for key in redis.keys)
+        assert "queue:default" in redis.keys
+
+    def test_skips_while_another_instance_acts(self):
+        redis = FakeRedis(feeds(), used_memory=900)
+        redis.values[mrg.LOCK_KEY] = "other"
+        assert mrg.run(redis, mrg.settings({})) == {}
+        assert "feed:home:1" in redis.keys
+
+    def test_dry_run_changes_nothing(self):
+        redis = FakeRedis(feeds(), used_memory=950)
+        assert mrg.run(redis, mrg.settings({}), dry_run=True) == {"trim_feeds": 3, "clear_cache": 2}
+        assert redis.keys == feeds() and redis.values == {}
+
+    def test_rebuilds_feeds_after_recovery(self, monkeypatch):
+        builds = []
+        monkeypatch.setattr(mrg, "rebuild_feeds", builds.append)
+        redis = FakeRedis(feeds(), used_memory=500)
+        redis.values[mrg.INCIDENT_KEY] = "earlier"
+        assert mrg.run(redis, mrg.settings({"REDIS_GUARD_BUILD_CONCURRENCY": "10"})) == {"rebuild_feeds": 0}
+        assert builds == [10]
+        assert redis.values == {}
+        # nothing left to do on the next run
+        assert mrg.run(redis, mrg.settings({})) == {}
+        assert builds == [10]
+
+    def test_metric_data(self):
+        data = mrg.metric_data({"trim_feeds": 3, "rebuild_feeds": 0}, "mastodon-prod")
+        assert [(d["MetricName"], d["Value"], d["Dimensions"][0]["Value"]) for d in data] == [
+            ("RedisGuardAction", 1, "trim_feeds"),
+            ("RedisGuardKeysRemoved", 3, "trim_feeds"),
+            ("RedisGuardAction", 1, "rebuild_feeds"),
+        ]
+        assert data[0]["Dimensions"][1] == {"Name": "StackName", "Value": "mastodon-prod"}
@@ -0,0 +1,161 @@
+"""
+Tests for mastodon-slow-queries.
+The database tests run against the Postgres in TEST_POSTGRES_DSN.
+"""
+
+import json
+
+import pytest
+
+import mastodon_slow_queries as msq
+
+
+def statement(queryid, query, calls, total_time, blocks=0, toplevel=True):
+    return msq.normalize_row({
+        "userid": 10,
+        "dbid": 1,
+        "queryid": queryid,
+        "toplevel": toplevel,
+        "query": query,
+        "calls": calls,
+        "rows": calls,
+        "total_exec_time": total_time,
+        "mean_exec_time": total_time / calls if calls else 0,
+        "shared_blks_read": blocks,
+    })
+
+
+class TestModelMapping:
+
+    def test_irregular_and_regular_tables(self):
+        assert msq.model_for_table("statuses") == "Status"
+        assert msq.model_for_table("accounts") == "Account"
+        assert msq.model_for_table("media_attachments") == "MediaAttachment"
+        assert msq.model_for_table("account_stats") == "AccountStat"
+        assert msq.model_for_table("conversation_mutes") == "ConversationMute"
+        assert msq.model_for_table("favourites") == "Favourite"
+
+    def test_models_for_query(self):
+        query = (
+            'SELECT "statuses".* FROM "statuses" INNER JOIN "accounts" ON "accounts"."id" = "statuses"."account_id" '
+            'LEFT JOIN status_stats ON status_stats.status_id = statuses.id WHERE "statuses"."id" = $1'
+        )
+        assert msq.models_for_query(query) == ["Status", "Account", "StatusStat"]
+
+    def test_models_for_write_queries(self):
+        assert msq.models_for_query('UPDATE "accounts" SET "note" = $1') == ["Account"]
+        assert msq.models_for_query('INSERT INTO "notifications" ("id") VALUES ($1)') == ["Notification"]
+        assert msq.models_for_query("DELETE FROM public.mentions WHERE id = $1") == ["Mention"]
+
+    def test_ignores_catalog_tables(self):
+        assert msq.models_for_query("SELECT * FROM pg_stat_statements") == []
+
+
+class TestDeltas:
+
+    def test_delta_since_previous_snapshot(self):
+        previous = {"taken_at": 0, "statements": {"10:1:1:True": {"calls": 10, "total_time": 100.0, "io_blocks": 5}}}
+        rows = msq.compute_deltas([statement(1, "SELECT 1", 15, 200.0, 9)], previous)
+        assert rows[0]["delta_calls"] == 5
+        assert rows[0]["delta_total_time"] == 100.0
+        assert rows[0]["delta_mean_time"] == 20.0
+        assert rows[0]["delta_io_blocks"] == 4
+
+    def test_nested_statement_has_its_own_snapshot(self):
+        previous = {"taken_at": 0, "statements": {"10:1:1:True": {"calls": 10, "total_time": 100.0, "io_blocks": 0}}}
+        rows = msq.compute_deltas(
+            [statement(1, "SELECT 1", 15, 200.0), statement(1, "SELECT 1", 4, 8.0, toplevel=False)],
+            previous
+        )
+        assert [row["delta_calls"] for row in rows] == [5, 4]
+
+    def test_reset_counters_use_current_values(self):
+        previous = {"taken_at": 0, "statements": {"10:1:1:True": {"calls": 100, "total_time": 1000.0, "io_blocks": 5}}}
+        rows = msq.compute_deltas([statement(1, "SELECT 1", 3, 30.0)], previous)
+        assert rows[0]["delta_calls"] == 3
+        assert rows[0]["delta_total_time"] == 30.0
+
+    def test_rank_by_delta_skips_idle_statements(self):
+        previous = {"taken_at": 0, "statements": {"10:1:1:True": {"calls": 10, "total_time": 9000.0, "io_blocks": 0}}}
+        rows = msq.compute_deltas(
+            [statement(1, "SELECT busy_before", 10, 9000.0), statement(2, "SELECT busy_now", 4, 400.0)],
+            previous
+        )
+        ranked = msq.rank(rows, "total", 10, use_deltas=True)
+        assert [row["query"] for row in ranked] == ["SELECT busy_now"]
+
+    def test_rank_cumulative(self):
+        rows = msq.compute_deltas(
+            [statement(1, "SELECT a", 1, 50.0), statement(2, "SELECT b", 100, 100.0, 10)],
+            None
+        )
+        assert msq.rank(rows, "mean", 1, use_deltas=False)[0]["query"] == "SELECT a"
+        assert msq.rank(rows, "total", 1, use_deltas=False)[0]["query"] == "SELECT b"
+        assert msq.rank(rows, "io", 1, use_deltas=False)[0]["query"] == "SELECT b"
+
+
+class TestEnvFile:
+
+    def test_connection_from_env_production(self, tmp_path):
+        env_file = tmp_path / ".env.production"
+        env_file.write_text('DB_HOST=db.example.com\nDB_PORT=5432\nDB_USER=admin\nDB_PASS="p@ss=word"\n# comment\n')
+        kwargs = msq.connection_kwargs(msq.load_env_file(str(env_file)))
+        assert kwargs["host"] == "db.example.com"
+        assert kwargs["password"] == "p@ss=word"
+        assert kwargs["dbname"] == "mastodon_production"
+
+
+class TestAgainstPostgres:
+
+    @pytest.fixture
+    def conn(self, postgres_dsn):
+        psycopg2 = pytest.importorskip("psycopg2")
+        conn = psycopg2.connect(postgres_dsn)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_stat_statements'")
+            has_extension = cursor.fetchone() is not None
+            if has_extension:
+                try:
+                    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_stat_statements")
+                    cursor.execute("SELECT pg_stat_statements_reset()")
+                except psycopg2.Error:
+                    has_extension = False
+            if not has_extension:
+                # stand-in with the PostgreSQL 15 column layout when the extension isn't preloaded
+                cursor.execute("DROP TABLE IF EXISTS pg_stat_statements")
+                cursor.execute(
+                    "CREATE TABLE pg_stat_statements AS SELECT 10::oid AS userid, "
+                    "(SELECT oid FROM pg_database WHERE datname = current_database()) AS dbid, "
+                    "1::bigint AS queryid, 'SELECT * FROM statuses WHERE id = $1'::text AS query, "
+                    "50::bigint AS calls, 500::double precision AS total_exec_time, "
+                    "10::double precision AS mean_exec_time, 50::bigint AS rows, "
+                    "7::bigint AS shared_blks_read, 0::bigint AS shared_blks_written, "
+                    "0::double precision AS blk_read_time, 0::double precision AS blk_write_time"
+                )
+        yield conn
+        if not has_extension:
+            with conn.cursor() as cursor:
+                cursor.execute("DROP TABLE pg_stat_statements")
+        conn.close()
+
+    def test_fetch_and_report(self, conn, postgres_dsn, tmp_path, capsys):
+        with conn.cursor() as cursor:
+            cursor.execute("CREATE TEMP TABLE statuses (id bigint)")
+            cursor.execute("SELECT * FROM statuses WHERE id = 1")
+
+        rows = msq.fetch_statements(conn)
+        assert rows, "pg_stat_statements returned no rows"
+        assert all("key" in row and row["calls"] > 0 for row in rows)
+
+        snapshot = tmp_path / "snapshot.json"
+        assert msq.main(["--dsn", postgres_dsn, "--snapshot-file", str(snapshot), "--top", "5"]) == 0
+        output = capsys.readouterr().out
+        assert "No previous snapshot" in output
+        assert "Top 5 by Total time" in output
+        assert json.loads(snapshot.read_text())["statements"]
+
+        assert msq.main(["--dsn", postgres_dsn, "--snapshot-file", str(snapshot), "--sort", "io"]) == 0
+        output = capsys.readouterr().out
+        assert "Changes since snapshot" in output
+        assert "Top 10 by I/O" in output
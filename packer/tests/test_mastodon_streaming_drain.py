@@ -0,0 +1,109 @@
+"""
+Tests for mastodon-streaming-drain.
+"""
+
+import random
+
+import mastodon_streaming_drain as msd
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_drain_window(tmp_path):
+    seconds_file = tmp_path / "streaming-drain-seconds.txt"
+    seconds_file.write_text("120\n")
+    assert msd.drain_window(str(seconds_file)) == 120 - msd.MARGIN_SECONDS
+    seconds_file.write_text("5\n")
+    assert msd.drain_window(str(seconds_file)) == 0
+    assert msd.drain_window(str(tmp_path / "missing.txt")) == msd.DEFAULT_DRAIN_SECONDS - msd.MARGIN_SECONDS
+
+
+def test_parse_peers():
+    output = (
+        "0      0          127.0.0.1:4000     127.0.0.1:53422\n"
+        "0      0          127.0.0.1:4000     127.0.0.1:41000\n"
+        "0      0      [::ffff:127.0.0.1]:4000  [::ffff:127.0.0.1]:41002\n"
+    )
+    assert msd.parse_peers(output) == [41000, 41002, 53422]
+    assert msd.parse_peers("") == []
+
+
+def test_schedule_spreads_closes_over_the_window():
+    peers = list(range(40000, 42000))
+    plan = msd.schedule(peers, 60, random.Random(1))
+    assert sorted(peer for _, batch in plan for peer in batch) == peers
+    assert [second for second, _ in plan] == sorted(second for second, _ in plan)
+    assert 0 <= plan[0][0] and plan[-1][0] <= 60
+    # roughly 2000 / 61 closes per second, never a storm
+    assert max(len(batch) for _, batch in plan) < 70
+    assert msd.schedule(peers, 0, random.Random(1)) == [(0, peers)]
+
+
+def test_drain_closes_each_batch_on_time():
+    clock = FakeClock()
+    closed = []
+    count = msd.drain(30, list(range(100)), random.Random(2), clock=clock, sleep=clock.sleep,
+                      closer=lambda batch: closed.append((clock.now - 1000.0, batch)))
+    assert count == 100
+    assert sorted(peer for _, batch in closed for peer in batch) == list(range(100))
+    plan = msd.schedule(list(range(100)), 30, random.Random(2))
+    assert [second for second, _ in closed] == [float(second) for second, _ in plan]
+
+
+def test_close_batches_ports(monkeypatch):
+    calls = []
+    monkeypatch.setattr(msd.subprocess, "run", lambda args, **kwargs: calls.append(args))
+    msd.close(list(range(1, msd.CLOSE_BATCH + 2)))
+    assert len(calls) == 2
+    assert calls[1][:5] == ["ss", "-K", "-tn", "state", "established"]
+    assert calls[1][5] == f"( sport = :4000 and ( dport = :{msd.CLOSE_BATCH + 1} ) )"
+
+
+def test_parse_target_state():
+    output = '{"TargetHealthDescriptions": [{"Target": {"Id": "i-1", "Port": 443}, "TargetHealth": {"State": "draining"}}]}'
+    assert msd.parse_target_state(output) == "draining"
+    assert msd.parse_target_state('{"TargetHealthDescriptions": []}') is None
+
+
+def run_main(monkeypatch, states, draining):
+    """Run main against a sequence of lifecycle states and deregistration checks; returns the events."""
+    states, draining, events = iter(states), iter(draining), []
+    metadata = {"instance-id": "i-1", "placement/region": "us-east-1"}
+    monkeypatch.setattr(msd, "imds_token", lambda: "token")
+    monkeypatch.setattr(msd, "imds", lambda path, token: next(states) if path == "autoscaling/target-lifecycle-state" else metadata[path])
+    monkeypatch.setattr(msd, "asg_name", lambda instance_id, region: "asg")
+    monkeypatch.setattr(msd, "target_group_arns", lambda asg, region: events.append("target groups") or ["arn"])
+    monkeypatch.setattr(msd, "deregistering", lambda instance_id, region, arns: next(draining))
+    monkeypatch.setattr(msd, "drain_connections", lambda window: events.append(f"drain {window}"))
+    monkeypatch.setattr(msd.time, "sleep", lambda seconds: events.append("poll"))
+    monkeypatch.setattr(msd.subprocess, "run", lambda args, **kwargs: events.append(" ".join(args)))
+    monkeypatch.setattr(msd, "complete_lifecycle_action", lambda token: events.append("complete"))
+    assert msd.main(["--window", "60"]) == 0
+    return events
+
+
+def test_main_drains_from_deregistration(monkeypatch):
+    # the ALB drains the target before the instance reaches Terminating:Wait
+    events = run_main(monkeypatch, ["InService", "InService", "InService", "Terminated"], [False, True])
+    assert events == [
+        "target groups", "poll", "drain 60", "poll", "poll",
+        "systemctl stop mastodon-streaming", "complete"
+    ]
+
+
+def test_main_drains_when_terminated_first(monkeypatch):
+    events = run_main(monkeypatch, ["InService", "Terminated"], [False])
+    assert events == [
+        "target groups", "poll", "drain 60",
+        "systemctl stop mastodon-streaming", "complete"
+    ]
@@ -0,0 +1,94 @@
+"""
+Tests for mastodon-worker-recycler.
+"""
+
+import mastodon_worker_recycler as mwr
+
+
+def fake_process(proc, pid, ppid, rss_kb, comm="ruby"):
+    directory = proc / str(pid)
+    directory.mkdir(parents=True)
+    (directory / "stat").write_text(f"{pid} ({comm}) S {ppid} {pid} {pid} 0 -1 4194560\n")
+    (directory / "status").write_text(f"Name:\t{comm}\nVmRSS:\t{rss_kb} kB\n")
+
+
+class TestProc:
+
+    def test_mem_total(self, tmp_path):
+        meminfo = tmp_path / "meminfo"
+        meminfo.write_text("MemTotal:        3964808 kB\nMemFree:          212000 kB\n")
+        assert mwr.mem_total_kb(str(meminfo)) == 3964808
+
+    def test_children_and_rss(self, tmp_path):
+        fake_process(tmp_path, 100, 1, 200000, "puma 6.4.3 (tcp://127.0.0.1:3000) [live]")
+        fake_process(tmp_path, 101, 100, 450000, "puma: cluster worker 0: 100 [live]")
+        fake_process(tmp_path, 102, 100, 460000, "puma: cluster worker 1: 100 [live]")
+        fake_process(tmp_path, 200, 1, 900000)
+        (tmp_path / "self").mkdir()
+
+        assert mwr.children(100, tmp_path) == [101, 102]
+        assert mwr.rss_kb(102, tmp_path) == 460000
+        assert mwr.rss_kb(999, tmp_path) == 0
+
+    def test_pss_splits_shared_pages(self, tmp_path):
+        fake_process(tmp_path, 101, 100, 450000, "puma: cluster worker 0: 100 [live]")
+        # no smaps_rollup, e.g. an old kernel: RSS
+        assert mwr.pss_kb(101, tmp_path) == 450000
+        (tmp_path / "101" / "smaps_rollup").write_text(
+            "55d0c000-7ffd0000 ---p 00000000 00:00 0  [rollup]\nRss:  450000 kB\nPss:  210000 kB\n"
+        )
+        assert mwr.pss_kb(101, tmp_path) == 210000
+
+
+class TestRecycle:
+
+    def test_sidekiq_is_quieted_before_restart(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(mwr.subprocess, "run", lambda args, **kwargs: calls.append(args))
+        monkeypatch.setattr(mwr.time, "sleep", lambda seconds: calls.append(["sleep", seconds]))
+        mwr.recycle({"service": "mastodon-sidekiq"})
+        assert calls == [
+            ["systemctl", "kill", "--kill-who=main", "--signal=TSTP", "mastodon-sidekiq"],
+            ["sleep", mwr.QUIET_SECONDS],
+            ["systemctl", "restart", "mastodon-sidekiq"],
+        ]
+
+
+class TestPlan:
+
+    def test_thresholds_scale_with_memory_and_workers(self):
+        limits = mwr.thresholds(4 * 1024 * 1024, 2)
+        assert limits["puma_worker"] == int(4 * 1024 * 1024 * mwr.WEB_SHARE / 2)
+        assert limits["sidekiq"] == int(4 * 1024 * 1024 * mwr.SIDEKIQ_SHARE)
+
+    def test_sidekiq_only_instances_get_a_larger_share(self):
+        limits = mwr.thresholds(8 * 1024 * 1024, 0, sidekiq_only=True)
+        assert limits["sidekiq"] == int(8 * 1024 * 1024 * mwr.SIDEKIQ_ONLY_SHARE)
+
+    def test_worker_threshold_has_a_floor(self):
+        assert mwr.thresholds(1024 * 1024, 4)["puma_worker"] == mwr.MIN_WORKER_KB
+
+    def test_nothing_to_recycle(self):
+        limits = {"puma_worker": 500000, "sidekiq": 1000000}
+        assert mwr.plan({101: 400000, 102: 499999}, 900000, limits) == []
+        assert mwr.plan({}, None, limits) == []
+
+    def test_recycles_largest_worker_only_and_sidekiq(self):
+        limits = {"puma_worker": 500000, "sidekiq": 1000000}
+        actions = mwr.plan({101: 600000, 102: 700000, 103: 100000}, 1200000, limits)
+        assert actions == [
+            {"service": "mastodon-web", "pid": 102, "memory_kb": 700000, "limit_kb": 500000},
+            {"service": "mastodon-sidekiq", "memory_kb": 1200000, "limit_kb": 1000000},
+        ]
+
+    def test_metric_data(self):
+        data = mwr.metric_data([{"service": "mastodon-sidekiq"}], "mastodon-test")
+        assert data == [{
+            "MetricName": "WorkerRecycled",
+            "Unit": "Count",
+            "Value": 1,
+            "Dimensions": [
+                {"Name": "Service", "Value": "mastodon-sidekiq"},
+                {"Name": "StackName", "Value": "mastodon-test"},
+            ],
+        }]
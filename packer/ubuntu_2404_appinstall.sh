@@ -26,35 +26,68 @@ curl -sL https://deb.nodesource.com/setup_24.x | bash -
 
 # System packages
 apt install -y \
-  imagemagick ffmpeg libvips-tools libpq-dev libxml2-dev libxslt1-dev file git-core \
+  imagemagick ffmpeg libvips42t64 libvips-tools libpq-dev libxml2-dev libxslt1-dev file git-core \
   g++ libprotobuf-dev protobuf-compiler pkg-config gcc autoconf \
   bison build-essential libssl-dev libyaml-dev libreadline6-dev \
   zlib1g-dev libncurses5-dev libffi-dev libgdbm-dev \
-  nginx nodejs redis-tools postgresql-client \
-  libidn11-dev libicu-dev libjemalloc-dev
+  nginx nodejs redis-tools postgresql-client python3-psycopg2 \
+  libidn11-dev libicu-dev libjemalloc-dev unbound
 
 # yarn
 corepack enable
 
 adduser --disabled-password mastodon
+
+# layered build cache, see packer/files/mastodon_build_cache.py; BUILD_CACHE=s3://bucket/prefix
+# or a local directory restores the compiled Ruby, gems, node_modules and assets of earlier builds
+BUILD_CACHE_TOOL="python3 /tmp/files/mastodon_build_cache.py"
+
 su - mastodon -c "git clone https://github.com/rbenv/rbenv.git ~/.rbenv"
 su - mastodon -c "cd ~/.rbenv && src/configure && make -C src"
 su - mastodon -c "echo 'export PATH=\"/home/mastodon/.rbenv/bin:$PATH\"' >> ~/.bashrc"
 su - mastodon -c "echo 'eval \"\$(rbenv init - bash)\"' >> ~/.bashrc"
 su - mastodon -c "git clone https://github.com/rbenv/ruby-build.git ~/.rbenv/plugins/ruby-build"
-su - mastodon -c "HOME=/home/mastodon RUBY_CONFIGURE_OPTS=--with-jemalloc /home/mastodon/.rbenv/bin/rbenv install $RUBY_VERSION"
-su - mastodon -c "/home/mastodon/.rbenv/bin/rbenv global $RUBY_VERSION && /home/mastodon/.rbenv/shims/gem install bundler --no-document"
+RUBY_KEY=$($BUILD_CACHE_TOOL key ruby $RUBY_VERSION jemalloc $(lsb_release -cs) $(uname -m))
+if $BUILD_CACHE_TOOL restore ruby $RUBY_KEY --dir /home/mastodon/.rbenv/versions; then
+  chown -R mastodon:mastodon /home/mastodon/.rbenv/versions
+  su - mastodon -c "/home/mastodon/.rbenv/bin/rbenv global $RUBY_VERSION"
+else
+  rm -rf /home/mastodon/.rbenv/versions/$RUBY_VERSION
+  su - mastodon -c "HOME=/home/mastodon RUBY_CONFIGURE_OPTS=--with-jemalloc /home/mastodon/.rbenv/bin/rbenv install $RUBY_VERSION"
+  su - mastodon -c "/home/mastodon/.rbenv/bin/rbenv global $RUBY_VERSION && /home/mastodon/.rbenv/shims/gem install bundler --no-document"
+  $BUILD_CACHE_TOOL save ruby $RUBY_KEY --dir /home/mastodon/.rbenv/versions $RUBY_VERSION
+fi
+su - mastodon -c "/home/mastodon/.rbenv/bin/rbenv rehash"
 su - mastodon -c "git clone https://github.com/mastodon/mastodon.git /home/mastodon/live"
 
 # git tag -l | grep -v 'rc[0-9]*$' | sort -V | tail -n 1
 su - mastodon -c "cd /home/mastodon/live && git checkout v$MASTODON_VERSION"
 su - mastodon -c "cd /home/mastodon/live && /home/mastodon/.rbenv/shims/bundle config deployment 'true'"
 su - mastodon -c "cd /home/mastodon/live && /home/mastodon/.rbenv/shims/bundle config without 'development test'"
-su - mastodon -c "cd /home/mastodon/live && /home/mastodon/.rbenv/shims/bundle install -j$(getconf _NPROCESSORS_ONLN)"
-su - mastodon -c "cd /home/mastodon/live && yarn install"
+GEMS_KEY=$($BUILD_CACHE_TOOL key gems /home/mastodon/live/Gemfile.lock $RUBY_KEY)
+if $BUILD_CACHE_TOOL restore gems $GEMS_KEY --dir /home/mastodon/live; then
+  chown -R mastodon:mastodon /home/mastodon/live/vendor/bundle
+else
+  su - mastodon -c "cd /home/mastodon/live && /home/mastodon/.rbenv/shims/bundle install -j$(getconf _NPROCESSORS_ONLN)"
+  $BUILD_CACHE_TOOL save gems $GEMS_KEY --dir /home/mastodon/live vendor/bundle
+fi
+NODE_KEY=$($BUILD_CACHE_TOOL key node /home/mastodon/live/yarn.lock $(node -p 'process.versions.node.split(".")[0]') $(uname -m))
+if $BUILD_CACHE_TOOL restore node $NODE_KEY --dir /home/mastodon/live; then
+  chown -R mastodon:mastodon /home/mastodon/live/node_modules
+else
+  su - mastodon -c "cd /home/mastodon/live && yarn install"
+  $BUILD_CACHE_TOOL save node $NODE_KEY --dir /home/mastodon/live node_modules
+fi
 
 # precompile assets
-su - mastodon -c "cd /home/mastodon/live && SECRET_KEY_BASE_DUMMY=1 RAILS_ENV=production /home/mastodon/.rbenv/shims/bundle exec rake assets:precompile && yarn cache clean"
+ASSETS_KEY=$($BUILD_CACHE_TOOL key assets $(su - mastodon -c "cd /home/mastodon/live && git rev-parse HEAD") $NODE_KEY)
+if $BUILD_CACHE_TOOL restore assets $ASSETS_KEY --dir /home/mastodon/live; then
+  chown -R mastodon:mastodon /home/mastodon/live/public
+else
+  su - mastodon -c "cd /home/mastodon/live && SECRET_KEY_BASE_DUMMY=1 RAILS_ENV=production /home/mastodon/.rbenv/shims/bundle exec rake assets:precompile"
+  $BUILD_CACHE_TOOL save assets $ASSETS_KEY --dir /home/mastodon/live public/assets public/packs
+fi
+su - mastodon -c "cd /home/mastodon/live && yarn cache clean"
 
 # set up services
 cp /home/mastodon/live/dist/mastodon-*.service /etc/systemd/system/
@@ -63,6 +96,34 @@ cp /home/mastodon/live/dist/mastodon-*.service /etc/systemd/system/
 sed -i '/^\[Service\].*/a SyslogIdentifier=mastodon-web' /etc/systemd/system/mastodon-web.service
 sed -i '/^\[Service\].*/a SyslogIdentifier=mastodon-sidekiq' /etc/systemd/system/mastodon-sidekiq.service
 sed -i '/^\[Service\].*/a SyslogIdentifier=mastodon-streaming' /etc/systemd/system/mastodon-streaming.service
+# memory limits and CPU weights, as a share of instance memory so they fit any instance type;
+# MemoryHigh throttles and reclaims before MemoryMax OOM-kills, and mastodon-worker-recycler
+# restarts workers before either is reached. web gets the most CPU to keep request latency flat
+for SERVICE in web:45%:55%:200 sidekiq:35%:45%:100 streaming:10%:15%:150; do
+  IFS=: read NAME HIGH MAX WEIGHT <<< "$SERVICE"
+  mkdir -p /etc/systemd/system/mastodon-$NAME.service.d
+  cat <<EOF > /etc/systemd/system/mastodon-$NAME.service.d/10-resources.conf
+[Service]
+MemoryHigh=$HIGH
+MemoryMax=$MAX
+CPUWeight=$WEIGHT
+EOF
+  # values applied by mastodon-config-agent
+  cat <<EOF > /etc/systemd/system/mastodon-$NAME.service.d/10-tunables.conf
+[Service]
+EnvironmentFile=-/etc/mastodon/tunables.env
+EOF
+done
+# sidekiq threads and queues from the tunables, e.g. SIDEKIQ_QUEUE_ARGS="-q default,8 -q ingress,6";
+# without DB_POOL, Mastodon sizes the sidekiq connection pool to its concurrency
+cat <<'EOF' >> /etc/systemd/system/mastodon-sidekiq.service.d/10-tunables.conf
+Environment="SIDEKIQ_CONCURRENCY=25"
+UnsetEnvironment=DB_POOL
+ExecStart=
+ExecStart=/home/mastodon/.rbenv/shims/bundle exec sidekiq -c ${SIDEKIQ_CONCURRENCY} $SIDEKIQ_QUEUE_ARGS
+EOF
+# re-read .env.production on puma restarts so a hot restart (USR1 with preload_app) picks up new values
+sed -i "1a require 'dotenv'\nDotenv.overload('/home/mastodon/live/.env.production') if File.exist?('/home/mastodon/live/.env.production')" /home/mastodon/live/config/puma.rb
 cat <<EOF > /etc/rsyslog.d/60-mastodon.conf
 :programname, isequal, "mastodon-web" /var/log/mastodon-web.log
 :programname, isequal, "mastodon-sidekiq" /var/log/mastodon-sidekiq.log
@@ -71,12 +132,458 @@ EOF
 
 # set up crons
 crontab -l -u mastodon > /tmp/cron
-echo "@weekly RAILS_ENV=production PATH=/home/mastodon/.rbenv/shims:$PATH /home/mastodon/live/bin/tootctl media remove >> /home/mastodon/live/log/crons.log 2>&1" >> /tmp/cron
+echo "@weekly RAILS_ENV=production PATH=/home/mastodon/.rbenv/shims:$PATH /home/mastodon/live/bin/tootctl media remove --days \$(cat /opt/oe/patterns/media-cache-days.txt 2>/dev/null || echo 7) >> /home/mastodon/live/log/crons.log 2>&1" >> /tmp/cron
 echo "@weekly RAILS_ENV=production PATH=/home/mastodon/.rbenv/shims:$PATH /home/mastodon/live/bin/tootctl preview_cards remove >> /home/mastodon/live/log/crons.log 2>&1" >> /tmp/cron
 echo "@hourly RAILS_ENV=production PATH=/home/mastodon/.rbenv/shims:$PATH /home/mastodon/live/bin/tootctl search deploy --only=instances accounts tags statuses public_statuses >> /home/mastodon/live/log/crons.log 2>&1" >> /tmp/cron
+echo "* * * * * /usr/local/bin/mastodon-sidekiq-metrics >> /home/mastodon/live/log/crons.log 2>&1" >> /tmp/cron
 crontab -u mastodon /tmp/cron
 rm /tmp/cron
 
+# recycle puma workers and sidekiq above their share of instance memory
+echo "* * * * * root flock -n /run/mastodon-worker-recycler.lock /usr/local/bin/mastodon-worker-recycler >> /var/log/mastodon-worker-recycler.log 2>&1" > /etc/cron.d/mastodon-worker-recycler
+
+# free redis memory before noeviction rejects writes; flock keeps a long feed rebuild from overlapping the next run
+echo "* * * * * root flock -n /run/mastodon-redis-guard.lock /usr/local/bin/mastodon-redis-guard >> /var/log/mastodon-redis-guard.log 2>&1" > /etc/cron.d/mastodon-redis-guard
+
+# local caching DNS resolver: federation resolves thousands of remote domains, and the VPC resolver
+# drops packets above its per-interface rate limit. unbound forwards misses to it and caches the answers
+cat <<EOF > /etc/unbound/unbound.conf.d/mastodon.conf
+server:
+  interface: 127.0.0.1
+  access-control: 127.0.0.0/8 allow
+  do-ip6: no
+  num-threads: 2
+  so-reuseport: yes
+  msg-cache-size: 32m
+  rrset-cache-size: 64m
+  # TTL floor for remote domains that publish very short TTLs, and a cap on cached NXDOMAIN and NODATA
+  cache-min-ttl: 60
+  cache-max-ttl: 86400
+  cache-max-negative-ttl: 900
+  # refresh names still in use before they expire, and answer from cache when the VPC resolver is slow
+  prefetch: yes
+  serve-expired: yes
+  serve-expired-ttl: 86400
+  serve-expired-client-timeout: 1800
+  # DNSSEC validation is left to the VPC resolver, so private hosted zones resolve
+  module-config: "iterator"
+  extended-statistics: yes
+  # read and reset every minute by mastodon-dns-metrics
+  statistics-cumulative: no
+remote-control:
+  control-enable: yes
+  control-interface: /run/unbound.ctl
+forward-zone:
+  name: "."
+  forward-addr: 169.254.169.253
+# Aurora and ElastiCache endpoints change on failover with short TTLs, so they are never cached
+forward-zone:
+  name: "rds.amazonaws.com"
+  forward-addr: 169.254.169.253
+  forward-no-cache: yes
+forward-zone:
+  name: "cache.amazonaws.com"
+  forward-addr: 169.254.169.253
+  forward-no-cache: yes
+EOF
+rm -f /etc/unbound/unbound.conf.d/root-auto-trust-anchor-file.conf /etc/unbound/unbound.conf.d/remote-control.conf
+unbound-checkconf
+systemctl enable unbound
+if [ "$IN_DOCKER" != "true" ]; then
+  systemctl restart unbound
+  mkdir -p /etc/systemd/resolved.conf.d
+  printf '[Resolve]\nDNSStubListener=no\n' > /etc/systemd/resolved.conf.d/mastodon-unbound.conf
+  systemctl restart systemd-resolved
+  rm -f /etc/resolv.conf
+  cat <<EOF > /etc/resolv.conf
+# unbound, then the VPC resolver directly if unbound doesn't answer
+nameserver 127.0.0.1
+nameserver 169.254.169.253
+options edns0 timeout:1 attempts:2
+EOF
+fi
+# cache hit rate to the CloudWatch agent's statsd listener, configured in /etc/mastodon/amazon-cloudwatch-agent.json below
+echo "* * * * * root /usr/local/bin/mastodon-dns-metrics >> /var/log/mastodon-dns-metrics.log 2>&1" > /etc/cron.d/mastodon-dns-metrics
+
+# publish sidekiq queue latency and size to CloudWatch for the stack dashboard
+cat <<'EOF' > /usr/local/bin/mastodon-sidekiq-metrics
+#!/bin/bash
+set -euo pipefail
+
+STACK_NAME=$(cat /opt/oe/patterns/stack-name.txt 2>/dev/null || true)
+[ -n "$STACK_NAME" ] || exit 0
+REDIS_HOST=$(grep '^REDIS_HOST=' /home/mastodon/live/.env.production | cut -d= -f2)
+REDIS_PORT=$(grep '^REDIS_PORT=' /home/mastodon/live/.env.production | cut -d= -f2)
+REDIS="redis-cli -h $REDIS_HOST -p $REDIS_PORT --raw"
+
+DATA="[]"
+for QUEUE in $($REDIS SMEMBERS queues); do
+  SIZE=$($REDIS LLEN "queue:$QUEUE")
+  OLDEST=$($REDIS LINDEX "queue:$QUEUE" -1)
+  [ -n "$OLDEST" ] || OLDEST='{}'
+  DATA=$(echo "$OLDEST" | jq -c \
+    --argjson data "$DATA" \
+    --argjson now "$(date +%s.%N)" \
+    --argjson size "$SIZE" \
+    --arg queue "$QUEUE" \
+    --arg stack "$STACK_NAME" '
+    # sidekiq < 8 stores enqueued_at in seconds, sidekiq 8 in milliseconds
+    (.enqueued_at // $now | if . > 100000000000 then . / 1000 else . end) as $enqueued
+    | [{"Name": "Queue", "Value": $queue}, {"Name": "StackName", "Value": $stack}] as $dims
+    | $data + [
+        {"MetricName": "SidekiqQueueLatency", "Unit": "Seconds", "Value": ([$now - $enqueued, 0] | max), "Dimensions": $dims},
+        {"MetricName": "SidekiqQueueSize", "Unit": "Count", "Value": $size, "Dimensions": $dims}
+      ]')
+done
+
+if [ "$DATA" != "[]" ]; then
+  aws cloudwatch put-metric-data --namespace Mastodon --metric-data "$DATA"
+fi
+EOF
+chmod 755 /usr/local/bin/mastodon-sidekiq-metrics
+
+# media workers: instance role from the MastodonRole instance tag (IMDS), "app" when untagged
+cat <<'EOF' > /usr/local/bin/mastodon-instance-role
+#!/bin/bash
+TOKEN=$(curl -sf -X PUT -H "X-aws-ec2-metadata-token-ttl-seconds: 60" http://169.254.169.254/latest/api/token)
+curl -sf -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/tags/instance/MastodonRole || echo app
+EOF
+chmod 755 /usr/local/bin/mastodon-instance-role
+
+# media workers: run only sidekiq, on the media queue first and remote fetches second
+cat <<'EOF' > /usr/local/bin/mastodon-media-worker-setup
+#!/bin/bash
+set -e
+CONCURRENCY=$(( $(nproc) * 2 ))
+mkdir -p /etc/systemd/system/mastodon-sidekiq.service.d
+cat <<CONF > /etc/systemd/system/mastodon-sidekiq.service.d/media-worker.conf
+[Service]
+Environment="DB_POOL=$CONCURRENCY"
+MemoryHigh=75%
+MemoryMax=85%
+# sidekiq -t 45 plus time to push unfinished jobs back to Redis; see mastodon-sidekiq-drain for the budget
+TimeoutStopSec=60
+ExecStart=
+ExecStart=/home/mastodon/.rbenv/shims/bundle exec sidekiq -c $CONCURRENCY -t 45 -q media,4 -q pull
+CONF
+systemctl disable --now mastodon-web mastodon-streaming nginx
+systemctl daemon-reload
+systemctl restart mastodon-sidekiq
+systemctl enable --now mastodon-sidekiq-drain
+EOF
+chmod 755 /usr/local/bin/mastodon-media-worker-setup
+
+# egress caching proxy: user data passes the CA secret ARN; the proxy URL is "disabled" unless it is enabled
+cat <<'EOF' > /usr/local/bin/mastodon-egress-proxy-setup
+#!/bin/bash
+set -e
+STACK_NAME=$(cat /opt/oe/patterns/stack-name.txt)
+URL=$(aws ssm get-parameter --name "/$STACK_NAME/egress-proxy/url" --query Parameter.Value --output text || echo disabled)
+[ "$URL" != "disabled" ] || exit 0
+# the proxy presents HTTPS certificates signed by its own CA
+aws secretsmanager get-secret-value --secret-id "$1" --query SecretString --output text \
+| jq -r .certificate > /usr/local/share/ca-certificates/mastodon-egress-proxy.crt
+update-ca-certificates
+# no_proxy matches NO_PROXY in cdk/mastodon/egress_proxy.py
+cat <<ENV >> /home/mastodon/live/.env.production
+http_proxy=$URL
+no_proxy=localhost,127.0.0.1,169.254.169.254,169.254.170.2,.amazonaws.com,.internal
+ENV
+EOF
+chmod 755 /usr/local/bin/mastodon-egress-proxy-setup
+
+# media workers: quiet sidekiq (TSTP) on a Spot interruption notice or rebalance recommendation, and on
+# scale-in or rebalancing stop it (unfinished jobs go back to Redis) before completing the lifecycle hook.
+# Scale-in: quiet period (30s) + stop (TimeoutStopSec 60) + polling (5s) fits the 180s hook heartbeat.
+# Spot interruption: the stop starts at once and fits the two minute notice
+cat <<'EOF' > /usr/local/bin/mastodon-sidekiq-drain
+#!/bin/bash
+IMDS=http://169.254.169.254/latest
+HOOK=sidekiq-drain
+QUIET_SECONDS=30
+QUIETED=""
+while true; do
+  TOKEN=$(curl -sf -X PUT -H "X-aws-ec2-metadata-token-ttl-seconds: 60" $IMDS/api/token)
+  get() { curl -sf -H "X-aws-ec2-metadata-token: $TOKEN" $IMDS/meta-data/$1; }
+  STATE=$(get autoscaling/target-lifecycle-state)
+  SPOT_ACTION=$(get spot/instance-action)
+  NOTICE=$SPOT_ACTION$(get events/recommendations/rebalance)
+  if [ -z "$QUIETED" ] && { [ -n "$NOTICE" ] || [ "$STATE" = "Terminated" ]; }; then
+    echo "quieting sidekiq: ${NOTICE:-lifecycle state $STATE}"
+    systemctl kill -s TSTP mastodon-sidekiq
+    QUIETED=$SECONDS
+  fi
+  if [ "$STATE" = "Terminated" ] || [ -n "$SPOT_ACTION" ]; then
+    # let running jobs finish without new work before the stop, unless Spot is about to reclaim the instance
+    WAIT=$((QUIETED + QUIET_SECONDS - SECONDS))
+    if [ -z "$SPOT_ACTION" ] && [ $WAIT -gt 0 ]; then
+      sleep $WAIT
+    fi
+    systemctl stop mastodon-sidekiq
+    INSTANCE_ID=$(get instance-id)
+    REGION=$(get placement/region)
+    ASG_NAME=$(aws autoscaling describe-auto-scaling-instances --region $REGION --instance-ids $INSTANCE_ID \
+      --query 'AutoScalingInstances[0].AutoScalingGroupName' --output text)
+    aws autoscaling complete-lifecycle-action --region $REGION --lifecycle-hook-name $HOOK \
+      --auto-scaling-group-name $ASG_NAME --instance-id $INSTANCE_ID --lifecycle-action-result CONTINUE || true
+    exit 0
+  fi
+  sleep 5
+done
+EOF
+chmod 755 /usr/local/bin/mastodon-sidekiq-drain
+cat <<EOF > /etc/systemd/system/mastodon-sidekiq-drain.service
+[Unit]
+Description=Drain mastodon-sidekiq before Spot interruption or Auto Scaling termination
+After=mastodon-sidekiq.service
+
+[Service]
+ExecStart=/usr/local/bin/mastodon-sidekiq-drain
+SyslogIdentifier=mastodon-sidekiq-drain
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+# app instances: close streaming connections at jittered times across the ALB deregistration delay, starting
+# when the target turns draining, then complete the streaming-drain lifecycle hook; enabled by user data on
+# app instances
+cat <<EOF > /etc/systemd/system/mastodon-streaming-drain.service
+[Unit]
+Description=Drain mastodon-streaming connections before Auto Scaling termination
+After=mastodon-streaming.service
+
+[Service]
+ExecStart=/usr/local/bin/mastodon-streaming-drain
+SyslogIdentifier=mastodon-streaming-drain
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+# route media jobs to the media queue only when the stack runs media workers to consume it
+cat <<'EOF' > /home/mastodon/live/config/initializers/oe_media_queue.rb
+if ENV['MEDIA_WORKERS_ENABLED'] == 'true'
+  Rails.application.config.after_initialize do
+    [PostProcessMediaWorker, RedownloadMediaWorker, RedownloadAvatarWorker, RedownloadHeaderWorker].each do |worker|
+      worker.sidekiq_options queue: 'media'
+    end
+  end
+end
+EOF
+chown mastodon:mastodon /home/mastodon/live/config/initializers/oe_media_queue.rb
+
+# live configuration from SSM Parameter Store, started by user_data once .env.production exists
+cat <<EOF > /etc/systemd/system/mastodon-config-agent.service
+[Unit]
+Description=Apply Mastodon configuration from SSM Parameter Store
+After=network-online.target
+
+[Service]
+ExecStart=/usr/local/bin/mastodon-config-agent
+Restart=always
+RestartSec=30
+SyslogIdentifier=mastodon-config-agent
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+# scratch space: mount NVMe instance storage, if the instance type has any, on every boot and point
+# temp files from puma, sidekiq, ImageMagick, libvips and ffmpeg at it. Instance storage is blank after
+# a stop/start but keeps its array and filesystem across a reboot, so both are reused when present.
+# The drop-ins are only written once the mount is up; until then the services use /tmp
+cat <<'EOF' > /usr/local/bin/mastodon-scratch-setup
+#!/bin/bash
+set -e
+DEVICES=$(lsblk -dpno NAME,MODEL | awk '/Instance Storage/ {print $1}')
+[ -n "$DEVICES" ] || exit 0
+if [ $(echo "$DEVICES" | wc -l) -gt 1 ]; then
+  # after a reboot the array is usually assembled already, as /dev/md127
+  mdadm --assemble --scan 2>/dev/null || true
+  DEVICE=$(mdadm --detail --scan | awk '$1 == "ARRAY" {print $2; exit}')
+  if [ -z "$DEVICE" ]; then
+    mdadm --create /dev/md0 --run --level=0 --raid-devices=$(echo "$DEVICES" | wc -l) $DEVICES
+    DEVICE=/dev/md0
+  fi
+else
+  DEVICE=$DEVICES
+fi
+mkdir -p /mnt/scratch
+if ! mountpoint -q /mnt/scratch; then
+  [ "$(blkid -o value -s TYPE $DEVICE || true)" = "ext4" ] || mkfs.ext4 -F -q -E nodiscard $DEVICE
+  mount -o noatime $DEVICE /mnt/scratch
+fi
+mkdir -p /mnt/scratch/tmp
+chmod 1777 /mnt/scratch/tmp
+for SERVICE in mastodon-web mastodon-sidekiq; do
+  mkdir -p /run/systemd/system/$SERVICE.service.d
+  # recreate the directory on start, so a missing mount leaves a usable TMPDIR on the root volume
+  cat <<CONF > /run/systemd/system/$SERVICE.service.d/scratch.conf
+[Service]
+Environment="TMPDIR=/mnt/scratch/tmp" "MAGICK_TEMPORARY_PATH=/mnt/scratch/tmp"
+ExecStartPre=+/usr/bin/install -d -m 1777 /mnt/scratch/tmp
+CONF
+done
+systemctl daemon-reload
+EOF
+chmod 755 /usr/local/bin/mastodon-scratch-setup
+cat <<EOF > /etc/systemd/system/mastodon-scratch.service
+[Unit]
+Description=Mount instance storage as Mastodon scratch space
+Before=mastodon-web.service mastodon-sidekiq.service
+
+[Service]
+Type=oneshot
+ExecStart=/usr/local/bin/mastodon-scratch-setup
+RemainAfterExit=true
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+# CloudWatch agent config, completed with the stack's log group names by user_data.sh. statsd receives
+# the unbound cache counters from mastodon-dns-metrics; ethtool counts packets dropped by the VPC
+# resolver's rate limit (linklocal_allowance_exceeded)
+mkdir -p /etc/mastodon
+cat <<'EOF' > /etc/mastodon/amazon-cloudwatch-agent.json
+{
+  "agent": {
+    "metrics_collection_interval": 60,
+    "run_as_user": "root",
+    "logfile": "/opt/aws/amazon-cloudwatch-agent/logs/amazon-cloudwatch-agent.log"
+  },
+  "metrics": {
+    "metrics_collected": {
+      "collectd": {
+        "metrics_aggregation_interval": 60
+      },
+      "ethtool": {
+        "metrics_include": ["linklocal_allowance_exceeded"]
+      },
+      "statsd": {
+        "service_address": "127.0.0.1:8125",
+        "metrics_aggregation_interval": 60
+      },
+      "disk": {
+        "measurement": ["used_percent"],
+        "metrics_collection_interval": 60,
+        "resources": ["*"]
+      },
+      "mem": {
+        "measurement": ["mem_used_percent"],
+        "metrics_collection_interval": 60
+      }
+    },
+    "append_dimensions": {
+      "ImageId": "${aws:ImageId}",
+      "InstanceId": "${aws:InstanceId}",
+      "InstanceType": "${aws:InstanceType}",
+      "AutoScalingGroupName": "${aws:AutoScalingGroupName}"
+    }
+  },
+  "logs": {
+    "logs_collected": {
+      "files": {
+        "collect_list": [
+          {
+            "file_path": "/opt/aws/amazon-cloudwatch-agent/logs/amazon-cloudwatch-agent.log",
+            "log_group_name": "@SYSTEM_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/opt/aws/amazon-cloudwatch-agent/logs/amazon-cloudwatch-agent.log",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/var/log/dpkg.log",
+            "log_group_name": "@SYSTEM_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/var/log/dpkg.log",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/var/log/apt/history.log",
+            "log_group_name": "@SYSTEM_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/var/log/apt/history.log",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/var/log/cloud-init.log",
+            "log_group_name": "@SYSTEM_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/var/log/cloud-init.log",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/var/log/cloud-init-output.log",
+            "log_group_name": "@SYSTEM_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/var/log/cloud-init-output.log",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/var/log/auth.log",
+            "log_group_name": "@SYSTEM_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/var/log/auth.log",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/var/log/syslog",
+            "log_group_name": "@SYSTEM_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/var/log/syslog",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/var/log/amazon/ssm/amazon-ssm-agent.log",
+            "log_group_name": "@SYSTEM_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/var/log/amazon/ssm/amazon-ssm-agent.log",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/var/log/amazon/ssm/errors.log",
+            "log_group_name": "@SYSTEM_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/var/log/amazon/ssm/errors.log",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/var/log/nginx/access.log",
+            "log_group_name": "@APP_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/var/log/nginx/access.log",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/var/log/nginx/error.log",
+            "log_group_name": "@APP_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/var/log/nginx/error.log",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/var/log/mastodon-web.log",
+            "log_group_name": "@APP_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/var/log/mastodon-web.log",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/var/log/mastodon-sidekiq.log",
+            "log_group_name": "@APP_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/var/log/mastodon-sidekiq.log",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/var/log/mastodon-streaming.log",
+            "log_group_name": "@APP_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/var/log/mastodon-streaming.log",
+            "timezone": "UTC"
+          },
+          {
+            "file_path": "/home/mastodon/live/log/crons.log",
+            "log_group_name": "@APP_LOG_GROUP@",
+            "log_stream_name": "{instance_id}-/home/mastodon/live/log/crons.log",
+            "timezone": "UTC"
+          }
+        ]
+      }
+    },
+    "log_stream_name": "{instance_id}"
+  }
+}
+EOF
+
 # log rotation
 cat <<EOF > /etc/logrotate.d/mastodon
 /home/mastodon/live/log/crons.log {
@@ -103,10 +610,28 @@ cat <<EOF > /etc/logrotate.d/mastodon
   su root root
   rotate 4
 }
+/var/log/mastodon-worker-recycler.log {
+  size 10M
+  copytruncate
+  su root root
+  rotate 4
+}
+/var/log/mastodon-redis-guard.log {
+  size 10M
+  copytruncate
+  su root root
+  rotate 4
+}
+/var/log/mastodon-dns-metrics.log {
+  size 10M
+  copytruncate
+  su root root
+  rotate 4
+}
 EOF
 
 systemctl daemon-reload
-systemctl enable mastodon-web mastodon-sidekiq mastodon-streaming
+systemctl enable mastodon-scratch mastodon-web mastodon-sidekiq mastodon-streaming
 
 # install custom rake task for generating secrets at initial provisioning
 cat <<EOF > /home/mastodon/live/lib/tasks/oe.rake
@@ -194,6 +719,37 @@ EOF
 chown root:root /root/check-secrets.py
 chmod 744 /root/check-secrets.py
 
+# per-table autovacuum settings and extensions that complement the stack's db parameter groups
+cat <<EOF > /root/db-tuning.sql
+CREATE EXTENSION IF NOT EXISTS pg_stat_statements;
+
+DO \$\$
+DECLARE
+  t text;
+BEGIN
+  FOREACH t IN ARRAY ARRAY['statuses', 'notifications', 'home_feeds', 'status_stats', 'account_stats', 'favourites', 'mentions'] LOOP
+    IF to_regclass(t) IS NOT NULL THEN
+      EXECUTE format(
+        'ALTER TABLE %I SET (autovacuum_vacuum_scale_factor = 0.01, autovacuum_analyze_scale_factor = 0.005, autovacuum_vacuum_insert_scale_factor = 0.01, autovacuum_vacuum_cost_limit = 4000)',
+        t
+      );
+    END IF;
+  END LOOP;
+END
+\$\$;
+EOF
+chown root:root /root/db-tuning.sql
+chmod 644 /root/db-tuning.sql
+
+# tools uploaded to /tmp/files by packer
+install -m 755 /tmp/files/mastodon_slow_queries.py /usr/local/bin/mastodon-slow-queries
+install -m 755 /tmp/files/mastodon_image_benchmark.py /usr/local/bin/mastodon-image-benchmark
+install -m 755 /tmp/files/mastodon_worker_recycler.py /usr/local/bin/mastodon-worker-recycler
+install -m 755 /tmp/files/mastodon_config_agent.py /usr/local/bin/mastodon-config-agent
+install -m 755 /tmp/files/mastodon_redis_guard.py /usr/local/bin/mastodon-redis-guard
+install -m 755 /tmp/files/mastodon_streaming_drain.py /usr/local/bin/mastodon-streaming-drain
+install -m 755 /tmp/files/mastodon_dns_metrics.py /usr/local/bin/mastodon-dns-metrics
+
 # remove default site
 rm -f /etc/nginx/sites-enabled/default
 
@@ -4,16 +4,22 @@ AWS Marketplace submission automation script.
 
 Submits a new AMI version to AWS Marketplace using the Catalog API.
 Replaces the deprecated Product Load Form (PLF) spreadsheet workflow.
+
+The template and diagram are published, and the AMI is optionally copied to
+other regions, concurrently before the changeset is submitted. With --wait,
+the script only tracks changesets submitted earlier.
 """
 
 import argparse
 import json
+import random
 import re
 import subprocess
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
 import boto3
 import yaml
@@ -125,9 +131,9 @@ class ConfigLoader:
 class MarketplaceSubmitter:
     """Handle AWS Marketplace API interactions."""
 
-    def __init__(self, config: Dict):
+    def __init__(self, config: Dict, client=None):
         self.config = config
-        self.client = boto3.client('marketplace-catalog', region_name='us-east-1')
+        self.client = client or boto3.client('marketplace-catalog', region_name='us-east-1')
 
     def build_payload(self, ami_id: str, version: str, release_notes: str) -> Dict:
         """
@@ -214,16 +220,47 @@ class MarketplaceSubmitter:
 
 
 class ChangesetPoller:
-    """Poll changeset status until complete or timeout."""
+    """
+    Poll changeset status until complete or a wall-clock deadline.
+
+    The interval starts short, since validation errors come back quickly, and
+    grows by `backoff` up to `max_interval`. Each wait is jittered so several
+    changesets (or several releases) don't poll in lockstep, and API errors
+    such as throttling back off the same way.
+    """
+
+    TERMINAL_STATUSES = ('SUCCEEDED', 'FAILED', 'CANCELLED')
 
-    def __init__(self, client):
+    def __init__(
+        self,
+        client,
+        initial_interval: float = 5,
+        max_interval: float = 60,
+        backoff: float = 1.5,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+        rng: Optional[random.Random] = None
+    ):
         self.client = client
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = rng or random.Random()
+
+    def next_interval(self, interval: float) -> float:
+        """The next base interval after `interval`."""
+        return min(interval * self.backoff, self.max_interval)
+
+    def jittered(self, interval: float) -> float:
+        """A wait between half and all of the interval."""
+        return interval / 2 + self.rng.uniform(0, interval / 2)
 
     def poll_until_complete(
         self,
         changeset_id: str,
-        timeout: int = 900,
-        interval: int = 30
+        timeout: float = 900
     ) -> Tuple[str, Optional[str]]:
         """
         Poll changeset status until completion or timeout.
@@ -231,43 +268,116 @@ class ChangesetPoller:
         Args:
             changeset_id: The changeset ID to monitor
             timeout: Maximum time to poll in seconds (default: 15 minutes)
-            interval: Polling interval in seconds (default: 30 seconds)
 
         Returns:
             Tuple of (status, error_message)
             status: SUCCEEDED, FAILED, PREPARING, APPLYING, or CANCELLED
             error_message: Error details if status is FAILED, None otherwise
         """
-        elapsed = 0
-        while elapsed < timeout:
+        return self.poll_many([changeset_id], timeout)[changeset_id]
+
+    def poll_many(
+        self,
+        changeset_ids: List[str],
+        timeout: float = 900
+    ) -> Dict[str, Tuple[str, Optional[str]]]:
+        """
+        Poll several changesets at once, each on its own schedule.
+
+        Returns:
+            Dictionary of changeset ID to (status, error_message). Changesets
+            still in progress at the deadline have their last known status.
+        """
+        start = self.clock()
+        deadline = start + timeout
+        results = {changeset_id: ('PREPARING', None) for changeset_id in changeset_ids}
+        # changeset ID -> (next poll time, current base interval)
+        schedule = {changeset_id: (start, self.initial_interval) for changeset_id in changeset_ids}
+
+        while schedule:
+            changeset_id, (due, interval) = min(schedule.items(), key=lambda item: item[1][0])
+            now = self.clock()
+            if due > now:
+                if due >= deadline:
+                    break
+                self.sleep(due - now)
+                now = self.clock()
+            if now >= deadline:
+                break
+
+            label = f"  [{now - start:.0f}s]" + (f" {changeset_id}" if len(changeset_ids) > 1 else "")
             try:
                 response = self.client.describe_change_set(
                     Catalog='AWSMarketplace',
                     ChangeSetId=changeset_id
                 )
-
                 status = response['Status']
-                print(f"  [{elapsed}s] Status: {status}")
+                print(f"{label} Status: {status}")
+                if status in self.TERMINAL_STATUSES:
+                    error_msg = response.get('FailureDescription', 'Unknown error') if status == 'FAILED' else None
+                    results[changeset_id] = (status, error_msg)
+                    del schedule[changeset_id]
+                    continue
+                results[changeset_id] = (status, None)
+            except Exception as e:
+                print(f"{label} Error polling status: {e}")
 
-                if status in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
-                    error_msg = None
-                    if status == 'FAILED':
-                        # Extract error details
-                        errors = response.get('FailureDescription', 'Unknown error')
-                        error_msg = errors
+            schedule[changeset_id] = (self.clock() + self.jittered(interval), self.next_interval(interval))
 
-                    return status, error_msg
+        return results
 
-                time.sleep(interval)
-                elapsed += interval
 
-            except Exception as e:
-                print(f"  Error polling status: {e}")
-                time.sleep(interval)
-                elapsed += interval
+class AmiDistributor:
+    """Copy an AMI to other regions concurrently and wait for the copies."""
+
+    def __init__(self, source_region: str = 'us-east-1', session=None, max_attempts: int = 120):
+        self.source_region = source_region
+        self.session = session or boto3.session.Session()
+        # image_available polls every 15 seconds; the default allows 30 minutes per copy
+        self.max_attempts = max_attempts
+
+    def source_name(self, ami_id: str) -> str:
+        ec2 = self.session.client('ec2', region_name=self.source_region)
+        return ec2.describe_images(ImageIds=[ami_id])['Images'][0]['Name']
+
+    def copy_to_region(self, ami_id: str, name: str, region: str) -> str:
+        ec2 = self.session.client('ec2', region_name=region)
+        image_id = ec2.copy_image(
+            Name=name,
+            SourceImageId=ami_id,
+            SourceRegion=self.source_region,
+            CopyImageTags=True
+        )['ImageId']
+        print(f"  Copying {ami_id} to {region} as {image_id}")
+        ec2.get_waiter('image_available').wait(
+            ImageIds=[image_id],
+            WaiterConfig={'Delay': 15, 'MaxAttempts': self.max_attempts}
+        )
+        return image_id
+
+
+def run_concurrently(steps: Dict[str, Callable[[], object]]) -> Dict[str, object]:
+    """
+    Run the steps in parallel threads and return their results by name.
 
-        # Timeout reached
-        return 'PREPARING', None
+    Raises:
+        The first step failure, after every step has finished
+    """
+    results = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(len(steps), 1)) as executor:
+        futures = {executor.submit(step): name for name, step in steps.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+                print(f"✓ {name}")
+            except Exception as e:
+                print(f"❌ {name} failed")
+                errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
 
 
 def validate_ami_id(ami_id: str) -> bool:
@@ -282,12 +392,39 @@ def validate_version(version: str) -> bool:
     return bool(re.match(pattern, version))
 
 
-def run_publish_steps(version: str) -> None:
+def make(target: str, version: str) -> None:
+    """Run a make target, printing its output in one piece when it finishes."""
+    result = subprocess.run(
+        ['make', target, f'TEMPLATE_VERSION={version}'],
+        capture_output=True,
+        text=True
+    )
+    print(f"--- make {target} ---\n{result.stdout}{result.stderr}", end="")
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+
+
+def run_publish_steps(
+    version: str,
+    ami_id: Optional[str] = None,
+    regions: Optional[List[str]] = None,
+    distributor: Optional[AmiDistributor] = None
+) -> Dict[str, str]:
     """
-    Run make publish and make publish-diagram.
+    Run make publish and then make publish-diagram, while the AMI is copied
+    to the target regions concurrently.
+
+    The make targets come from common.mk and may share prerequisites such as
+    the devenv image build, so they run one after the other. The AMI copies
+    only call the EC2 API and run alongside them.
 
     Args:
         version: Template version
+        ami_id: AMI to copy
+        regions: Regions to copy the AMI to
+
+    Returns:
+        Dictionary of region to copied AMI ID
 
     Raises:
         subprocess.CalledProcessError: If make command fails
@@ -296,39 +433,74 @@ def run_publish_steps(version: str) -> None:
     print("✓ Extracted release notes from CHANGELOG.md")
     print("✓ Loaded configuration from plf_config.yaml")
 
-    # Run make publish
-    print("📤 Publishing template to S3...")
-    subprocess.run(
-        ['make', 'publish', f'TEMPLATE_VERSION={version}'],
-        check=True,
-        capture_output=False
-    )
-    print("✓ Published template to S3")
-
-    # Run make publish-diagram
-    print("📤 Publishing diagram to S3...")
-    subprocess.run(
-        ['make', 'publish-diagram', f'TEMPLATE_VERSION={version}'],
-        check=True,
-        capture_output=False
-    )
-    print("✓ Published diagram to S3")
+    def publish():
+        make('publish', version)
+        make('publish-diagram', version)
+
+    steps = {"Published template and diagram to S3": publish}
+    if regions:
+        distributor = distributor or AmiDistributor()
+        name = distributor.source_name(ami_id)
+        for region in regions:
+            steps[f"Copied AMI to {region}"] = (lambda region=region: distributor.copy_to_region(ami_id, name, region))
+
+    print(f"📤 Publishing template and diagram to S3{' and copying the AMI to ' + ', '.join(regions) if regions else ''}...")
+    results = run_concurrently(steps)
+    return {region: results[f"Copied AMI to {region}"] for region in regions or []}
+
+
+def wait_for_changesets(poller: ChangesetPoller, changeset_ids: List[str], timeout: float) -> int:
+    """Track changesets submitted earlier; exit status 1 if any failed or was cancelled."""
+    print(f"⏳ Polling {len(changeset_ids)} changeset(s)...")
+    results = poller.poll_many(changeset_ids, timeout)
+    print()
+    exit_code = 0
+    for changeset_id, (status, error_msg) in results.items():
+        print(f"{changeset_id}: {status}" + (f" - {error_msg}" if error_msg else ""))
+        if status in ('FAILED', 'CANCELLED'):
+            exit_code = 1
+    return exit_code
 
 
 def main():
     parser = argparse.ArgumentParser(
         description='Submit new AMI version to AWS Marketplace'
     )
-    parser.add_argument('ami_id', help='AMI ID (e.g., ami-0e95cf48ef6e3b89f)')
-    parser.add_argument('version', help='Version string (e.g., 2.3.0)')
+    parser.add_argument('ami_id', nargs='?', help='AMI ID (e.g., ami-0e95cf48ef6e3b89f)')
+    parser.add_argument('version', nargs='?', help='Version string (e.g., 2.3.0)')
     parser.add_argument(
         '--dry-run',
         action='store_true',
         help='Use Intent=VALIDATE instead of APPLY (test mode)'
     )
+    parser.add_argument(
+        '--regions',
+        type=lambda value: [region for region in value.split(',') if region],
+        default=[],
+        help='Comma-separated regions to copy the AMI to while publishing'
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=900,
+        help='Seconds to poll changesets for (default: 900)'
+    )
+    parser.add_argument(
+        '--wait',
+        nargs='+',
+        metavar='CHANGESET_ID',
+        help='Only poll these previously submitted changesets until they finish'
+    )
 
     args = parser.parse_args()
 
+    if args.wait:
+        client = boto3.client('marketplace-catalog', region_name='us-east-1')
+        sys.exit(wait_for_changesets(ChangesetPoller(client), args.wait, args.timeout))
+
+    if not args.ami_id or not args.version:
+        parser.error('ami_id and version are required unless --wait is given')
+
     # Validate inputs
     if not validate_ami_id(args.ami_id):
         print(f"❌ Error: Invalid AMI ID format: {args.ami_id}")
@@ -354,8 +526,10 @@ def main():
         loader = ConfigLoader(config_path)
         config = loader.load_config()
 
-        # Run publish steps
-        run_publish_steps(args.version)
+        # Run publish steps and AMI copies
+        copies = run_publish_steps(args.version, args.ami_id, args.regions)
+        for region, image_id in copies.items():
+            print(f"  {region}: {image_id}")
 
         # Build payload
         submitter = MarketplaceSubmitter(config)
@@ -374,7 +548,7 @@ def main():
         # Poll for status
         print(f"\n⏳ Polling changeset status...")
         poller = ChangesetPoller(submitter.client)
-        status, error_msg = poller.poll_until_complete(changeset_id)
+        status, error_msg = poller.poll_until_complete(changeset_id, args.timeout)
 
         # Display results
         print()
@@ -401,9 +575,11 @@ def main():
 
         else:
             # Timeout
-            print(f"⏳ Changeset still {status} after 15 minutes")
+            print(f"⏳ Changeset still {status} after {args.timeout:.0f} seconds")
             print(f"\nChangeset ID: {changeset_id}")
             print(f"Status: {status}")
+            print(f"\nWait for it with:")
+            print(f"make submit-marketplace-wait CHANGESET_IDS={changeset_id}")
             print(f"\nCheck status with:")
             print(f"aws marketplace-catalog describe-change-set \\")
             print(f"  --catalog AWSMarketplace \\")
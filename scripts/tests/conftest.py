@@ -0,0 +1,60 @@
+"""
+Shared fixtures for tests of the release scripts.
+
+The AWS clients are real boto3 clients wrapped in botocore Stubbers, so no
+credentials or network access are needed.
+"""
+
+import importlib.util
+from pathlib import Path
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+SCRIPTS = Path(__file__).parent.parent
+
+
+def load_script(name: str):
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), SCRIPTS / f"{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def stubbed_client(service: str, region: str = "us-east-1"):
+    client = boto3.client(service, region_name=region, aws_access_key_id="testing", aws_secret_access_key="testing")
+    return client, Stubber(client)
+
+
+@pytest.fixture(scope="session")
+def submit_marketplace():
+    return load_script("submit-marketplace")
+
+
+@pytest.fixture
+def catalog():
+    client, stubber = stubbed_client("marketplace-catalog")
+    with stubber:
+        yield client, stubber
+    stubber.assert_no_pending_responses()
+
+
+class FakeClock:
+    """Clock and sleep for the poller, so tests don't wait."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,155 @@
+"""
+Tests for scripts/submit-marketplace.py with stubbed Catalog and EC2 clients.
+"""
+
+import random
+import subprocess
+import threading
+
+import pytest
+
+from conftest import stubbed_client
+
+CHANGESET = {"Catalog": "AWSMarketplace", "ChangeSetId": "cs-1"}
+
+
+def status(stubber, value, changeset_id="cs-1", **extra):
+    stubber.add_response(
+        "describe_change_set",
+        {"Status": value, **extra},
+        {"Catalog": "AWSMarketplace", "ChangeSetId": changeset_id}
+    )
+
+
+@pytest.fixture
+def poller(submit_marketplace, catalog, clock):
+    client, _ = catalog
+    return submit_marketplace.ChangesetPoller(client, clock=clock, sleep=clock.sleep, rng=random.Random(1))
+
+
+class TestChangesetPoller:
+
+    def test_backoff_with_jitter(self, poller, catalog, clock):
+        _, stubber = catalog
+        for value in ["PREPARING"] * 6 + ["SUCCEEDED"]:
+            status(stubber, value)
+
+        assert poller.poll_until_complete("cs-1") == ("SUCCEEDED", None)
+        bases = [5, 7.5, 11.25, 16.875, 25.3125, 37.96875]
+        assert len(clock.sleeps) == len(bases)
+        for slept, base in zip(clock.sleeps, bases):
+            assert base / 2 <= slept <= base
+        assert len(set(round(s / b, 6) for s, b in zip(clock.sleeps, bases))) > 1
+
+    def test_interval_is_capped(self, poller):
+        interval = 5
+        for _ in range(20):
+            interval = poller.next_interval(interval)
+        assert interval == 60
+
+    def test_deadline_counts_time_spent_in_calls(self, poller, catalog, clock):
+        client, stubber = catalog
+        # every describe_change_set call takes 20 seconds
+        client.meta.events.register("before-call.*.*", lambda **kwargs: setattr(clock, "now", clock.now + 20))
+        for _ in range(4):
+            status(stubber, "APPLYING")
+
+        assert poller.poll_until_complete("cs-1", timeout=100) == ("APPLYING", None)
+        assert clock.now <= 100 + 20
+        stubber.assert_no_pending_responses()
+
+    def test_failure_description(self, poller, catalog):
+        _, stubber = catalog
+        status(stubber, "FAILED", FailureDescription="Version already exists")
+        assert poller.poll_until_complete("cs-1") == ("FAILED", "Version already exists")
+
+    def test_errors_back_off_and_retry(self, poller, catalog, clock):
+        _, stubber = catalog
+        stubber.add_client_error("describe_change_set", "ThrottlingException", expected_params=CHANGESET)
+        status(stubber, "SUCCEEDED")
+        assert poller.poll_until_complete("cs-1") == ("SUCCEEDED", None)
+        assert len(clock.sleeps) == 1
+
+    def test_poll_many(self, poller, catalog, clock):
+        _, stubber = catalog
+        # both are polled first, then each on its own schedule until it finishes
+        status(stubber, "PREPARING", "cs-1")
+        status(stubber, "FAILED", "cs-2", FailureDescription="Invalid AMI")
+        status(stubber, "APPLYING", "cs-1")
+        status(stubber, "SUCCEEDED", "cs-1")
+
+        assert poller.poll_many(["cs-1", "cs-2"]) == {
+            "cs-1": ("SUCCEEDED", None),
+            "cs-2": ("FAILED", "Invalid AMI"),
+        }
+
+    def test_wait_exit_status(self, submit_marketplace, poller, catalog):
+        _, stubber = catalog
+        status(stubber, "SUCCEEDED", "cs-1")
+        status(stubber, "CANCELLED", "cs-2")
+        assert submit_marketplace.wait_for_changesets(poller, ["cs-1", "cs-2"], 900) == 1
+
+
+class TestSubmitter:
+
+    def test_submit_changeset(self, submit_marketplace, catalog):
+        client, stubber = catalog
+        config = {
+            "Product ID": "prod-123", "Marketplace Access Role ARN": "arn:aws:iam::123456789012:role/mp",
+            "CloudFormation Parameter Name": "AsgAmiId", "Template Base URL": "https://example.com/t",
+            "Diagram Base URL": "https://example.com/d", "Operating System": "UBUNTU", "Operating System Version": "24.04",
+            "Operating System Username": "ubuntu", "Recommended Instance Type": "t3.large",
+            "Short Description": "short", "Full Description": "full", "Product Access Instructions": "instructions",
+        }
+        submitter = submit_marketplace.MarketplaceSubmitter(config, client=client)
+        payload = submitter.build_payload("ami-0123456789abcdef0", "2.4.0", "* notes")
+        stubber.add_response("start_change_set", {"ChangeSetId": "cs-9", "ChangeSetArn": "arn:cs-9"}, payload)
+        assert submitter.submit_changeset(payload) == "cs-9"
+
+
+class TestPublishSteps:
+
+    def test_steps_run_concurrently(self, submit_marketplace):
+        barrier = threading.Barrier(3, timeout=5)
+        results = submit_marketplace.run_concurrently({name: (lambda name=name: (barrier.wait(), name)[1]) for name in "abc"})
+        assert results == {"a": "a", "b": "b", "c": "c"}
+
+    def test_failure_is_raised_after_the_other_steps(self, submit_marketplace):
+        finished = threading.Event()
+
+        def fail():
+            raise subprocess.CalledProcessError(2, ["make", "publish"])
+
+        with pytest.raises(subprocess.CalledProcessError):
+            submit_marketplace.run_concurrently({"fail": fail, "slow": lambda: finished.wait(0.2) or finished.set()})
+        assert finished.is_set()
+
+    def test_publish_and_copy_ami(self, submit_marketplace, monkeypatch):
+        made = []
+        monkeypatch.setattr(submit_marketplace, "make", lambda target, version: made.append((target, version)))
+
+        clients = {}
+        source, source_stubber = stubbed_client("ec2", "us-east-1")
+        source_stubber.add_response("describe_images", {"Images": [{"Name": "mastodon-2.4.0"}]}, {"ImageIds": ["ami-0123456789abcdef0"]})
+        clients["us-east-1"] = source
+        for n, region in enumerate(["us-west-2", "eu-west-1"]):
+            client, stubber = stubbed_client("ec2", region)
+            copy = f"ami-{n:017x}"
+            stubber.add_response("copy_image", {"ImageId": copy}, {
+                "Name": "mastodon-2.4.0", "SourceImageId": "ami-0123456789abcdef0",
+                "SourceRegion": "us-east-1", "CopyImageTags": True
+            })
+            stubber.add_response("describe_images", {"Images": [{"ImageId": copy, "State": "available"}]}, {"ImageIds": [copy]})
+            stubber.activate()
+            clients[region] = client
+        source_stubber.activate()
+
+        class Session:
+            def client(self, service, region_name):
+                return clients[region_name]
+
+        distributor = submit_marketplace.AmiDistributor(session=Session())
+        copies = submit_marketplace.run_publish_steps("2.4.0", "ami-0123456789abcdef0", ["us-west-2", "eu-west-1"], distributor)
+        assert copies == {"us-west-2": "ami-00000000000000000", "eu-west-1": "ami-00000000000000001"}
+        # the make targets may share prerequisites, so they run in order
+        assert made == [("publish", "2.4.0"), ("publish-diagram", "2.4.0")]
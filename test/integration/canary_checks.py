@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Synthetic monitoring checks for a Mastodon deployment.
+
+The same checks as test_health.py: the health endpoint returns OK, the
+instance API returns the instance's domain and version, and the home page
+responds within the maximum response time. Each check's latency and success
+are published to CloudWatch as Mastodon/CanaryLatency and
+Mastodon/CanarySuccess, with Check, Location and StackName dimensions.
+
+This file only uses the standard library (and boto3 to publish), so the CDK
+stack inlines it as the code of the canary Lambda functions, which run it
+every minute from inside the VPC and from the internet. It also runs locally:
+
+    python canary_checks.py --base-url https://mastodon.example.com
+    python canary_checks.py --base-url http://127.0.0.1:8080   # against stub_server.py
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Tuple
+
+NAMESPACE = "Mastodon"
+USER_AGENT = "OE-Patterns-Canary/1.0"
+
+
+def fetch(url: str, timeout: float) -> Tuple[int, bytes, float]:
+    """Status, body and elapsed seconds of a GET; connection errors raise URLError."""
+    request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status, body = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, body = e.code, e.read()
+    return status, body, time.monotonic() - start
+
+
+def check_health(base_url: str, max_response_time: float, timeout: float) -> Tuple[bool, float, str]:
+    status, body, elapsed = fetch(f"{base_url}/health", timeout)
+    ok = status == 200 and body.strip() == b"OK"
+    return ok, elapsed, f"status {status}"
+
+
+def check_instance_api(base_url: str, max_response_time: float, timeout: float) -> Tuple[bool, float, str]:
+    status, body, elapsed = fetch(f"{base_url}/api/v2/instance", timeout)
+    if status != 200:
+        return False, elapsed, f"status {status}"
+    try:
+        instance = json.loads(body)
+    except ValueError:
+        return False, elapsed, "response is not JSON"
+    ok = bool(instance.get("domain") and instance.get("version"))
+    return ok, elapsed, f"version {instance.get('version')}"
+
+
+def check_response_time(base_url: str, max_response_time: float, timeout: float) -> Tuple[bool, float, str]:
+    status, _, elapsed = fetch(base_url, timeout)
+    ok = status in (200, 301, 302) and elapsed < max_response_time
+    return ok, elapsed, f"status {status} in {elapsed:.2f}s (max {max_response_time}s)"
+
+
+CHECKS = {
+    "health": check_health,
+    "instance_api": check_instance_api,
+    "response_time": check_response_time,
+}
+
+
+def run_checks(base_url: str, max_response_time: float = 5.0, timeout: float = 20.0) -> List[Dict]:
+    results = []
+    for name, check in CHECKS.items():
+        start = time.monotonic()
+        try:
+            ok, elapsed, detail = check(base_url.rstrip("/"), max_response_time, timeout)
+        except (urllib.error.URLError, OSError) as e:
+            ok, elapsed, detail = False, time.monotonic() - start, str(getattr(e, "reason", e))
+        results.append({"check": name, "success": ok, "latency_ms": round(elapsed * 1000, 1), "detail": detail})
+    return results
+
+
+def metric_data(results: List[Dict], location: str, stack_name: str) -> List[Dict]:
+    data = []
+    for result in results:
+        dimensions = [
+            {"Name": "Check", "Value": result["check"]},
+            {"Name": "Location", "Value": location},
+            {"Name": "StackName", "Value": stack_name},
+        ]
+        data.append({"MetricName": "CanarySuccess", "Unit": "Count", "Value": 1 if result["success"] else 0, "Dimensions": dimensions})
+        data.append({"MetricName": "CanaryLatency", "Unit": "Milliseconds", "Value": result["latency_ms"], "Dimensions": dimensions})
+    return data
+
+
+def publish(results: List[Dict], location: str, stack_name: str, region: str = None) -> None:
+    import boto3
+
+    boto3.client("cloudwatch", region_name=region).put_metric_data(
+        Namespace=NAMESPACE, MetricData=metric_data(results, location, stack_name)
+    )
+
+
+def handler(event, context):
+    """Lambda entry point, configured through the function's environment."""
+    results = run_checks(os.environ["BASE_URL"], float(os.environ.get("MAX_RESPONSE_TIME", "5")))
+    publish(results, os.environ["LOCATION"], os.environ["STACK_NAME"])
+    print(json.dumps({"location": os.environ["LOCATION"], "results": results}))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Mastodon synthetic monitoring checks once")
+    parser.add_argument("--base-url", default=os.environ.get("TEST_BASE_URL"), required="TEST_BASE_URL" not in os.environ)
+    parser.add_argument("--max-response-time", type=float, default=5.0, help="Seconds the home page may take (default: 5)")
+    parser.add_argument("--location", default="local", help="Location dimension of the published metrics (default: local)")
+    parser.add_argument("--stack-name", help="Publish the results as CloudWatch metrics for this stack")
+    parser.add_argument("--region", default=os.environ.get("AWS_REGION"))
+    args = parser.parse_args(argv)
+
+    results = run_checks(args.base_url, args.max_response_time)
+    for result in results:
+        print(f"{'ok  ' if result['success'] else 'FAIL'} {result['check']:<14} {result['latency_ms']:>8.1f}ms  {result['detail']}")
+    if args.stack_name:
+        publish(results, args.location, args.stack_name, args.region)
+    return 0 if all(result["success"] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,8 @@ import pytest
 import boto3
 from pathlib import Path
 
+from web_vitals import INIT_SCRIPT, WebVitalsReport, collect
+
 
 def pytest_addoption(parser):
     """Add custom command line options."""
@@ -30,6 +32,18 @@ def pytest_addoption(parser):
         default=False,
         help="Skip UI/browser tests"
     )
+    parser.addoption(
+        "--web-vitals-report",
+        action="store",
+        default="reports/web-vitals.jsonl",
+        help="JSON-lines file for page timings collected by UI tests"
+    )
+
+
+def pytest_sessionstart(session):
+    """Start a fresh web vitals report; with pytest-xdist only the controller does this."""
+    if not hasattr(session.config, "workerinput"):
+        WebVitalsReport(session.config.getoption("--web-vitals-report")).reset()
 
 
 @pytest.fixture(scope="session")
@@ -122,12 +136,120 @@ def instance_id(ec2_client, stack_name):
         pytest.fail(f"Failed to get instance ID: {e}")
 
 
+@pytest.fixture(scope="session")
+def browser():
+    """Chromium for UI tests, one per pytest-xdist worker."""
+    from playwright.sync_api import sync_playwright
+
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=True)
+        yield browser
+        browser.close()
+
+
+def new_context(browser, **kwargs):
+    context = browser.new_context(
+        viewport={"width": 1280, "height": 720},
+        user_agent="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36",
+        **kwargs
+    )
+    context.add_init_script(INIT_SCRIPT)
+    return context
+
+
+@pytest.fixture
+def browser_context(browser):
+    """A fresh browser context per test, so every page load starts from a cold cache."""
+    context = new_context(browser)
+    yield context
+    context.close()
+
+
+@pytest.fixture(scope="session")
+def test_user_credentials(config):
+    """
+    Credentials of a pre-created test user, from TEST_USER_EMAIL and TEST_USER_PASSWORD.
+
+    Create the user with tootctl:
+
+    sudo su - mastodon -c 'cd ~/live && RAILS_ENV=production bin/tootctl \
+      accounts create testuser --email test@example.com --confirmed --role User'
+    """
+    email = os.environ.get("TEST_USER_EMAIL")
+    password = os.environ.get("TEST_USER_PASSWORD")
+    if not email or not password:
+        pytest.skip("TEST_USER_EMAIL and TEST_USER_PASSWORD are required for logged in UI tests")
+    return {"email": email, "password": password}
+
+
+@pytest.fixture(scope="session")
+def auth_state(request, browser, base_url, test_user_credentials, tmp_path_factory):
+    """
+    Path of a storage state file with a logged in session.
+
+    The first worker to get here logs in and saves the state; the others wait
+    on the lock and reuse it, so the suite logs in once however many workers run.
+    """
+    from filelock import FileLock
+
+    root = tmp_path_factory.getbasetemp()
+    if hasattr(request.config, "workerinput"):
+        # each worker has its own basetemp under a directory shared by the run
+        root = root.parent
+    state = root / "auth-state.json"
+    with FileLock(str(state) + ".lock"):
+        if not state.exists():
+            context = new_context(browser)
+            page = context.new_page()
+            page.goto(f"{base_url}/auth/sign_in", wait_until="domcontentloaded", timeout=30000)
+            page.fill("#user_email", test_user_credentials["email"])
+            page.fill("#user_password", test_user_credentials["password"])
+            page.click('button[type="submit"]')
+            page.wait_for_url(lambda url: "sign_in" not in url, timeout=30000)
+            context.storage_state(path=str(state))
+            context.close()
+    return str(state)
+
+
+@pytest.fixture
+def authenticated_context(browser, auth_state):
+    """A fresh browser context logged in as the test user."""
+    context = new_context(browser, storage_state=auth_state)
+    yield context
+    context.close()
+
+
+@pytest.fixture(scope="session")
+def web_vitals_report(request):
+    return WebVitalsReport(request.config.getoption("--web-vitals-report"))
+
+
+@pytest.fixture
+def record_web_vitals(web_vitals_report):
+    """Collect the timings of a loaded page and append them to the report."""
+    def record(page, page_name):
+        return web_vitals_report.append(page_name, page.url, collect(page))
+    return record
+
+
 @pytest.fixture(scope="session")
 def skip_ui_tests(request):
     """Check if UI tests should be skipped."""
     return request.config.getoption("--skip-ui")
 
 
+def pytest_terminal_summary(terminalreporter, config):
+    """Print the page timings collected by this run."""
+    if hasattr(config, "workerinput"):
+        return
+    report = WebVitalsReport(config.getoption("--web-vitals-report"))
+    if report.records():
+        terminalreporter.section("web vitals")
+        for line in report.table():
+            terminalreporter.write_line(line)
+        terminalreporter.write_line(f"report: {report.path}")
+
+
 def pytest_collection_modifyitems(config, items):
     """Modify test collection to handle skip markers."""
     skip_ui = config.getoption("--skip-ui")
@@ -137,3 +259,10 @@ def pytest_collection_modifyitems(config, items):
         for item in items:
             if "ui" in item.keywords:
                 item.add_marker(skip_ui_marker)
+
+    # load tests put real traffic on the deployment, so they only run when asked for
+    if "load" not in (config.getoption("-m") or ""):
+        skip_load_marker = pytest.mark.skip(reason="load tests only run with -m load")
+        for item in items:
+            if "load" in item.keywords:
+                item.add_marker(skip_load_marker)
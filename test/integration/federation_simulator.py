@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+"""
+ActivityPub federation ingress simulator.
+
+Runs a fake remote instance: an HTTP server that serves WebFinger, actors
+with their public keys and notes. It then delivers Create, Announce and Like
+activities from those actors to the target instance's inbox at a fixed rate,
+signed with HTTP Signatures the way Mastodon signs them. Each activity is
+delivered fan-out times, cycling over the inbox URLs, as a remote instance
+does when it delivers to several followers' inboxes.
+
+It reports how many deliveries the inbox accepted per second. With
+--stack-name it then reads the SidekiqQueueSize and SidekiqQueueLatency
+metrics the instances publish for the ingress queue, and reports how long the
+queue took to drain. Those metrics are published every minute, so the drain
+time has one-minute resolution.
+
+The target verifies every signature by fetching the actor's key from the fake
+instance. For a real deployment the fake instance must be reachable at
+--public-url over HTTPS with a valid certificate and a public address.
+
+Usage:
+    python federation_simulator.py --target-url https://mastodon.example.com \\
+        --public-url https://fake-remote.example.net --listen 0.0.0.0:8443 \\
+        --actors 50 --rate 20 --duration 120 --fan-out 2 --stack-name mastodon-prod
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import formatdate
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+from aiohttp import web
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from load_generator import USER_AGENT, LatencyHistogram
+
+ACTIVITY_JSON = "application/activity+json"
+AS_CONTEXT = ["https://www.w3.org/ns/activitystreams", "https://w3id.org/security/v1"]
+PUBLIC = "https://www.w3.org/ns/activitystreams#Public"
+SIGNED_HEADERS = ["(request-target)", "host", "date", "digest", "content-type"]
+DEFAULT_MIX = {"Create": 70, "Announce": 20, "Like": 10}
+
+
+def generate_key() -> rsa.RSAPrivateKey:
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def public_key_pem(key: rsa.RSAPrivateKey) -> str:
+    return key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
+
+
+def digest(body: bytes) -> str:
+    return "SHA-256=" + base64.b64encode(hashlib.sha256(body).digest()).decode()
+
+
+def signing_string(method: str, path: str, headers: Dict[str, str], signed_headers: List[str]) -> str:
+    """The signed text; headers are keyed by lower-case name."""
+    lines = []
+    for name in signed_headers:
+        if name == "(request-target)":
+            lines.append(f"(request-target): {method.lower()} {path}")
+        else:
+            lines.append(f"{name}: {headers[name]}")
+    return "\n".join(lines)
+
+
+def sign_request(url: str, body: bytes, key_id: str, key: rsa.RSAPrivateKey, date: str = None) -> Dict[str, str]:
+    """Headers for a signed POST of body to url (draft-cavage HTTP Signatures, rsa-sha256)."""
+    parsed = urlparse(url)
+    headers = {
+        "host": parsed.netloc,
+        "date": date or formatdate(usegmt=True),
+        "digest": digest(body),
+        "content-type": ACTIVITY_JSON,
+    }
+    path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+    signature = key.sign(signing_string("POST", path, headers, SIGNED_HEADERS).encode(), padding.PKCS1v15(), hashes.SHA256())
+    headers["signature"] = (
+        f'keyId="{key_id}",algorithm="rsa-sha256",headers="{" ".join(SIGNED_HEADERS)}",'
+        f'signature="{base64.b64encode(signature).decode()}"'
+    )
+    return headers
+
+
+def parse_signature(header: str) -> Dict[str, str]:
+    return dict(re.findall(r'(\w+)="([^"]*)"', header or ""))
+
+
+def verify_signature(method: str, path: str, headers, body: bytes, pem: str) -> bool:
+    """Check a signed request the way a receiving inbox does, including the body digest."""
+    params = parse_signature(headers.get("Signature"))
+    signed_headers = params.get("headers", "date").split()
+    if "digest" in signed_headers and headers.get("Digest") != digest(body):
+        return False
+    lowered = {name.lower(): value for name, value in headers.items()}
+    if not all(name == "(request-target)" or name in lowered for name in signed_headers):
+        return False
+    key = serialization.load_pem_public_key(pem.encode())
+    try:
+        key.verify(
+            base64.b64decode(params.get("signature", "")),
+            signing_string(method, path, lowered, signed_headers).encode(),
+            padding.PKCS1v15(), hashes.SHA256()
+        )
+    except (InvalidSignature, ValueError):
+        return False
+    return True
+
+
+class FakeInstance:
+    """
+    A remote instance with actors named user0, user1, ... Run with
+    "async with FakeInstance(...) as public_url:"; public_url is where the
+    target reaches it, which defaults to the listening address.
+    """
+
+    def __init__(self, actors: int = 10, host: str = "127.0.0.1", port: int = 0, public_url: str = None):
+        self.names = [f"user{i}" for i in range(actors)]
+        self.keys = {name: generate_key() for name in self.names}
+        self.host = host
+        self.port = port
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.domain = None
+        self.fetches = {}
+        self.runner = None
+
+    def actor_id(self, name: str) -> str:
+        return f"{self.public_url}/users/{name}"
+
+    def key_id(self, name: str) -> str:
+        return f"{self.actor_id(name)}#main-key"
+
+    def actor(self, name: str) -> Dict:
+        actor_id = self.actor_id(name)
+        return {
+            "@context": AS_CONTEXT,
+            "id": actor_id,
+            "type": "Person",
+            "preferredUsername": name,
+            "name": f"Federation simulator {name}",
+            "url": actor_id,
+            "inbox": f"{actor_id}/inbox",
+            "outbox": f"{actor_id}/outbox",
+            "followers": f"{actor_id}/followers",
+            "following": f"{actor_id}/following",
+            "endpoints": {"sharedInbox": f"{self.public_url}/inbox"},
+            "publicKey": {"id": self.key_id(name), "owner": actor_id, "publicKeyPem": public_key_pem(self.keys[name])},
+        }
+
+    def note(self, name: str, n: int, mention: str = None) -> Dict:
+        actor_id = self.actor_id(name)
+        note_id = f"{actor_id}/statuses/{n}"
+        # simulate() numbers activities from the current time in milliseconds
+        published = datetime.fromtimestamp(n / 1000, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        note = {
+            "id": note_id,
+            "type": "Note",
+            "attributedTo": actor_id,
+            "content": f"<p>Federation simulator status {n}</p>",
+            "published": published,
+            "url": note_id,
+            "to": [PUBLIC],
+            "cc": [f"{actor_id}/followers"],
+        }
+        if mention:
+            note["cc"].append(mention)
+            note["tag"] = [{"type": "Mention", "href": mention}]
+        return note
+
+    def activity(self, kind: str, name: str, n: int, like_object: str = None, mention: str = None) -> Dict:
+        actor_id = self.actor_id(name)
+        activity = {
+            "@context": AS_CONTEXT,
+            "id": f"{actor_id}/activities/{n}",
+            "type": kind,
+            "actor": actor_id,
+            "to": [PUBLIC],
+            "cc": [f"{actor_id}/followers"],
+        }
+        if kind == "Create":
+            activity["object"] = self.note(name, n, mention)
+        elif kind == "Announce":
+            # boost another actor's note, which the target fetches from us
+            activity["object"] = self.note(self.names[(self.names.index(name) + 1) % len(self.names)], n)["id"]
+        else:
+            activity["object"] = like_object or self.note(name, n)["id"]
+        return activity
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._count])
+        app.router.add_get("/.well-known/webfinger", self._webfinger)
+        app.router.add_get("/users/{name}", self._actor)
+        app.router.add_get(r"/users/{name}/statuses/{n:\d+}", self._note)
+        for collection in ("outbox", "followers", "following"):
+            app.router.add_get(f"/users/{{name}}/{collection}", self._collection)
+        return app
+
+    @web.middleware
+    async def _count(self, request, handler):
+        self.fetches[request.path] = self.fetches.get(request.path, 0) + 1
+        return await handler(request)
+
+    def _name(self, request) -> str:
+        name = request.match_info["name"]
+        if name not in self.keys:
+            raise web.HTTPNotFound()
+        return name
+
+    async def _webfinger(self, request):
+        match = re.fullmatch(r"acct:([^@]+)@(.+)", request.query.get("resource", ""))
+        if not match or match.group(1) not in self.keys or match.group(2) != self.domain:
+            raise web.HTTPNotFound()
+        return web.json_response({
+            "subject": request.query["resource"],
+            "links": [{"rel": "self", "type": ACTIVITY_JSON, "href": self.actor_id(match.group(1))}],
+        }, content_type="application/jrd+json")
+
+    async def _actor(self, request):
+        return web.json_response(self.actor(self._name(request)), content_type=ACTIVITY_JSON)
+
+    async def _note(self, request):
+        note = dict(self.note(self._name(request), int(request.match_info["n"])), **{"@context": AS_CONTEXT})
+        return web.json_response(note, content_type=ACTIVITY_JSON)
+
+    async def _collection(self, request):
+        return web.json_response({
+            "@context": AS_CONTEXT, "id": str(request.url), "type": "OrderedCollection", "totalItems": 0, "orderedItems": []
+        }, content_type=ACTIVITY_JSON)
+
+    async def __aenter__(self) -> str:
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        if not self.public_url:
+            self.public_url = f"http://{self.host}:{self.runner.addresses[0][1]}"
+        self.domain = urlparse(self.public_url).netloc
+        return self.public_url
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+class IngressResult:
+
+    def __init__(self, rate: float, fan_out: int):
+        self.rate = rate
+        self.fan_out = fan_out
+        self.activities: Dict[str, int] = {}
+        self.statuses: Dict[str, int] = {}
+        self.deliveries = 0
+        self.accepted = 0
+        self.latency = LatencyHistogram()
+        self.elapsed = 0.0
+        self.queue: Optional[Dict] = None
+
+    def record(self, latency_us: int, status: str, ok: bool) -> None:
+        self.deliveries += 1
+        self.accepted += ok
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latency.record(latency_us)
+
+    def summary(self) -> Dict:
+        return {
+            "target_rate": self.rate,
+            "fan_out": self.fan_out,
+            "elapsed": self.elapsed,
+            "activities": dict(sorted(self.activities.items())),
+            "deliveries": self.deliveries,
+            "accepted": self.accepted,
+            "accepted_per_second": self.accepted / self.elapsed if self.elapsed else 0.0,
+            "statuses": dict(sorted(self.statuses.items())),
+            "latency_ms": {
+                "p50": self.latency.percentile(50) / 1000,
+                "p90": self.latency.percentile(90) / 1000,
+                "p99": self.latency.percentile(99) / 1000,
+                "max": (self.latency.max or 0) / 1000,
+            },
+            "ingress_queue": self.queue,
+        }
+
+
+def format_summary(summary: Dict) -> str:
+    latency = summary["latency_ms"]
+    activities = ", ".join(f"{count} {kind}" for kind, count in summary["activities"].items())
+    statuses = ", ".join(f"{status}: {count}" for status, count in summary["statuses"].items())
+    lines = [
+        f"activities: {activities} (fan-out {summary['fan_out']})",
+        f"deliveries: {summary['accepted']}/{summary['deliveries']} accepted in {summary['elapsed']:.1f}s, "
+        f"{summary['accepted_per_second']:.1f}/s (target {summary['target_rate'] * summary['fan_out']:.1f}/s)",
+        f"responses: {statuses}",
+        f"latency ms: p50 {latency['p50']:.1f}, p90 {latency['p90']:.1f}, p99 {latency['p99']:.1f}, max {latency['max']:.1f}",
+    ]
+    queue = summary["ingress_queue"]
+    if queue:
+        drained = f"within {queue['drain_seconds']:.0f}s of the last delivery" if queue["drain_seconds"] is not None else "not drained"
+        lines.append(
+            f"ingress queue: peak {queue['peak_size']:.0f} jobs, peak latency {queue['peak_latency']:.0f}s, {drained}"
+        )
+    return "\n".join(lines)
+
+
+async def _deliver(session, semaphore, inbox, body, key_id, key, result, scheduled, loop):
+    async with semaphore:
+        headers = sign_request(inbox, body, key_id, key)
+        try:
+            async with session.post(inbox, data=body, headers=headers) as response:
+                await response.read()
+                status, ok = str(response.status), response.status < 300
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status, ok = type(e).__name__, False
+    result.record(int((loop.time() - scheduled) * 1_000_000), status, ok)
+
+
+async def simulate(
+    instance: FakeInstance,
+    inboxes: List[str],
+    rate: float,
+    duration: float,
+    fan_out: int = 1,
+    mix: Dict[str, int] = None,
+    like_object: str = None,
+    mention: str = None,
+    max_concurrency: int = 200,
+    timeout: float = 30,
+    seed: int = None,
+) -> IngressResult:
+    """Deliver rate activities per second for duration seconds, each to fan_out inboxes."""
+    mix = mix or DEFAULT_MIX
+    kinds, weights = list(mix), list(mix.values())
+    rng = random.Random(seed)
+    result = IngressResult(rate, fan_out)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    inbox_cycle = itertools.cycle(inboxes)
+    # activity ids must be unique across runs or the target ignores them as duplicates
+    first = int(time.time() * 1000)
+    loop = asyncio.get_running_loop()
+
+    async with aiohttp.ClientSession(
+        headers={"User-Agent": f"{USER_AGENT} (federation simulator; +{instance.public_url})", "Accept": ACTIVITY_JSON},
+        timeout=aiohttp.ClientTimeout(total=timeout),
+        connector=aiohttp.TCPConnector(limit=max_concurrency),
+    ) as session:
+        start = loop.time()
+        tasks = []
+        for i in range(int(rate * duration)):
+            scheduled = start + i / rate
+            delay = scheduled - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind = rng.choices(kinds, weights)[0]
+            name = rng.choice(instance.names)
+            activity = instance.activity(kind, name, first + i, like_object, mention)
+            result.activities[kind] = result.activities.get(kind, 0) + 1
+            body = json.dumps(activity).encode()
+            for _ in range(fan_out):
+                tasks.append(asyncio.create_task(_deliver(
+                    session, semaphore, next(inbox_cycle), body, instance.key_id(name), instance.keys[name], result, scheduled, loop
+                )))
+        await asyncio.gather(*tasks)
+        result.elapsed = loop.time() - start
+    return result
+
+
+def queue_stats(datapoints: Dict[str, List[Dict]], sent_end: datetime, period: int = 60) -> Dict:
+    """
+    Peak ingress queue size and latency, and how long after sent_end the
+    queue drained: the end of the first period after sent_end whose maximum
+    size was 0, or None if it has not drained yet.
+    """
+    sizes = sorted(datapoints.get("SidekiqQueueSize", []), key=lambda p: p["Timestamp"])
+    latencies = datapoints.get("SidekiqQueueLatency", [])
+    drain_seconds = None
+    for point in sizes:
+        end = point["Timestamp"] + timedelta(seconds=period)
+        if end > sent_end and point["Maximum"] == 0:
+            drain_seconds = (end - sent_end).total_seconds()
+            break
+    return {
+        "peak_size": max((p["Maximum"] for p in sizes), default=0),
+        "peak_latency": max((p["Maximum"] for p in latencies), default=0),
+        "drain_seconds": drain_seconds,
+    }
+
+
+def wait_for_drain(stack_name: str, region: str, started: datetime, sent_end: datetime, timeout: float, poll: float = 30) -> Dict:
+    import boto3
+
+    cloudwatch = boto3.client("cloudwatch", region_name=region)
+    dimensions = [{"Name": "Queue", "Value": "ingress"}, {"Name": "StackName", "Value": stack_name}]
+    deadline = time.time() + timeout
+    while True:
+        datapoints = {
+            metric: cloudwatch.get_metric_statistics(
+                Namespace="Mastodon", MetricName=metric, Dimensions=dimensions,
+                StartTime=started - timedelta(minutes=1), EndTime=datetime.now(timezone.utc) + timedelta(minutes=1),
+                Period=60, Statistics=["Maximum"],
+            )["Datapoints"]
+            for metric in ("SidekiqQueueSize", "SidekiqQueueLatency")
+        }
+        stats = queue_stats(datapoints, sent_end)
+        if stats["drain_seconds"] is not None or time.time() > deadline:
+            return stats
+        time.sleep(poll)
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip().capitalize()
+        if kind not in DEFAULT_MIX or not weight.isdigit():
+            raise argparse.ArgumentTypeError(f"expected e.g. create=70,announce=20,like=10, got {value}")
+        mix[kind] = int(weight)
+    return mix
+
+
+async def run(args) -> IngressResult:
+    host, _, port = args.listen.rpartition(":")
+    instance = FakeInstance(args.actors, host, int(port), args.public_url)
+    async with instance as public_url:
+        print(f"fake instance serving {args.actors} actors at {public_url}", file=sys.stderr)
+        target = args.target_url.rstrip("/")
+        inboxes = [inbox if inbox.startswith("http") else target + inbox for inbox in args.inbox or ["/inbox"]]
+        started = datetime.now(timezone.utc)
+        result = await simulate(
+            instance, inboxes, args.rate, args.duration, args.fan_out, args.mix, args.like_object, args.mention, seed=args.seed
+        )
+        if args.stack_name:
+            # keep serving actors and notes while the target works through the queue
+            print("waiting for the ingress queue to drain", file=sys.stderr)
+            result.queue = await asyncio.get_running_loop().run_in_executor(
+                None, wait_for_drain, args.stack_name, args.region, started, datetime.now(timezone.utc), args.drain_timeout
+            )
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deliver signed ActivityPub activities from a fake remote instance to an inbox")
+    parser.add_argument("--target-url", default=os.environ.get("TEST_BASE_URL"), required="TEST_BASE_URL" not in os.environ)
+    parser.add_argument("--public-url", help="URL the target reaches the fake instance at (default: the listening address)")
+    parser.add_argument("--listen", default="127.0.0.1:8443", help="host:port to serve actors on (default: 127.0.0.1:8443)")
+    parser.add_argument("--actors", type=int, default=10, help="Fake actors, each with its own key (default: 10)")
+    parser.add_argument("--rate", type=float, default=10, help="Activities per second (default: 10)")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to send activities for (default: 60)")
+    parser.add_argument("--fan-out", type=int, default=1, help="Deliveries per activity, cycling over --inbox (default: 1)")
+    parser.add_argument("--inbox", action="append", help="Inbox path or URL, repeatable (default: /inbox)")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="Activity weights (default: create=70,announce=20,like=10)")
+    parser.add_argument("--like-object", help="Status URL to Like (default: the fake instance's own notes)")
+    parser.add_argument("--mention", help="Local actor URL to mention in Create, so the statuses are stored")
+    parser.add_argument("--seed", type=int, help="Seed for the activity mix")
+    parser.add_argument("--stack-name", default=os.environ.get("TEST_STACK_NAME"), help="Report ingress queue drain time from this stack's Sidekiq metrics")
+    parser.add_argument("--region", default=os.environ.get("AWS_REGION"))
+    parser.add_argument("--drain-timeout", type=float, default=900, help="Seconds to wait for the ingress queue to drain (default: 900)")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    summary = asyncio.run(run(args)).summary()
+    print(json.dumps(summary, indent=2) if args.json else format_summary(summary))
+    return 0 if summary["accepted"] == summary["deliveries"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
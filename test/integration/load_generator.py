@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Asynchronous load generator for the Mastodon API.
+
+Replays a weighted mix of API scenarios at a fixed request rate and reports
+throughput, error rate and latency percentiles. Requests are started on an
+open-loop schedule: latency is measured from the time a request was due to
+start, not when a connection became free, so a slow server shows up in the
+percentiles instead of silently lowering the request rate (coordinated
+omission).
+
+Scenarios that need an OAuth access token (home timeline, posting statuses)
+or an account to look up are skipped when those are not provided.
+
+Usage:
+    python load_generator.py --base-url https://mastodon.example.com --rate 20 --duration 60
+    python load_generator.py --base-url ... --token $TEST_ACCESS_TOKEN --account admin --json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+USER_AGENT = "OE-Patterns-Load-Test/1.0"
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of latencies in microseconds.
+
+    Values are bucketed on a log-linear scale so every recorded value is kept
+    to the given number of significant figures (3 by default, i.e. within
+    0.1%) while memory stays bounded no matter how many values are recorded.
+    """
+
+    def __init__(self, significant_figures: int = 3):
+        self.significant_figures = significant_figures
+        self.sub_bucket_bits = math.ceil(math.log2(2 * 10 ** significant_figures))
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value: int) -> Tuple[int, int]:
+        """Lowest and highest value that are recorded in the same bucket as value."""
+        shift = max(0, value.bit_length() - self.sub_bucket_bits)
+        lowest = (value >> shift) << shift
+        return lowest, lowest + (1 << shift) - 1
+
+    def record(self, value_us: int) -> None:
+        value_us = max(0, int(value_us))
+        lowest, _ = self._bucket(value_us)
+        self.counts[lowest] = self.counts.get(lowest, 0) + 1
+        self.count += 1
+        self.total += value_us
+        self.min = value_us if self.min is None else min(self.min, value_us)
+        self.max = value_us if self.max is None else max(self.max, value_us)
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        for lowest, count in other.counts.items():
+            self.counts[lowest] = self.counts.get(lowest, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            "significant_figures": self.significant_figures,
+            "counts": {str(lowest): count for lowest, count in sorted(self.counts.items())},
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "LatencyHistogram":
+        histogram = cls(data["significant_figures"])
+        histogram.counts = {int(lowest): count for lowest, count in data["counts"].items()}
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
+
+    def percentile(self, percentile: float) -> int:
+        """Value at the given percentile (0-100), reported as the top of its bucket like HdrHistogram."""
+        if not self.count:
+            return 0
+        # round first so float error in e.g. 99.9 / 100 * 20000 doesn't skip a value
+        target = max(1, math.ceil(round(percentile / 100 * self.count, 6)))
+        seen = 0
+        for lowest in sorted(self.counts):
+            seen += self.counts[lowest]
+            if seen >= target:
+                return min(self._bucket(lowest)[1], self.max)
+        return self.max
+
+
+@dataclass
+class Scenario:
+    """
+    One weighted API request.
+
+    path and data values are formatted with the run context, e.g. {account},
+    and {n}, a counter that keeps posted statuses unique. needs lists the
+    context keys (token, account) the scenario cannot run without.
+    """
+    name: str
+    weight: int
+    path: str
+    method: str = "GET"
+    data: Optional[Dict[str, str]] = None
+    needs: Tuple[str, ...] = ()
+
+
+DEFAULT_SCENARIOS = [
+    Scenario("public_timeline", 35, "/api/v1/timelines/public?limit=20"),
+    Scenario("instance", 20, "/api/v2/instance"),
+    Scenario("account_lookup", 15, "/api/v1/accounts/lookup?acct={account}", needs=("account",)),
+    Scenario("home_timeline", 25, "/api/v1/timelines/home?limit=20", needs=("token",)),
+    Scenario(
+        "post_status", 5, "/api/v1/statuses", method="POST",
+        data={"status": "Load test status {n}", "visibility": "private"},
+        needs=("token",)
+    ),
+]
+
+
+def active_scenarios(scenarios: List[Scenario], context: Dict[str, Optional[str]]) -> List[Scenario]:
+    """Scenarios whose needs are all present in the context."""
+    return [s for s in scenarios if all(context.get(need) for need in s.needs)]
+
+
+@dataclass
+class ScenarioResult:
+    requests: int = 0
+    errors: int = 0
+    statuses: Dict[str, int] = field(default_factory=dict)
+    latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+    # successful responses by the second of the run they completed in
+    completed: Dict[int, int] = field(default_factory=dict)
+
+    def record(self, latency_us: int, status: str, ok: bool, second: int = 0) -> None:
+        self.requests += 1
+        if ok:
+            self.completed[second] = self.completed.get(second, 0) + 1
+        else:
+            self.errors += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latency.record(latency_us)
+
+    def per_second(self, seconds: int) -> List[int]:
+        """Successful responses in each whole second of the run, the samples for throughput comparisons."""
+        return [self.completed.get(second, 0) for second in range(seconds)]
+
+
+@dataclass
+class LoadResult:
+    target_rate: float
+    elapsed: float = 0.0
+    scenarios: Dict[str, ScenarioResult] = field(default_factory=dict)
+
+    def record(self, scenario: str, latency_us: int, status: str, ok: bool, second: int = 0) -> None:
+        self.scenarios.setdefault(scenario, ScenarioResult()).record(latency_us, status, ok, second)
+
+    def overall(self) -> ScenarioResult:
+        overall = ScenarioResult()
+        for result in self.scenarios.values():
+            overall.requests += result.requests
+            overall.errors += result.errors
+            for status, count in result.statuses.items():
+                overall.statuses[status] = overall.statuses.get(status, 0) + count
+            for second, count in result.completed.items():
+                overall.completed[second] = overall.completed.get(second, 0) + count
+            overall.latency.merge(result.latency)
+        return overall
+
+    def summary(self) -> Dict:
+        def describe(result: ScenarioResult) -> Dict:
+            return {
+                "requests": result.requests,
+                "errors": result.errors,
+                "error_rate": result.errors / result.requests if result.requests else 0.0,
+                "throughput": result.requests / self.elapsed if self.elapsed else 0.0,
+                "statuses": dict(sorted(result.statuses.items())),
+                "latency_ms": {
+                    "min": (result.latency.min or 0) / 1000,
+                    "mean": result.latency.mean() / 1000,
+                    "p50": result.latency.percentile(50) / 1000,
+                    "p90": result.latency.percentile(90) / 1000,
+                    "p99": result.latency.percentile(99) / 1000,
+                    "p99.9": result.latency.percentile(99.9) / 1000,
+                    "max": (result.latency.max or 0) / 1000,
+                },
+            }
+
+        return {
+            "target_rate": self.target_rate,
+            "elapsed": self.elapsed,
+            "overall": describe(self.overall()),
+            "scenarios": {name: describe(result) for name, result in sorted(self.scenarios.items())},
+        }
+
+
+def format_summary(summary: Dict) -> str:
+    lines = [
+        f"{'scenario':<18}{'reqs':>7}{'req/s':>8}{'errors':>8}"
+        f"{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'p99.9 ms':>10}{'max ms':>9}"
+    ]
+    rows = list(summary["scenarios"].items()) + [("overall", summary["overall"])]
+    for name, result in rows:
+        latency = result["latency_ms"]
+        lines.append(
+            f"{name:<18}{result['requests']:>7}{result['throughput']:>8.1f}{result['error_rate']:>7.1%} "
+            f"{latency['p50']:>9.1f}{latency['p90']:>9.1f}{latency['p99']:>9.1f}"
+            f"{latency['p99.9']:>10.1f}{latency['max']:>9.1f}"
+        )
+    lines.append(f"target {summary['target_rate']:.1f} req/s, ran {summary['elapsed']:.1f}s")
+    return "\n".join(lines)
+
+
+async def _request(session, semaphore, base_url, scenario, context, start, scheduled, result, loop):
+    headers = {}
+    if "token" in scenario.needs:
+        headers["Authorization"] = f"Bearer {context['token']}"
+    data = {k: v.format(**context) for k, v in scenario.data.items()} if scenario.data else None
+    url = base_url + scenario.path.format(**context)
+    async with semaphore:
+        try:
+            async with session.request(scenario.method, url, headers=headers, data=data) as response:
+                await response.read()
+                status, ok = str(response.status), response.status < 400
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status, ok = type(e).__name__, False
+    now = loop.time()
+    result.record(scenario.name, int((now - scheduled) * 1_000_000), status, ok, int(now - start))
+
+
+async def run_load(
+    base_url: str,
+    rate: float,
+    duration: float,
+    scenarios: List[Scenario] = None,
+    token: str = None,
+    account: str = None,
+    max_concurrency: int = 200,
+    timeout: float = 30,
+    seed: int = None,
+) -> LoadResult:
+    """Send rate requests per second for duration seconds and wait for all of them to finish."""
+    context = {"token": token, "account": account}
+    scenarios = active_scenarios(scenarios or DEFAULT_SCENARIOS, context)
+    if not scenarios:
+        raise ValueError("no scenarios can run without a token or account")
+    weights = [s.weight for s in scenarios]
+    rng = random.Random(seed)
+    counter = itertools.count(1)
+    result = LoadResult(target_rate=rate)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    loop = asyncio.get_running_loop()
+
+    async with aiohttp.ClientSession(
+        headers={"User-Agent": USER_AGENT},
+        timeout=aiohttp.ClientTimeout(total=timeout),
+        connector=aiohttp.TCPConnector(limit=max_concurrency),
+    ) as session:
+        start = loop.time()
+        tasks = []
+        for i in range(int(rate * duration)):
+            scheduled = start + i / rate
+            delay = scheduled - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            scenario = rng.choices(scenarios, weights)[0]
+            request_context = dict(context, n=next(counter))
+            tasks.append(asyncio.create_task(
+                _request(session, semaphore, base_url.rstrip("/"), scenario, request_context, start, scheduled, result, loop)
+            ))
+        await asyncio.gather(*tasks)
+        result.elapsed = loop.time() - start
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay weighted Mastodon API scenarios at a target request rate")
+    parser.add_argument("--base-url", default=os.environ.get("TEST_BASE_URL"), required="TEST_BASE_URL" not in os.environ)
+    parser.add_argument("--rate", type=float, default=10, help="Requests per second (default: 10)")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to send requests for (default: 60)")
+    parser.add_argument("--token", default=os.environ.get("TEST_ACCESS_TOKEN"), help="OAuth access token for home timeline and posting scenarios")
+    parser.add_argument("--account", default=os.environ.get("TEST_ACCOUNT"), help="Account to use in lookup scenarios")
+    parser.add_argument("--concurrency", type=int, default=200, help="Max requests in flight (default: 200)")
+    parser.add_argument("--timeout", type=float, default=30, help="Per-request timeout in seconds (default: 30)")
+    parser.add_argument("--seed", type=int, help="Seed for the scenario mix")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    parser.add_argument("--max-error-rate", type=float, help="Exit non-zero if the overall error rate is above this fraction")
+    parser.add_argument("--max-p99-ms", type=float, help="Exit non-zero if the overall p99 latency is above this")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run_load(
+        args.base_url, args.rate, args.duration, token=args.token, account=args.account,
+        max_concurrency=args.concurrency, timeout=args.timeout, seed=args.seed
+    ))
+    summary = result.summary()
+    print(json.dumps(summary, indent=2) if args.json else format_summary(summary))
+
+    overall = summary["overall"]
+    failed = False
+    if args.max_error_rate is not None and overall["error_rate"] > args.max_error_rate:
+        print(f"error rate {overall['error_rate']:.2%} is above {args.max_error_rate:.2%}", file=sys.stderr)
+        failed = True
+    if args.max_p99_ms is not None and overall["latency_ms"]["p99"] > args.max_p99_ms:
+        print(f"p99 latency {overall['latency_ms']['p99']:.1f}ms is above {args.max_p99_ms:.1f}ms", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+Performance baselines for the Mastodon API load test.
+
+`record` runs load_generator.py against a deployment and appends one JSON
+line per scenario (plus "overall") to baselines/<mastodon version>.jsonl.
+Every line carries the keys a run is compared on: Mastodon version, AMI ID,
+instance type and scenario, along with the latency histogram and the
+successful responses in each second of the run.
+
+`compare` picks the latest run matching each side's filters and tests every
+scenario for regressions in the candidate:
+
+    latency p50   Mann-Whitney U over the two latency histograms
+    latency p99   share of requests slower than the baseline's p99
+    throughput    Welch's t-test over the per-second successful responses
+    error rate    two-proportion z-test
+
+A change is flagged as a regression when it is in the wrong direction,
+significant at --alpha and at least --min-change in size (relative, or
+--min-error-increase for the error rate), so small but real differences
+between long runs don't fail the comparison.
+
+Usage:
+    python perf_baseline.py record --base-url https://mastodon.example.com --stack-name my-stack
+    python perf_baseline.py list
+    python perf_baseline.py compare --baseline version=4.5.0 --candidate version=4.5.1
+    python perf_baseline.py compare --baseline instance_type=t3.large --candidate instance_type=t3.xlarge
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import sys
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+from load_generator import USER_AGENT, LatencyHistogram, LoadResult, run_load
+
+BASELINE_DIR = Path(__file__).resolve().parent / "baselines"
+KEYS = ("version", "ami_id", "instance_type", "scenario")
+UNKNOWN = "unknown"
+
+
+# Statistics
+
+
+def normal_sf(z: float) -> float:
+    """P(Z > z) for a standard normal Z."""
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def _beta_continued_fraction(a: float, b: float, x: float) -> float:
+    """Continued fraction of the incomplete beta function (modified Lentz)."""
+    tiny = 1e-300
+    c, d = 1.0, 1.0 - (a + b) * x / (a + 1)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    fraction = d
+    for m in range(1, 300):
+        for numerator in (
+            m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+            -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1)),
+        ):
+            d = 1.0 + numerator * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            fraction *= c * d
+        if abs(c * d - 1.0) < 1e-12:
+            break
+    return fraction
+
+
+def incomplete_beta(a: float, b: float, x: float) -> float:
+    """Regularized incomplete beta function I_x(a, b)."""
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log(1 - x))
+    if x < (a + 1) / (a + b + 2):
+        return front * _beta_continued_fraction(a, b, x) / a
+    return 1.0 - front * _beta_continued_fraction(b, a, 1 - x) / b
+
+
+def t_cdf(t: float, df: float) -> float:
+    """P(T <= t) for Student's t with df degrees of freedom."""
+    tail = 0.5 * incomplete_beta(df / 2, 0.5, df / (df + t * t))
+    return 1.0 - tail if t > 0 else tail
+
+
+def mann_whitney(baseline: LatencyHistogram, candidate: LatencyHistogram) -> float:
+    """
+    One-sided p-value that candidate latencies are stochastically larger.
+
+    Values in the same histogram bucket are ties; the normal approximation
+    with tie correction is accurate at load test sample sizes.
+    """
+    n1, n2 = baseline.count, candidate.count
+    n = n1 + n2
+    if not n1 or not n2:
+        return 1.0
+    rank = 0
+    candidate_ranks = 0.0
+    ties = 0.0
+    for value in sorted(set(baseline.counts) | set(candidate.counts)):
+        a, b = baseline.counts.get(value, 0), candidate.counts.get(value, 0)
+        t = a + b
+        candidate_ranks += b * (rank + (t + 1) / 2)
+        ties += t ** 3 - t
+        rank += t
+    u = candidate_ranks - n2 * (n2 + 1) / 2
+    variance = n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    return normal_sf((u - n1 * n2 / 2) / math.sqrt(variance))
+
+
+def proportion_increase(baseline_hits: int, baseline_n: int, candidate_hits: int, candidate_n: int) -> float:
+    """One-sided p-value that the candidate's proportion is higher (two-proportion z-test)."""
+    if not baseline_n or not candidate_n:
+        return 1.0
+    pooled = (baseline_hits + candidate_hits) / (baseline_n + candidate_n)
+    se = math.sqrt(pooled * (1 - pooled) * (1 / baseline_n + 1 / candidate_n))
+    difference = candidate_hits / candidate_n - baseline_hits / baseline_n
+    if se == 0:
+        return 0.0 if difference > 0 else 1.0
+    return normal_sf(difference / se)
+
+
+def welch_decrease(baseline: List[float], candidate: List[float]) -> float:
+    """One-sided p-value that the candidate's mean is lower (Welch's t-test)."""
+    n1, n2 = len(baseline), len(candidate)
+    if n1 < 2 or n2 < 2:
+        return 1.0
+    m1, m2 = sum(baseline) / n1, sum(candidate) / n2
+    v1 = sum((x - m1) ** 2 for x in baseline) / (n1 - 1)
+    v2 = sum((x - m2) ** 2 for x in candidate) / (n2 - 1)
+    se2 = v1 / n1 + v2 / n2
+    if se2 == 0:
+        return 0.0 if m2 < m1 else 1.0
+    df = se2 ** 2 / ((v1 / n1) ** 2 / (n1 - 1) + (v2 / n2) ** 2 / (n2 - 1))
+    return t_cdf((m2 - m1) / math.sqrt(se2), df)
+
+
+def count_above(histogram: LatencyHistogram, threshold_us: float) -> int:
+    """Recorded values in buckets entirely above the threshold."""
+    return sum(count for lowest, count in histogram.counts.items() if lowest > threshold_us)
+
+
+# Baseline store
+
+
+def records_from_result(result: LoadResult, keys: Dict, duration: float, run_id: str = None, timestamp: str = None) -> List[Dict]:
+    """One record per scenario and one for the whole run."""
+    run_id = run_id or uuid.uuid4().hex[:12]
+    timestamp = timestamp or datetime.now(timezone.utc).isoformat()
+    summary = result.summary()
+    results = {"overall": result.overall(), **result.scenarios}
+    records = []
+    for scenario, scenario_result in sorted(results.items()):
+        described = summary["overall"] if scenario == "overall" else summary["scenarios"][scenario]
+        records.append({
+            "run_id": run_id,
+            "timestamp": timestamp,
+            **keys,
+            "scenario": scenario,
+            "rate": result.target_rate,
+            "duration": duration,
+            "requests": described["requests"],
+            "errors": described["errors"],
+            "error_rate": described["error_rate"],
+            "throughput": described["throughput"],
+            "latency_ms": described["latency_ms"],
+            "histogram": scenario_result.latency.to_dict(),
+            # whole seconds of the schedule; the last responses arrive after it
+            "per_second": scenario_result.per_second(int(duration)),
+        })
+    return records
+
+
+def baseline_file(directory: Path, version: str) -> Path:
+    return Path(directory) / f"{re.sub(r'[^A-Za-z0-9._-]', '_', version)}.jsonl"
+
+
+def save(records: List[Dict], directory: Path = BASELINE_DIR) -> Path:
+    path = baseline_file(directory, records[0]["version"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    return path
+
+
+def load(directory: Path = BASELINE_DIR) -> List[Dict]:
+    records = []
+    for path in sorted(Path(directory).glob("*.jsonl")):
+        records.extend(json.loads(line) for line in path.read_text().splitlines() if line)
+    return records
+
+
+def runs(records: List[Dict]) -> List[Dict]:
+    """One entry per run, oldest first, with the run's keys and scenarios."""
+    by_run = {}
+    for record in records:
+        run = by_run.setdefault(record["run_id"], {
+            "run_id": record["run_id"],
+            "timestamp": record["timestamp"],
+            "version": record["version"],
+            "ami_id": record["ami_id"],
+            "instance_type": record["instance_type"],
+            "rate": record["rate"],
+            "duration": record["duration"],
+            "scenarios": {},
+        })
+        run["scenarios"][record["scenario"]] = record
+    return sorted(by_run.values(), key=lambda run: run["timestamp"])
+
+
+def parse_filters(filters: List[str]) -> Dict[str, str]:
+    parsed = {}
+    for item in filters:
+        key, _, value = item.partition("=")
+        if key not in ("run_id", *KEYS[:-1]) or not value:
+            raise ValueError(f"invalid filter {item!r}: use run_id, version, ami_id or instance_type=VALUE")
+        parsed[key] = value
+    return parsed
+
+
+def select_run(records: List[Dict], filters: Dict[str, str]) -> Optional[Dict]:
+    """The latest run matching every filter."""
+    matching = [run for run in runs(records) if all(str(run[key]) == value for key, value in filters.items())]
+    return matching[-1] if matching else None
+
+
+# Comparison
+
+
+@dataclass
+class Comparison:
+    scenario: str
+    metric: str
+    baseline: float
+    candidate: float
+    # relative change (absolute for error rates), positive is worse
+    change: float
+    p_value: float
+    significant: bool
+    regression: bool
+
+    @property
+    def verdict(self) -> str:
+        if self.regression:
+            return "REGRESSION"
+        if self.significant and self.change > 0:
+            return "worse (small)"
+        return "ok"
+
+
+def _relative(baseline: float, candidate: float) -> float:
+    if baseline == 0:
+        return 0.0 if candidate == 0 else math.inf
+    return (candidate - baseline) / baseline
+
+
+def compare_scenario(
+        baseline: Dict, candidate: Dict, alpha: float = 0.05, min_change: float = 0.1, min_error_increase: float = 0.01
+) -> List[Comparison]:
+    scenario = baseline["scenario"]
+    base_latency = LatencyHistogram.from_dict(baseline["histogram"])
+    cand_latency = LatencyHistogram.from_dict(candidate["histogram"])
+    comparisons = []
+
+    def add(metric, base, cand, change, p_value, threshold=min_change):
+        significant = p_value < alpha
+        comparisons.append(Comparison(scenario, metric, base, cand, change, p_value, significant, significant and change >= threshold))
+
+    base_p50, cand_p50 = baseline["latency_ms"]["p50"], candidate["latency_ms"]["p50"]
+    add("latency p50 ms", base_p50, cand_p50, _relative(base_p50, cand_p50), mann_whitney(base_latency, cand_latency))
+
+    # under no change about 1% of the candidate's requests are slower than the baseline's p99
+    base_p99, cand_p99 = baseline["latency_ms"]["p99"], candidate["latency_ms"]["p99"]
+    threshold = base_latency.percentile(99)
+    add(
+        "latency p99 ms", base_p99, cand_p99, _relative(base_p99, cand_p99),
+        proportion_increase(count_above(base_latency, threshold), base_latency.count, count_above(cand_latency, threshold), cand_latency.count)
+    )
+
+    base_throughput, cand_throughput = baseline["per_second"], candidate["per_second"]
+    base_mean = sum(base_throughput) / len(base_throughput) if base_throughput else 0.0
+    cand_mean = sum(cand_throughput) / len(cand_throughput) if cand_throughput else 0.0
+    add("throughput ok/s", base_mean, cand_mean, -_relative(base_mean, cand_mean), welch_decrease(base_throughput, cand_throughput))
+
+    # error rates are compared in absolute terms, a baseline is usually at or near zero
+    add(
+        "error rate %", baseline["error_rate"] * 100, candidate["error_rate"] * 100,
+        candidate["error_rate"] - baseline["error_rate"],
+        proportion_increase(baseline["errors"], baseline["requests"], candidate["errors"], candidate["requests"]),
+        min_error_increase
+    )
+    return comparisons
+
+
+def compare_runs(
+        baseline_run: Dict, candidate_run: Dict, alpha: float = 0.05, min_change: float = 0.1, min_error_increase: float = 0.01
+) -> List[Comparison]:
+    comparisons = []
+    for scenario, baseline in sorted(baseline_run["scenarios"].items(), key=lambda item: (item[0] != "overall", item[0])):
+        if scenario in candidate_run["scenarios"]:
+            comparisons.extend(compare_scenario(
+                baseline, candidate_run["scenarios"][scenario], alpha, min_change, min_error_increase
+            ))
+    return comparisons
+
+
+def describe_run(run: Dict) -> str:
+    return (
+        f"{run['run_id']} {run['timestamp'][:19]} Mastodon {run['version']} {run['ami_id']} {run['instance_type']} "
+        f"{run['rate']:g} req/s for {run['duration']:g}s"
+    )
+
+
+def format_comparison(comparisons: List[Comparison]) -> str:
+    lines = [f"{'scenario':<18}{'metric':<17}{'baseline':>10}{'candidate':>11}{'change':>9}{'p-value':>9}  verdict"]
+    for c in comparisons:
+        change = "n/a" if math.isinf(c.change) else f"{c.change:+.1%}"
+        if c.metric.startswith("error rate"):
+            change = f"{c.candidate - c.baseline:+.2f}pp"
+        elif c.metric.startswith("throughput") and not math.isinf(c.change):
+            change = f"{-c.change:+.1%}"
+        lines.append(
+            f"{c.scenario:<18}{c.metric:<17}{c.baseline:>10.2f}{c.candidate:>11.2f}{change:>9}{c.p_value:>9.3f}  {c.verdict}"
+        )
+    return "\n".join(lines)
+
+
+# Recording
+
+
+async def mastodon_version(base_url: str) -> str:
+    async with aiohttp.ClientSession(headers={"User-Agent": USER_AGENT}) as session:
+        async with session.get(f"{base_url.rstrip('/')}/api/v2/instance") as response:
+            response.raise_for_status()
+            return (await response.json())["version"]
+
+
+def stack_instance(stack_name: str, region: str = None) -> Tuple[str, str]:
+    """AMI ID and instance type of a running instance in the stack."""
+    import boto3
+
+    response = boto3.client("ec2", region_name=region).describe_instances(
+        Filters=[
+            {"Name": "tag:aws:cloudformation:stack-name", "Values": [stack_name]},
+            {"Name": "instance-state-name", "Values": ["running"]},
+        ]
+    )
+    for reservation in response["Reservations"]:
+        for instance in reservation["Instances"]:
+            return instance["ImageId"], instance["InstanceType"]
+    raise RuntimeError(f"No running instances found for stack {stack_name}")
+
+
+def record(args) -> int:
+    ami_id, instance_type = args.ami_id, args.instance_type
+    if args.stack_name and not (ami_id and instance_type):
+        stack_ami_id, stack_instance_type = stack_instance(args.stack_name, args.region)
+        ami_id, instance_type = ami_id or stack_ami_id, instance_type or stack_instance_type
+    keys = {
+        "version": args.version or asyncio.run(mastodon_version(args.base_url)),
+        "ami_id": ami_id or UNKNOWN,
+        "instance_type": instance_type or UNKNOWN,
+    }
+    result = asyncio.run(run_load(
+        args.base_url, args.rate, args.duration, token=args.token, account=args.account,
+        max_concurrency=args.concurrency, seed=args.seed
+    ))
+    records = records_from_result(result, keys, args.duration)
+    path = save(records, args.dir)
+    print(describe_run(runs(records)[0]))
+    print(f"saved {len(records)} records to {path}")
+    return 0
+
+
+def list_runs(args) -> int:
+    for run in runs(load(args.dir)):
+        print(describe_run(run))
+    return 0
+
+
+def compare(args) -> int:
+    records = load(args.dir)
+    selected = {}
+    for side in ("baseline", "candidate"):
+        filters = parse_filters(getattr(args, side))
+        selected[side] = select_run(records, filters)
+        if selected[side] is None:
+            print(f"no {side} run matches {filters} in {args.dir}", file=sys.stderr)
+            return 2
+    if selected["baseline"]["run_id"] == selected["candidate"]["run_id"]:
+        print("the baseline and candidate filters select the same run", file=sys.stderr)
+        return 2
+
+    print(f"baseline:  {describe_run(selected['baseline'])}")
+    print(f"candidate: {describe_run(selected['candidate'])}")
+    comparisons = compare_runs(selected["baseline"], selected["candidate"], args.alpha, args.min_change, args.min_error_increase)
+    print(format_comparison(comparisons))
+    regressions = [c for c in comparisons if c.regression]
+    print(
+        f"{len(regressions)} regression(s) at p < {args.alpha}, at least {args.min_change:.0%} worse "
+        f"or {args.min_error_increase:.1%} more errors"
+    )
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record and compare Mastodon load test baselines")
+    parser.add_argument("--dir", type=Path, default=BASELINE_DIR, help="Baseline directory (default: baselines/)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="Run the load test and save the results as a baseline")
+    record_parser.add_argument("--base-url", default=os.environ.get("TEST_BASE_URL"), required="TEST_BASE_URL" not in os.environ)
+    record_parser.add_argument("--rate", type=float, default=10, help="Requests per second (default: 10)")
+    record_parser.add_argument("--duration", type=float, default=60, help="Seconds to send requests for (default: 60)")
+    record_parser.add_argument("--token", default=os.environ.get("TEST_ACCESS_TOKEN"))
+    record_parser.add_argument("--account", default=os.environ.get("TEST_ACCOUNT"))
+    record_parser.add_argument("--concurrency", type=int, default=200)
+    record_parser.add_argument("--seed", type=int)
+    record_parser.add_argument("--stack-name", help="Read the AMI ID and instance type from the stack's running instance")
+    record_parser.add_argument("--region", default=os.environ.get("AWS_REGION"))
+    record_parser.add_argument("--version", help="Mastodon version (default: read from /api/v2/instance)")
+    record_parser.add_argument("--ami-id")
+    record_parser.add_argument("--instance-type")
+    record_parser.set_defaults(func=record)
+
+    list_parser = commands.add_parser("list", help="List the recorded runs")
+    list_parser.set_defaults(func=list_runs)
+
+    compare_parser = commands.add_parser("compare", help="Compare the latest runs matching two sets of filters")
+    compare_parser.add_argument("--baseline", nargs="+", required=True, metavar="KEY=VALUE", help="run_id, version, ami_id or instance_type")
+    compare_parser.add_argument("--candidate", nargs="+", required=True, metavar="KEY=VALUE")
+    compare_parser.add_argument("--alpha", type=float, default=0.05, help="Significance level (default: 0.05)")
+    compare_parser.add_argument("--min-change", type=float, default=0.1, help="Smallest relative change flagged (default: 0.1)")
+    compare_parser.add_argument(
+        "--min-error-increase", type=float, default=0.01, help="Smallest error rate increase flagged, as a fraction (default: 0.01)"
+    )
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
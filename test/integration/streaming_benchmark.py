@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Fan-out benchmark for the Mastodon streaming server.
+
+Opens many concurrent WebSocket subscriptions to /api/v1/streaming, split
+across the public, hashtag and user streams, then posts public statuses
+tagged with the benchmark hashtag through the API. Every open subscription
+should receive every status, so the benchmark reports:
+
+  * delivery latency percentiles, from just before the status was posted
+    until it arrived on a subscription
+  * deliveries missed, i.e. statuses an open subscription never received
+  * connections that failed to open or were dropped by the server
+
+All streams need an access token with read and write:statuses scopes; the
+user stream only receives the statuses because they are posted by the same
+account.
+
+Usage:
+    python streaming_benchmark.py --base-url https://mastodon.example.com --token $TEST_ACCESS_TOKEN \\
+        --connections 2000 --posts 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import resource
+import sys
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import aiohttp
+
+from load_generator import USER_AGENT, LatencyHistogram
+
+STREAMS = ("public", "hashtag", "user")
+MARKER_PATTERN = re.compile(r"bench-[0-9a-f]{8}-\d+")
+
+
+@dataclass
+class StreamingResult:
+    connections: int
+    opened: int = 0
+    connect_failures: int = 0
+    dropped: int = 0
+    posts: int = 0
+    post_failures: int = 0
+    expected: int = 0
+    delivered: int = 0
+    elapsed: float = 0.0
+    latency: Dict[str, LatencyHistogram] = field(default_factory=lambda: {s: LatencyHistogram() for s in STREAMS})
+
+    def summary(self) -> Dict:
+        overall = LatencyHistogram()
+        for histogram in self.latency.values():
+            overall.merge(histogram)
+
+        def describe(histogram: LatencyHistogram) -> Dict:
+            return {
+                "deliveries": histogram.count,
+                "p50": histogram.percentile(50) / 1000,
+                "p90": histogram.percentile(90) / 1000,
+                "p99": histogram.percentile(99) / 1000,
+                "max": (histogram.max or 0) / 1000,
+            }
+
+        return {
+            "connections": self.connections,
+            "opened": self.opened,
+            "connect_failures": self.connect_failures,
+            "dropped": self.dropped,
+            "posts": self.posts,
+            "post_failures": self.post_failures,
+            "expected_deliveries": self.expected,
+            "delivered": self.delivered,
+            "missed_deliveries": max(0, self.expected - self.delivered),
+            "delivery_ratio": self.delivered / self.expected if self.expected else 0.0,
+            "elapsed": self.elapsed,
+            "latency_ms": dict(describe(overall), streams={s: describe(h) for s, h in self.latency.items()}),
+        }
+
+
+def format_summary(summary: Dict) -> str:
+    latency = summary["latency_ms"]
+    lines = [
+        f"connections: {summary['opened']}/{summary['connections']} opened, "
+        f"{summary['connect_failures']} failed, {summary['dropped']} dropped",
+        f"posts: {summary['posts']} ({summary['post_failures']} failed)",
+        f"deliveries: {summary['delivered']}/{summary['expected_deliveries']} "
+        f"({summary['delivery_ratio']:.2%}), {summary['missed_deliveries']} missed",
+        f"{'stream':<10}{'deliveries':>11}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}",
+    ]
+    rows = list(latency["streams"].items()) + [("overall", latency)]
+    for name, row in rows:
+        lines.append(f"{name:<10}{row['deliveries']:>11}{row['p50']:>9.1f}{row['p90']:>9.1f}{row['p99']:>9.1f}{row['max']:>9.1f}")
+    return "\n".join(lines)
+
+
+def raise_open_files_limit() -> None:
+    """Each subscription is a socket, so lift the soft file limit to the hard one."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def streaming_url(session: aiohttp.ClientSession, base_url: str) -> str:
+    """The streaming URL advertised by the instance API, or the base URL with a ws(s) scheme."""
+    try:
+        async with session.get(f"{base_url}/api/v2/instance") as response:
+            url = (await response.json()).get("configuration", {}).get("urls", {}).get("streaming")
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        url = None
+    return (url or re.sub(r"^http", "ws", base_url)).rstrip("/") + "/api/v1/streaming"
+
+
+class StreamingBenchmark:
+
+    def __init__(self, base_url: str, token: str, connections: int, streams: List[str] = STREAMS, tag: str = None):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.streams = [streams[i % len(streams)] for i in range(connections)]
+        self.run_id = uuid.uuid4().hex[:8]
+        self.tag = tag or f"oebench{self.run_id}"
+        self.result = StreamingResult(connections=connections)
+        self.sent: Dict[str, float] = {}
+        self.sockets: List[aiohttp.ClientWebSocketResponse] = []
+        self.stopping = False
+
+    async def _subscribe(self, session, url, stream):
+        loop = asyncio.get_running_loop()
+        params = {"stream": stream}
+        if stream == "hashtag":
+            params["tag"] = self.tag
+        try:
+            ws = await session.ws_connect(url, params=params, headers={"Authorization": f"Bearer {self.token}"}, heartbeat=30)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.result.connect_failures += 1
+            return
+        self.sockets.append(ws)
+        self.result.opened += 1
+        seen = set()
+        async for message in ws:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                continue
+            event = json.loads(message.data)
+            if event.get("event") != "update":
+                continue
+            match = MARKER_PATTERN.search(json.loads(event["payload"]).get("content", ""))
+            if match and match.group() in self.sent and match.group() not in seen:
+                seen.add(match.group())
+                self.result.delivered += 1
+                self.result.latency[stream].record(int((loop.time() - self.sent[match.group()]) * 1_000_000))
+        self.sockets.remove(ws)
+        if not self.stopping:
+            self.result.dropped += 1
+
+    async def _post(self, session, n):
+        loop = asyncio.get_running_loop()
+        marker = f"bench-{self.run_id}-{n}"
+        # recipients are counted when the status is sent, so subscriptions
+        # dropped while it is in flight count as missed deliveries
+        recipients = len(self.sockets)
+        self.sent[marker] = loop.time()
+        try:
+            async with session.post(
+                f"{self.base_url}/api/v1/statuses",
+                headers={"Authorization": f"Bearer {self.token}"},
+                data={"status": f"Streaming benchmark {marker} #{self.tag}", "visibility": "public"},
+            ) as response:
+                await response.read()
+                ok = response.status < 400
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok = False
+        if ok:
+            self.result.posts += 1
+            self.result.expected += recipients
+        else:
+            self.result.post_failures += 1
+            del self.sent[marker]
+
+    async def run(self, posts: int, post_rate: float = 1, connect_rate: float = 200, settle: float = 2, grace: float = 10, timeout: float = 30) -> StreamingResult:
+        """Open the subscriptions, post, wait grace seconds for deliveries and close."""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        async with aiohttp.ClientSession(
+            headers={"User-Agent": USER_AGENT},
+            timeout=aiohttp.ClientTimeout(total=None, connect=timeout, sock_connect=timeout),
+            connector=aiohttp.TCPConnector(limit=0),
+        ) as session:
+            url = await streaming_url(session, self.base_url)
+            readers = []
+            for i, stream in enumerate(self.streams):
+                readers.append(asyncio.create_task(self._subscribe(session, url, stream)))
+                if (i + 1) % max(1, int(connect_rate / 10)) == 0:
+                    await asyncio.sleep(0.1)
+            while self.result.opened + self.result.connect_failures < len(self.streams):
+                await asyncio.sleep(0.1)
+            await asyncio.sleep(settle)
+
+            for n in range(posts):
+                post_start = loop.time()
+                await self._post(session, n)
+                await asyncio.sleep(max(0, 1 / post_rate - (loop.time() - post_start)))
+            await asyncio.sleep(grace)
+
+            self.stopping = True
+            await asyncio.gather(*(ws.close() for ws in list(self.sockets)))
+            await asyncio.gather(*readers)
+        self.result.elapsed = loop.time() - start
+        return self.result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure streaming server fan-out latency over many WebSocket subscriptions")
+    parser.add_argument("--base-url", default=os.environ.get("TEST_BASE_URL"), required="TEST_BASE_URL" not in os.environ)
+    parser.add_argument("--token", default=os.environ.get("TEST_ACCESS_TOKEN"), required="TEST_ACCESS_TOKEN" not in os.environ,
+                        help="Access token with read and write:statuses scopes")
+    parser.add_argument("--connections", type=int, default=1000, help="Subscriptions to open (default: 1000)")
+    parser.add_argument("--streams", default=",".join(STREAMS), help="Streams to spread subscriptions over (default: public,hashtag,user)")
+    parser.add_argument("--connect-rate", type=float, default=200, help="New subscriptions per second (default: 200)")
+    parser.add_argument("--posts", type=int, default=10, help="Statuses to post (default: 10)")
+    parser.add_argument("--post-rate", type=float, default=1, help="Statuses per second (default: 1)")
+    parser.add_argument("--grace", type=float, default=10, help="Seconds to wait for deliveries after the last post (default: 10)")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    parser.add_argument("--max-p99-ms", type=float, help="Exit non-zero if the p99 delivery latency is above this")
+    parser.add_argument("--min-delivery-ratio", type=float, help="Exit non-zero if fewer than this fraction of deliveries arrived")
+    args = parser.parse_args(argv)
+
+    streams = args.streams.split(",")
+    unknown = set(streams) - set(STREAMS)
+    if unknown:
+        parser.error(f"unknown streams: {', '.join(sorted(unknown))}")
+
+    raise_open_files_limit()
+    benchmark = StreamingBenchmark(args.base_url, args.token, args.connections, streams)
+    result = asyncio.run(benchmark.run(args.posts, args.post_rate, args.connect_rate, grace=args.grace))
+    summary = result.summary()
+    print(json.dumps(summary, indent=2) if args.json else format_summary(summary))
+
+    failed = False
+    if args.max_p99_ms is not None and summary["latency_ms"]["p99"] > args.max_p99_ms:
+        print(f"p99 delivery latency {summary['latency_ms']['p99']:.1f}ms is above {args.max_p99_ms:.1f}ms", file=sys.stderr)
+        failed = True
+    if args.min_delivery_ratio is not None and summary["delivery_ratio"] < args.min_delivery_ratio:
+        print(f"delivery ratio {summary['delivery_ratio']:.2%} is below {args.min_delivery_ratio:.2%}", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
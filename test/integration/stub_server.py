@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Mastodon API endpoints used by the load generator
+and the streaming benchmark.
+
+Serves canned responses after a configurable delay, and fails a configurable
+fraction of requests, so the load tools and their reporting can be tested
+without a deployment. Authenticated endpoints return 401 unless the request
+carries the stub's token. Posted statuses are sent as update events to the
+WebSocket subscriptions on /api/v1/streaming whose stream they belong to.
+The inboxes verify HTTP Signatures against the sender's published key and
+count accepted activities by type.
+
+Usage:
+    python stub_server.py --port 8080 --delay-ms 20
+    python load_generator.py --base-url http://127.0.0.1:8080 --token stub-token --account admin
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import re
+
+import aiohttp
+from aiohttp import web
+
+from federation_simulator import ACTIVITY_JSON, parse_signature, verify_signature
+
+TOKEN = "stub-token"
+ACCOUNT = {"id": "1", "username": "admin", "acct": "admin"}
+STATUS = {"id": "1", "content": "<p>Hello</p>", "visibility": "public", "account": ACCOUNT}
+
+
+class StubServer:
+    """
+    Run with "async with StubServer() as base_url:". Requests served are
+    counted per path in requests, and open streaming subscriptions are kept
+    in subscriptions.
+    """
+
+    def __init__(self, delay: float = 0.0, error_rate: float = 0.0, port: int = 0, seed: int = None, stream_delay: float = 0.0):
+        self.delay = delay
+        self.error_rate = error_rate
+        self.port = port
+        self.random = random.Random(seed)
+        self.stream_delay = stream_delay
+        self.requests = {}
+        self.subscriptions = []
+        self.status_ids = itertools.count(1)
+        self.inbox = {}
+        self.public_keys = {}
+        self.runner = None
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get("/", self._index)
+        app.router.add_get("/health", self._health)
+        app.router.add_get("/api/v2/instance", self._instance)
+        app.router.add_get("/api/v1/timelines/public", self._timeline)
+        app.router.add_get("/api/v1/timelines/home", self._authenticated(self._timeline))
+        app.router.add_get("/api/v1/accounts/lookup", self._lookup)
+        app.router.add_post("/api/v1/statuses", self._authenticated(self._post_status))
+        app.router.add_get("/api/v1/streaming", self._authenticated(self._streaming))
+        app.router.add_post("/inbox", self._inbox)
+        app.router.add_post("/users/{name}/inbox", self._inbox)
+        return app
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        self.requests[request.path] = self.requests.get(request.path, 0) + 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.json_response({"error": "stub failure"}, status=503)
+        return await handler(request)
+
+    @staticmethod
+    def _authenticated(handler):
+        async def wrapper(request):
+            if request.headers.get("Authorization") != f"Bearer {TOKEN}":
+                return web.json_response({"error": "The access token is invalid"}, status=401)
+            return await handler(request)
+        return wrapper
+
+    @staticmethod
+    async def _index(request):
+        return web.Response(text="<!DOCTYPE html><html><head><title>Mastodon</title></head><body></body></html>", content_type="text/html")
+
+    @staticmethod
+    async def _health(request):
+        return web.Response(text="OK")
+
+    @staticmethod
+    async def _instance(request):
+        return web.json_response({"domain": "stub.local", "version": "4.5.1"})
+
+    @staticmethod
+    async def _timeline(request):
+        return web.json_response([STATUS] * int(request.query.get("limit", 20)))
+
+    @staticmethod
+    async def _lookup(request):
+        if request.query.get("acct") != ACCOUNT["acct"]:
+            return web.json_response({"error": "Record not found"}, status=404)
+        return web.json_response(ACCOUNT)
+
+    async def _post_status(self, request):
+        form = await request.post()
+        if not form.get("status"):
+            return web.json_response({"error": "Validation failed: Text can't be blank"}, status=422)
+        status = dict(
+            STATUS,
+            id=str(next(self.status_ids)),
+            content=f"<p>{form['status']}</p>",
+            visibility=form.get("visibility", "public"),
+            tags=[{"name": tag.lower()} for tag in re.findall(r"#(\w+)", form["status"])],
+        )
+        asyncio.create_task(self._broadcast(status))
+        return web.json_response(status)
+
+    async def _streaming(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        subscription = (ws, request.query.get("stream"), request.query.get("tag", "").lower())
+        self.subscriptions.append(subscription)
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            self.subscriptions.remove(subscription)
+        return ws
+
+    async def _broadcast(self, status):
+        """Send the status to every subscription it belongs to; all statuses are by the token's user."""
+        if self.stream_delay:
+            await asyncio.sleep(self.stream_delay)
+        tags = {tag["name"] for tag in status["tags"]}
+        public = status["visibility"] == "public"
+        for ws, stream, tag in list(self.subscriptions):
+            if stream == "user" or (public and (stream == "public" or (stream == "hashtag" and tag in tags))):
+                event = {"stream": [stream] + ([tag] if stream == "hashtag" else []), "event": "update", "payload": json.dumps(status)}
+                if not ws.closed:
+                    await ws.send_str(json.dumps(event))
+
+    async def _public_key(self, key_id: str):
+        if key_id not in self.public_keys:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(key_id.split("#")[0], headers={"Accept": ACTIVITY_JSON}) as response:
+                        response.raise_for_status()
+                        self.public_keys[key_id] = (await response.json(content_type=None))["publicKey"]["publicKeyPem"]
+            except aiohttp.ClientError:
+                return None
+        return self.public_keys[key_id]
+
+    async def _inbox(self, request):
+        body = await request.read()
+        key_id = parse_signature(request.headers.get("Signature")).get("keyId")
+        pem = await self._public_key(key_id) if key_id else None
+        if not pem or not verify_signature(request.method, request.path_qs, request.headers, body, pem):
+            return web.json_response({"error": "Verification failed"}, status=401)
+        activity = json.loads(body)
+        self.inbox[activity["type"]] = self.inbox.get(activity["type"], 0) + 1
+        return web.Response(status=202)
+
+    async def disconnect(self, count: int) -> None:
+        """Close count streaming subscriptions from the server side."""
+        for ws, _, _ in list(self.subscriptions)[:count]:
+            await ws.close()
+
+    async def __aenter__(self) -> str:
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", self.port)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        return f"http://127.0.0.1:{port}"
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve stand-in Mastodon API responses for load generator tests")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--delay-ms", type=float, default=0, help="Delay before every response")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests answered with 503")
+    parser.add_argument("--stream-delay-ms", type=float, default=0, help="Delay before posted statuses are streamed")
+    args = parser.parse_args(argv)
+    server = StubServer(args.delay_ms / 1000, args.error_rate, stream_delay=args.stream_delay_ms / 1000)
+    web.run_app(server.app(), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Tests for the synthetic monitoring checks, run against the local stub server.
+"""
+
+import asyncio
+
+from canary_checks import metric_data, run_checks
+from stub_server import StubServer
+
+
+async def check_stub(server, **kwargs):
+    async with server as base_url:
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: run_checks(base_url, **kwargs))
+
+
+class TestCanaryChecks:
+
+    def test_healthy(self):
+        results = asyncio.run(check_stub(StubServer()))
+        assert [r["check"] for r in results] == ["health", "instance_api", "response_time"]
+        assert all(r["success"] for r in results), results
+        assert results[1]["detail"] == "version 4.5.1"
+
+    def test_errors_fail_every_check(self):
+        results = asyncio.run(check_stub(StubServer(error_rate=1)))
+        assert not any(r["success"] for r in results)
+        assert results[0]["detail"] == "status 503"
+
+    def test_slow_home_page_fails_response_time(self):
+        results = {r["check"]: r for r in asyncio.run(check_stub(StubServer(delay=0.2), max_response_time=0.1))}
+        assert results["health"]["success"]
+        assert not results["response_time"]["success"]
+        assert results["response_time"]["latency_ms"] >= 200
+
+    def test_unreachable(self):
+        results = run_checks("http://127.0.0.1:9", timeout=2)
+        assert not any(r["success"] for r in results)
+
+    def test_metric_data(self):
+        data = metric_data([{"check": "health", "success": False, "latency_ms": 12.5}], "vpc", "mastodon-test")
+        dimensions = [
+            {"Name": "Check", "Value": "health"},
+            {"Name": "Location", "Value": "vpc"},
+            {"Name": "StackName", "Value": "mastodon-test"},
+        ]
+        assert data == [
+            {"MetricName": "CanarySuccess", "Unit": "Count", "Value": 0, "Dimensions": dimensions},
+            {"MetricName": "CanaryLatency", "Unit": "Milliseconds", "Value": 12.5, "Dimensions": dimensions},
+        ]
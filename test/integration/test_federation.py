@@ -0,0 +1,119 @@
+"""
+Tests for the ActivityPub federation ingress simulator.
+
+These run the fake remote instance against the stub server's inbox, which
+verifies every HTTP Signature by fetching the actor's key from the fake
+instance, so no deployment is needed.
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import aiohttp
+
+from federation_simulator import (
+    ACTIVITY_JSON, FakeInstance, generate_key, queue_stats, sign_request, simulate, verify_signature, public_key_pem
+)
+from stub_server import StubServer
+
+
+class TestSignatures:
+
+    def test_round_trip(self):
+        key = generate_key()
+        body = b'{"type": "Create"}'
+        headers = sign_request("https://mastodon.example.com/inbox", body, "https://remote.example/users/a#main-key", key)
+        received = {name.title(): value for name, value in headers.items()}
+
+        assert verify_signature("POST", "/inbox", received, body, public_key_pem(key))
+        assert not verify_signature("POST", "/users/b/inbox", received, body, public_key_pem(key))
+        assert not verify_signature("POST", "/inbox", received, b'{"type": "Delete"}', public_key_pem(key))
+        assert not verify_signature("POST", "/inbox", received, body, public_key_pem(generate_key()))
+
+
+class TestFakeInstance:
+
+    def test_serves_webfinger_actor_and_notes(self):
+        async def fetch():
+            async with FakeInstance(actors=2) as public_url, aiohttp.ClientSession() as session:
+                domain = public_url.split("://")[1]
+                async with session.get(f"{public_url}/.well-known/webfinger", params={"resource": f"acct:user1@{domain}"}) as r:
+                    finger = await r.json(content_type=None)
+                async with session.get(finger["links"][0]["href"]) as r:
+                    actor_type, actor = r.content_type, await r.json(content_type=None)
+                async with session.get(f"{actor['id']}/statuses/7") as r:
+                    note = await r.json(content_type=None)
+                async with session.get(f"{public_url}/users/nobody") as r:
+                    missing = r.status
+                return actor_type, actor, note, missing
+
+        actor_type, actor, note, missing = asyncio.run(fetch())
+        assert actor_type == ACTIVITY_JSON
+        assert actor["preferredUsername"] == "user1"
+        assert actor["publicKey"]["id"] == actor["id"] + "#main-key"
+        assert "BEGIN PUBLIC KEY" in actor["publicKey"]["publicKeyPem"]
+        assert note["attributedTo"] == actor["id"]
+        assert missing == 404
+
+    def test_activities(self):
+        instance = FakeInstance(actors=2, public_url="https://remote.example")
+        create = instance.activity("Create", "user0", 1, mention="https://mastodon.example.com/users/admin")
+        announce = instance.activity("Announce", "user0", 2)
+        like = instance.activity("Like", "user1", 3, like_object="https://mastodon.example.com/users/admin/statuses/1")
+
+        assert create["object"]["attributedTo"] == create["actor"]
+        assert create["object"]["tag"] == [{"type": "Mention", "href": "https://mastodon.example.com/users/admin"}]
+        assert announce["object"] == "https://remote.example/users/user1/statuses/2"
+        assert like["object"] == "https://mastodon.example.com/users/admin/statuses/1"
+        assert len({create["id"], announce["id"], like["id"]}) == 3
+
+
+class TestSimulator:
+
+    def test_signed_deliveries_are_accepted(self):
+        async def deliver():
+            server = StubServer()
+            instance = FakeInstance(actors=3)
+            async with server as target, instance:
+                result = await simulate(instance, [f"{target}/inbox", f"{target}/users/admin/inbox"], rate=40, duration=1, fan_out=2, seed=1)
+            return server, instance, result.summary()
+
+        server, instance, summary = asyncio.run(deliver())
+        assert summary["deliveries"] == 80
+        assert summary["accepted"] == 80
+        assert summary["statuses"] == {"202": 80}
+        assert sum(summary["activities"].values()) == 40
+        assert server.inbox == {kind: count * 2 for kind, count in summary["activities"].items()}
+        assert server.requests["/users/admin/inbox"] == 40
+        # the inbox verified every signature against keys fetched from the actors
+        assert set(instance.fetches) <= {"/users/user0", "/users/user1", "/users/user2"}
+
+    def test_unverifiable_signatures_are_rejected(self):
+        async def deliver():
+            async with StubServer() as target:
+                # actors at an address the target can't fetch keys from
+                instance = FakeInstance(actors=1, public_url="http://127.0.0.1:9")
+                return (await simulate(instance, [f"{target}/inbox"], rate=10, duration=1)).summary()
+
+        summary = asyncio.run(deliver())
+        assert summary["accepted"] == 0
+        assert summary["statuses"] == {"401": 10}
+
+
+class TestQueueStats:
+
+    def test_drain_time(self):
+        start = datetime(2025, 1, 1, 12, 0, tzinfo=timezone.utc)
+        point = lambda minute, value: {"Timestamp": start + timedelta(minutes=minute), "Maximum": value}
+        datapoints = {
+            "SidekiqQueueSize": [point(3, 0), point(0, 50), point(1, 4000), point(2, 900), point(4, 0)],
+            "SidekiqQueueLatency": [point(0, 1), point(1, 95), point(2, 40)],
+        }
+
+        stats = queue_stats(datapoints, sent_end=start + timedelta(minutes=1, seconds=30))
+        assert stats == {"peak_size": 4000, "peak_latency": 95, "drain_seconds": 150}
+
+    def test_not_drained(self):
+        start = datetime(2025, 1, 1, 12, 0, tzinfo=timezone.utc)
+        datapoints = {"SidekiqQueueSize": [{"Timestamp": start, "Maximum": 10}]}
+        assert queue_stats(datapoints, sent_end=start)["drain_seconds"] is None
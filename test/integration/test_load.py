@@ -0,0 +1,118 @@
+"""
+Load tests for the Mastodon API.
+
+The TestLoadGenerator tests run the load generator against the local stub
+server and need no deployment. TestMastodonLoad replays the default scenario
+mix against the deployment under test; it is marked load and only runs when
+selected with -m load.
+"""
+
+import asyncio
+import os
+import random
+
+import pytest
+
+from load_generator import DEFAULT_SCENARIOS, LatencyHistogram, Scenario, active_scenarios, run_load
+from stub_server import ACCOUNT, TOKEN, StubServer
+
+
+async def load_stub(rate, duration, server=None, **kwargs):
+    server = server or StubServer()
+    async with server as base_url:
+        return await run_load(base_url, rate, duration, seed=1, **kwargs)
+
+
+class TestLatencyHistogram:
+
+    def test_percentiles_within_precision(self):
+        rng = random.Random(1)
+        values = sorted(int(rng.lognormvariate(10, 1.5)) for _ in range(20000))
+        histogram = LatencyHistogram()
+        for value in values:
+            histogram.record(value)
+
+        assert histogram.count == len(values)
+        assert histogram.min == values[0]
+        assert histogram.max == values[-1]
+        for percentile in (50, 90, 99, 99.9):
+            exact = values[int(len(values) * percentile / 100) - 1]
+            assert histogram.percentile(percentile) == pytest.approx(exact, rel=0.002)
+
+    def test_small_values_are_exact(self):
+        histogram = LatencyHistogram()
+        for value in (3, 1, 2):
+            histogram.record(value)
+        assert [histogram.percentile(p) for p in (1, 50, 100)] == [1, 2, 3]
+
+    def test_merge(self):
+        first, second = LatencyHistogram(), LatencyHistogram()
+        first.record(1000)
+        second.record(5_000_000)
+        first.merge(second)
+        assert first.count == 2
+        assert first.max == 5_000_000
+        assert first.percentile(100) == 5_000_000
+
+    def test_empty(self):
+        assert LatencyHistogram().percentile(99) == 0
+
+
+class TestLoadGenerator:
+
+    def test_scenarios_without_token_or_account_are_skipped(self):
+        names = [s.name for s in active_scenarios(DEFAULT_SCENARIOS, {"token": None, "account": None})]
+        assert names == ["public_timeline", "instance"]
+        assert len(active_scenarios(DEFAULT_SCENARIOS, {"token": "t", "account": "a"})) == len(DEFAULT_SCENARIOS)
+
+    def test_reaches_target_rate_against_stub(self):
+        server = StubServer(delay=0.01)
+        result = asyncio.run(load_stub(100, 2, server, token=TOKEN, account=ACCOUNT["acct"]))
+        summary = result.summary()
+        overall = summary["overall"]
+
+        assert overall["requests"] == 200
+        assert overall["error_rate"] == 0
+        assert overall["throughput"] == pytest.approx(100, rel=0.2)
+        assert overall["latency_ms"]["p50"] >= 10
+        assert set(summary["scenarios"]) == {s.name for s in DEFAULT_SCENARIOS}
+        assert sum(server.requests.values()) == 200
+        assert server.requests["/api/v1/statuses"] == summary["scenarios"]["post_status"]["requests"]
+
+    def test_errors_are_counted_by_status(self):
+        scenarios = [Scenario("home_timeline", 1, "/api/v1/timelines/home", needs=("token",))]
+        result = asyncio.run(load_stub(50, 1, scenarios=scenarios, token="wrong"))
+        overall = result.summary()["overall"]
+        assert overall["error_rate"] == 1
+        assert overall["statuses"] == {"401": 50}
+
+    def test_slow_server_shows_in_latency_not_rate(self):
+        # with one request in flight at a time, later requests wait behind
+        # earlier ones and that wait is part of their latency
+        result = asyncio.run(load_stub(50, 1, StubServer(delay=0.05), max_concurrency=1))
+        latency = result.summary()["overall"]["latency_ms"]
+        assert latency["p99"] > 1000
+        assert latency["min"] >= 50
+
+
+@pytest.mark.load
+@pytest.mark.slow
+class TestMastodonLoad:
+    """Load tests against the deployed Mastodon instance."""
+
+    @pytest.mark.timeout(300)
+    def test_default_scenarios(self, base_url, config):
+        load = config.get("load", {})
+        result = asyncio.run(run_load(
+            base_url,
+            load.get("rate", 10),
+            load.get("duration", 60),
+            token=os.environ.get("TEST_ACCESS_TOKEN"),
+            account=os.environ.get("TEST_ACCOUNT"),
+        ))
+        overall = result.summary()["overall"]
+
+        assert overall["error_rate"] <= load.get("max_error_rate", 0.01), \
+            f"Error rate {overall['error_rate']:.2%} with statuses {overall['statuses']}"
+        assert overall["latency_ms"]["p99"] <= load.get("max_p99_ms", 2000), \
+            f"p99 latency {overall['latency_ms']['p99']:.0f}ms"
@@ -0,0 +1,120 @@
+"""
+Tests for the performance baseline store and regression comparison.
+
+The statistics are checked against reference values, and the record and
+compare steps run the load generator against the local stub server with and
+without an added delay, so no deployment is needed.
+"""
+
+import asyncio
+import json
+import random
+
+import pytest
+
+from load_generator import LatencyHistogram, run_load
+from perf_baseline import (
+    compare_runs, format_comparison, incomplete_beta, load, main, mann_whitney, parse_filters,
+    proportion_increase, records_from_result, runs, save, select_run, t_cdf, welch_decrease
+)
+from stub_server import StubServer
+
+
+def histogram(values):
+    h = LatencyHistogram()
+    for value in values:
+        h.record(value)
+    return h
+
+
+class TestStatistics:
+
+    def test_reference_values(self):
+        assert incomplete_beta(2, 3, 0.4) == pytest.approx(0.5248, abs=1e-4)
+        assert t_cdf(2.0, 10) == pytest.approx(0.96331, abs=1e-5)
+        assert t_cdf(-1.5, 4) == pytest.approx(0.104, abs=1e-6)
+        assert t_cdf(0.0, 7) == pytest.approx(0.5)
+
+    def test_mann_whitney(self):
+        rng = random.Random(1)
+        baseline = histogram(int(rng.gauss(20000, 3000)) for _ in range(2000))
+        same = histogram(int(rng.gauss(20000, 3000)) for _ in range(2000))
+        slower = histogram(int(rng.gauss(21000, 3000)) for _ in range(2000))
+
+        assert mann_whitney(baseline, same) > 0.01
+        assert mann_whitney(baseline, slower) < 0.001
+        # one-sided: faster is not a regression
+        assert mann_whitney(slower, baseline) > 0.99
+
+    def test_welch_and_proportions(self):
+        assert welch_decrease([10, 11, 9, 10, 10], [8, 7, 8, 9, 8]) < 0.01
+        assert welch_decrease([10, 11, 9, 10, 10], [10, 9, 11, 10, 10]) > 0.1
+        assert welch_decrease([10, 10], [10, 10]) == 1.0
+        assert proportion_increase(5, 1000, 40, 1000) < 0.001
+        assert proportion_increase(5, 1000, 6, 1000) > 0.1
+
+
+class TestBaselines:
+
+    @pytest.fixture(scope="class")
+    def results(self):
+        async def load_runs():
+            results = {}
+            for name, delay in (("fast", 0.0), ("slow", 0.05)):
+                async with StubServer(delay=delay) as base_url:
+                    results[name] = await run_load(base_url, rate=100, duration=3, account="admin", seed=1)
+            return results
+
+        return asyncio.run(load_runs())
+
+    def store(self, directory, results):
+        save(records_from_result(results["fast"], {"version": "4.5.0", "ami_id": "ami-1", "instance_type": "t3.large"}, 3,
+                                 run_id="fast", timestamp="2025-01-01T00:00:00+00:00"), directory)
+        save(records_from_result(results["slow"], {"version": "4.5.1", "ami_id": "ami-2", "instance_type": "t3.large"}, 3,
+                                 run_id="slow", timestamp="2025-01-02T00:00:00+00:00"), directory)
+
+    def test_records(self, tmp_path, results):
+        self.store(tmp_path, results)
+        assert sorted(path.name for path in tmp_path.iterdir()) == ["4.5.0.jsonl", "4.5.1.jsonl"]
+
+        record = json.loads((tmp_path / "4.5.0.jsonl").read_text().splitlines()[0])
+        assert {key: record[key] for key in ("run_id", "version", "ami_id", "instance_type")} == {
+            "run_id": "fast", "version": "4.5.0", "ami_id": "ami-1", "instance_type": "t3.large"
+        }
+        scenarios = select_run(load(tmp_path), {"version": "4.5.0"})["scenarios"]
+        assert set(scenarios) == {"overall", "public_timeline", "instance", "account_lookup"}
+        overall = scenarios["overall"]
+        assert overall["requests"] == 300
+        assert len(overall["per_second"]) == 3
+        assert LatencyHistogram.from_dict(overall["histogram"]).count == 300
+
+    def test_select(self, tmp_path, results):
+        self.store(tmp_path, results)
+        records = load(tmp_path)
+        assert [run["run_id"] for run in runs(records)] == ["fast", "slow"]
+        assert select_run(records, {"instance_type": "t3.large"})["run_id"] == "slow"
+        assert select_run(records, {"ami_id": "ami-1"})["run_id"] == "fast"
+        assert select_run(records, {"version": "5.0.0"}) is None
+        with pytest.raises(ValueError):
+            parse_filters(["scenario=overall"])
+
+    def test_compare_flags_latency_regression(self, tmp_path, results):
+        self.store(tmp_path, results)
+        records = load(tmp_path)
+        fast, slow = select_run(records, {"run_id": "fast"}), select_run(records, {"run_id": "slow"})
+
+        regressions = {(c.scenario, c.metric) for c in compare_runs(fast, slow) if c.regression}
+        assert ("overall", "latency p50 ms") in regressions
+        assert ("overall", "latency p99 ms") in regressions
+        assert not any(metric.startswith(("throughput", "error")) for _, metric in regressions)
+        assert not any(c.regression for c in compare_runs(slow, fast))
+        assert "REGRESSION" in format_comparison(compare_runs(fast, slow))
+
+    def test_compare_command(self, tmp_path, results, capsys):
+        self.store(tmp_path, results)
+        assert main(["--dir", str(tmp_path), "compare", "--baseline", "version=4.5.0", "--candidate", "version=4.5.1"]) == 1
+        assert main(["--dir", str(tmp_path), "compare", "--baseline", "version=4.5.1", "--candidate", "ami_id=ami-1"]) == 0
+        assert main(["--dir", str(tmp_path), "compare", "--baseline", "version=4.5.0", "--candidate", "version=4.5.0"]) == 2
+        output = capsys.readouterr().out
+        assert "baseline:  fast" in output
+        assert "REGRESSION" in output
@@ -0,0 +1,90 @@
+"""
+Streaming server fan-out tests.
+
+The TestStreamingBenchmark tests run the benchmark against the local stub
+server. TestMastodonStreaming runs it against the deployment under test; it
+is marked load, only runs when selected with -m load and needs an access
+token in TEST_ACCESS_TOKEN.
+"""
+
+import asyncio
+import os
+
+import pytest
+
+from streaming_benchmark import StreamingBenchmark, streaming_url
+from stub_server import TOKEN, StubServer
+
+
+async def benchmark_stub(server, connections, posts, token=TOKEN, disconnect=0):
+    async with server as base_url:
+        benchmark = StreamingBenchmark(base_url, token, connections)
+        run = asyncio.create_task(benchmark.run(posts, post_rate=20, settle=0.5, grace=0.5))
+        if disconnect:
+            while len(server.subscriptions) < connections:
+                await asyncio.sleep(0.05)
+            await server.disconnect(disconnect)
+        return (await run).summary()
+
+
+class TestStreamingBenchmark:
+
+    def test_every_subscription_receives_every_post(self):
+        summary = asyncio.run(benchmark_stub(StubServer(stream_delay=0.02), 90, 5))
+
+        assert summary["opened"] == 90
+        assert summary["dropped"] == 0
+        assert summary["posts"] == 5
+        assert summary["expected_deliveries"] == 450
+        assert summary["delivered"] == 450
+        assert summary["missed_deliveries"] == 0
+        for stream in ("public", "hashtag", "user"):
+            assert summary["latency_ms"]["streams"][stream]["deliveries"] == 150
+        assert summary["latency_ms"]["p50"] >= 20
+
+    def test_dropped_subscriptions_are_counted(self):
+        summary = asyncio.run(benchmark_stub(StubServer(), 30, 3, disconnect=10))
+
+        assert summary["dropped"] == 10
+        assert summary["expected_deliveries"] == 60
+        assert summary["delivered"] == 60
+
+    def test_rejected_token(self):
+        summary = asyncio.run(benchmark_stub(StubServer(), 10, 2, token="wrong"))
+
+        assert summary["opened"] == 0
+        assert summary["connect_failures"] == 10
+        assert summary["post_failures"] == 2
+        assert summary["delivery_ratio"] == 0
+
+    def test_streaming_url_falls_back_to_base_url(self):
+        async def resolve():
+            import aiohttp
+            async with StubServer() as base_url, aiohttp.ClientSession() as session:
+                return base_url, await streaming_url(session, base_url)
+
+        base_url, url = asyncio.run(resolve())
+        assert url == base_url.replace("http://", "ws://") + "/api/v1/streaming"
+
+
+@pytest.mark.load
+@pytest.mark.slow
+class TestMastodonStreaming:
+    """Streaming fan-out against the deployed Mastodon instance."""
+
+    @pytest.mark.timeout(300)
+    def test_fan_out(self, base_url, config):
+        token = os.environ.get("TEST_ACCESS_TOKEN")
+        if not token:
+            pytest.skip("TEST_ACCESS_TOKEN not set")
+        streaming = config.get("load", {}).get("streaming", {})
+
+        benchmark = StreamingBenchmark(base_url, token, streaming.get("connections", 500))
+        summary = asyncio.run(benchmark.run(streaming.get("posts", 10))).summary()
+
+        assert summary["connect_failures"] == 0, f"{summary['connect_failures']} subscriptions failed to open"
+        assert summary["dropped"] == 0, f"{summary['dropped']} subscriptions dropped"
+        assert summary["delivery_ratio"] >= streaming.get("min_delivery_ratio", 0.99), \
+            f"Only {summary['delivered']} of {summary['expected_deliveries']} deliveries arrived"
+        assert summary["latency_ms"]["p99"] <= streaming.get("max_p99_ms", 2000), \
+            f"p99 delivery latency {summary['latency_ms']['p99']:.0f}ms"
@@ -1,41 +1,26 @@
 """
 User workflow tests for Mastodon using Playwright.
 These tests simulate real user interactions.
+
+Browser fixtures are in conftest.py: every test gets a fresh context, so the
+tests can run in parallel with pytest-xdist (-n auto), and logged in tests
+share one saved session. Page timings are appended to the web vitals report.
 """
 
 import pytest
-import time
-import random
-import string
-from playwright.sync_api import sync_playwright, expect
 
 
 @pytest.mark.ui
 class TestMastodonUIWorkflows:
     """Level 3: UI and user workflow tests."""
 
-    @pytest.fixture(scope="class")
-    def browser_context(self):
-        """Create a browser context for UI tests."""
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            context = browser.new_context(
-                viewport={"width": 1280, "height": 720},
-                user_agent="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36"
-            )
-            yield context
-            context.close()
-            browser.close()
-
-    def test_homepage_loads(self, base_url, browser_context):
+    def test_homepage_loads(self, base_url, browser_context, record_web_vitals):
         """Test that the Mastodon homepage loads correctly."""
         page = browser_context.new_page()
 
         try:
-            page.goto(base_url, wait_until="networkidle", timeout=30000)
-
-            # Wait for page to be interactive
-            page.wait_for_load_state("domcontentloaded")
+            page.goto(base_url, wait_until="domcontentloaded", timeout=30000)
+            record_web_vitals(page, "homepage")
 
             # Check that essential elements are present
             assert page.title(), "Page title should not be empty"
@@ -119,7 +104,7 @@ class TestMastodonUIWorkflows:
         finally:
             page.close()
 
-    def test_public_timeline_accessible(self, base_url, browser_context):
+    def test_public_timeline_accessible(self, base_url, browser_context, record_web_vitals):
         """Test that public timeline is accessible."""
         page = browser_context.new_page()
 
@@ -128,8 +113,8 @@ class TestMastodonUIWorkflows:
             public_url = f"{base_url}/public"
 
             try:
-                page.goto(public_url, timeout=30000)
-                page.wait_for_load_state("domcontentloaded")
+                page.goto(public_url, wait_until="domcontentloaded", timeout=30000)
+                record_web_vitals(page, "public_timeline")
 
                 # Public timeline should show posts or a message
                 # Don't fail if no posts, just verify page loads
@@ -142,14 +127,14 @@ class TestMastodonUIWorkflows:
         finally:
             page.close()
 
-    def test_about_page(self, base_url, browser_context):
+    def test_about_page(self, base_url, browser_context, record_web_vitals):
         """Test that the about page is accessible."""
         page = browser_context.new_page()
 
         try:
             about_url = f"{base_url}/about"
-            page.goto(about_url, timeout=30000)
-            page.wait_for_load_state("domcontentloaded")
+            page.goto(about_url, wait_until="domcontentloaded", timeout=30000)
+            record_web_vitals(page, "about")
 
             # About page should have instance information
             page_content = page.content()
@@ -195,55 +180,47 @@ class TestMastodonUIWorkflows:
 class TestMastodonUserWorkflow:
     """
     End-to-end user workflow tests.
-    These require a test user to be created via tootctl first.
+    These require a test user to be created via tootctl first, with its
+    credentials in TEST_USER_EMAIL and TEST_USER_PASSWORD; see
+    test_user_credentials in conftest.py. The suite logs in once and every
+    test reuses the saved session.
     """
 
-    @pytest.fixture(scope="class")
-    def test_user_credentials(self, config):
-        """
-        Get or create test user credentials.
-
-        Note: For full workflow testing, you'll need to create a test user
-        via tootctl CLI:
-
-        sudo su - mastodon -c 'cd ~/live && RAILS_ENV=production bin/tootctl \
-          accounts create testuser --email test@example.com --confirmed --role User'
-        """
-        pytest.skip(
-            "Full user workflow tests require a pre-configured test user. "
-            "Create one using tootctl and update this fixture."
-        )
-
-        return {
-            "username": "testuser",
-            "email": "test@example.com",
-            "password": "test_password"
-        }
-
-    def test_user_login_workflow(self, base_url, test_user_credentials, browser_context):
-        """Test complete user login workflow."""
-        page = browser_context.new_page()
+    def test_user_login_workflow(self, base_url, authenticated_context):
+        """Test that the saved login gives a logged in session."""
+        page = authenticated_context.new_page()
 
         try:
-            page.goto(base_url, timeout=30000)
+            page.goto(f"{base_url}/home", wait_until="domcontentloaded", timeout=30000)
+
+            # Should be logged in
+            assert "sign_in" not in page.url.lower(), \
+                "Should not be redirected to sign in with a saved session"
+
+        finally:
+            page.close()
 
-            # Navigate to login
-            page.click('a:has-text("Sign in")')
-            page.wait_for_load_state("domcontentloaded")
+    def test_home_timeline_loads(self, base_url, authenticated_context, record_web_vitals):
+        """Test that the logged in home timeline renders."""
+        page = authenticated_context.new_page()
+
+        try:
+            page.goto(f"{base_url}/home", wait_until="domcontentloaded", timeout=30000)
+            page.wait_for_selector(".columns-area", timeout=30000)
+            record_web_vitals(page, "home_timeline")
 
-            # Fill in credentials
-            page.fill('input[type="email"], input[name="username"]',
-                     test_user_credentials["email"])
-            page.fill('input[type="password"]',
-                     test_user_credentials["password"])
+        finally:
+            page.close()
 
-            # Submit login
-            page.click('button[type="submit"]')
-            page.wait_for_load_state("networkidle")
+    def test_settings_page_loads(self, base_url, authenticated_context, record_web_vitals):
+        """Test that the profile settings page renders for the logged in user."""
+        page = authenticated_context.new_page()
 
-            # Should be logged in
+        try:
+            page.goto(f"{base_url}/settings/profile", wait_until="domcontentloaded", timeout=30000)
             assert "sign_in" not in page.url.lower(), \
-                "Should be redirected after login"
+                "Settings should be available with a saved session"
+            record_web_vitals(page, "settings_profile")
 
         finally:
             page.close()
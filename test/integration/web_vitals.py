@@ -0,0 +1,106 @@
+"""
+Page performance capture for the Playwright UI tests.
+
+INIT_SCRIPT is added to every browser context so Largest Contentful Paint and
+layout shifts are observed from the start of each navigation. collect() then
+reads them together with the navigation timing and the JavaScript transferred
+by the page. Every UI test gets a fresh context, so the transfer sizes are for
+a cold cache.
+
+Records are appended to a JSON-lines report, one line per page, so several
+pytest-xdist workers can write to the same file.
+"""
+
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List
+
+INIT_SCRIPT = """
+(() => {
+  const vitals = window.__oeWebVitals = {lcp: null, cls: 0};
+  try {
+    new PerformanceObserver((list) => {
+      const entries = list.getEntries();
+      const last = entries[entries.length - 1];
+      vitals.lcp = last.renderTime || last.loadTime || last.startTime;
+    }).observe({type: "largest-contentful-paint", buffered: true});
+    new PerformanceObserver((list) => {
+      for (const entry of list.getEntries()) {
+        if (!entry.hadRecentInput) vitals.cls += entry.value;
+      }
+    }).observe({type: "layout-shift", buffered: true});
+  } catch (e) {
+    // browsers without these entry types report null
+    vitals.cls = null;
+  }
+})();
+"""
+
+COLLECT_SCRIPT = """
+() => {
+  const nav = performance.getEntriesByType("navigation")[0] || {};
+  const scripts = performance.getEntriesByType("resource")
+    .filter((r) => r.initiatorType === "script" || /\\.js(\\?|$)/.test(r.name));
+  const vitals = window.__oeWebVitals || {};
+  return {
+    ttfb_ms: nav.responseStart,
+    dom_content_loaded_ms: nav.domContentLoadedEventEnd,
+    load_ms: nav.loadEventEnd,
+    lcp_ms: vitals.lcp,
+    cls: vitals.cls,
+    js_requests: scripts.length,
+    js_transfer_bytes: scripts.reduce((sum, r) => sum + (r.transferSize || 0), 0),
+    document_transfer_bytes: nav.transferSize,
+  };
+}
+"""
+
+# LCP can still change shortly after the load event while late content renders
+SETTLE_MS = 1000
+
+
+def collect(page) -> Dict:
+    """Wait for the page to load and settle, then read its timings."""
+    page.wait_for_load_state("load")
+    page.wait_for_timeout(SETTLE_MS)
+    return page.evaluate(COLLECT_SCRIPT)
+
+
+class WebVitalsReport:
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+
+    def reset(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text("")
+
+    def append(self, page_name: str, url: str, metrics: Dict) -> Dict:
+        record = {
+            "page": page_name,
+            "url": url,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "worker": os.environ.get("PYTEST_XDIST_WORKER", "main"),
+            **metrics,
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # one write per line keeps lines from parallel workers whole
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        return record
+
+    def records(self) -> List[Dict]:
+        if not self.path.exists():
+            return []
+        return [json.loads(line) for line in self.path.read_text().splitlines() if line]
+
+    def table(self) -> List[str]:
+        lines = [f"{'page':<18}{'TTFB ms':>9}{'load ms':>9}{'LCP ms':>9}{'CLS':>7}{'JS KB':>8}"]
+        for record in sorted(self.records(), key=lambda r: r["page"]):
+            lines.append(
+                f"{record['page']:<18}{record['ttfb_ms'] or 0:>9.0f}{record['load_ms'] or 0:>9.0f}"
+                f"{record['lcp_ms'] or 0:>9.0f}{record['cls'] or 0:>7.3f}{record['js_transfer_bytes'] / 1024:>8.0f}"
+            )
+        return lines